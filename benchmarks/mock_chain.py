@@ -0,0 +1,762 @@
+""" Local simulated chain for the benchmarks: an eth-tester / py-evm chain with a mock fleet of Uniswap v3 pools,
+    Gamma hypervisors, ERC20 tokens and a Multicall3 deployed at genesis, behind a JSON-RPC provider shim
+    that counts requests and can add latency to mimic a remote node.
+
+    Mock contracts are small EVM programs ( no Solidity compiler needed ):
+     - responder: answers each calldata with the ABI encoded result stored for it ( pools, hypervisors, tokens ),
+       emits event logs sent to it in transactions and stores new answers sent to it in transactions
+     - multicall: Multicall3 aggregate3
+
+    Needs the eth-tester and py-evm packages ( pip install "eth-tester[py-evm]" ).
+"""
+import os
+import sys
+import math
+import time
+import random
+import threading
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from web3 import Web3
+from web3.providers.base import BaseProvider
+from web3.middleware import combine_middlewares
+from eth_abi import abi
+from eth_utils import keccak, event_abi_to_log_topic
+from hexbytes import HexBytes
+
+from bins import file_utilities
+from onchain_analysis_base import _abi_types, erc20, univ3_pool, gamma_hypervisor
+
+
+MIN_TICK = -887272
+MAX_TICK = 887272
+
+# responder selector emitting the event logs in the calldata
+EMIT_SELECTOR = 0xfffffffe
+# responder selector storing the ( slot, value ) pairs in the calldata
+STORE_SELECTOR = 0xfffffffd
+# Multicall3 aggregate3((address,bool,bytes)[])
+AGGREGATE3_SELECTOR = 0x82ad56cb
+
+
+# EVM ASSEMBLER
+_OPCODES = {"STOP":0x00, "ADD":0x01, "MUL":0x02, "SUB":0x03, "LT":0x10, "EQ":0x14, "ISZERO":0x15, "OR":0x17, "SHL":0x1b, "SHR":0x1c,
+            "SHA3":0x20, "CALLDATALOAD":0x35, "CALLDATASIZE":0x36, "CALLDATACOPY":0x37, "RETURNDATASIZE":0x3d, "RETURNDATACOPY":0x3e,
+            "MSTORE":0x52, "MLOAD":0x51, "SLOAD":0x54, "SSTORE":0x55, "JUMP":0x56, "JUMPI":0x57, "GAS":0x5a, "JUMPDEST":0x5b,
+            "DUP1":0x80, "SWAP1":0x90, "LOG0":0xa0, "LOG1":0xa1, "LOG2":0xa2, "LOG3":0xa3, "LOG4":0xa4,
+            "RETURN":0xf3, "STATICCALL":0xfa, "REVERT":0xfd}
+
+class _assembler():
+    """ Minimal EVM assembler: opcodes, pushes, jump labels and word variables kept in memory ( load/store ) """
+
+    def __init__(self):
+        self._items = list() # bytes, ("label", name) or ("push", label name)
+
+    def op(self, *names:str):
+        for name in names:
+            self._items.append(bytes([_OPCODES[name]]))
+
+    def push(self, value:int):
+        size = max(1, (value.bit_length()+7)//8)
+        self._items.append(bytes([0x5f + size]) + value.to_bytes(size, "big"))
+
+    def label(self, name:str):
+        self._items.append(("label", name))
+        self.op("JUMPDEST")
+
+    def jump(self, name:str):
+        self._items.append(("push", name))
+        self.op("JUMP")
+
+    def jumpi(self, name:str):
+        """ jump when the stack top is not zero """
+        self._items.append(("push", name))
+        self.op("JUMPI")
+
+    def load(self, variable:int):
+        self.push(variable)
+        self.op("MLOAD")
+
+    def store(self, variable:int):
+        """ store the stack top """
+        self.push(variable)
+        self.op("MSTORE")
+
+    def assemble(self)->bytes:
+        # label pushes are PUSH2
+        labels = dict()
+        position = 0
+        for item in self._items:
+            if isinstance(item, tuple):
+                if item[0] == "label":
+                    labels[item[1]] = position
+                else:
+                    position += 3
+            else:
+                position += len(item)
+        return b"".join(item if isinstance(item, bytes) else (b"" if item[0] == "label" else b"\x61" + labels[item[1]].to_bytes(2, "big"))
+                        for item in self._items)
+
+
+def responder_code()->bytes:
+    """ Runtime code answering a call with the data stored at storage[keccak(calldata)+1...] ( length+1 at storage[keccak(calldata)] ),
+        reverting on unknown calldata.
+        EMIT_SELECTOR calldata is a list of logs to emit: [ topics count, topics..., data length, data padded to 32 bytes ]...
+        STORE_SELECTOR calldata is a list of storage writes: [ slot, value ]...
+    """
+    H, LEN, I, P, N, D = 0x00, 0x20, 0x40, 0x60, 0x80, 0xa0
+    BUFFER = 0x200
+    a = _assembler()
+    a.push(0)
+    a.op("CALLDATALOAD")
+    a.push(224)
+    a.op("SHR")
+    a.push(EMIT_SELECTOR)
+    a.op("EQ")
+    a.jumpi("emit")
+    a.push(0)
+    a.op("CALLDATALOAD")
+    a.push(224)
+    a.op("SHR")
+    a.push(STORE_SELECTOR)
+    a.op("EQ")
+    a.jumpi("store")
+
+    # answer
+    a.op("CALLDATASIZE")
+    a.push(0)
+    a.push(BUFFER)
+    a.op("CALLDATACOPY")
+    a.op("CALLDATASIZE")
+    a.push(BUFFER)
+    a.op("SHA3")
+    a.store(H)
+    a.load(H)
+    a.op("SLOAD", "DUP1", "ISZERO")
+    a.jumpi("missing")
+    a.push(1)
+    a.op("SWAP1", "SUB")
+    a.store(LEN)
+    a.push(0)
+    a.store(I)
+    a.label("copy")
+    a.load(LEN)
+    a.load(I)
+    a.op("LT", "ISZERO")
+    a.jumpi("answer")
+    a.load(I)
+    a.push(5)
+    a.op("SHR")
+    a.load(H)
+    a.op("ADD")
+    a.push(1)
+    a.op("ADD", "SLOAD")
+    a.load(I)
+    a.push(BUFFER)
+    a.op("ADD", "MSTORE")
+    a.load(I)
+    a.push(32)
+    a.op("ADD")
+    a.store(I)
+    a.jump("copy")
+    a.label("answer")
+    a.load(LEN)
+    a.push(BUFFER)
+    a.op("RETURN")
+    a.label("missing")
+    a.push(0)
+    a.op("DUP1", "REVERT")
+
+    # emit logs
+    a.label("emit")
+    a.push(4)
+    a.store(P)
+    a.label("log")
+    a.op("CALLDATASIZE")
+    a.load(P)
+    a.op("LT", "ISZERO")
+    a.jumpi("done")
+    a.load(P)
+    a.op("CALLDATALOAD")
+    a.store(N)
+    a.load(N)
+    a.push(5)
+    a.op("SHL")
+    a.load(P)
+    a.op("ADD")
+    a.push(32)
+    a.op("ADD")
+    a.store(D)
+    a.load(D)
+    a.op("CALLDATALOAD")
+    a.store(LEN)
+    a.load(LEN)
+    a.load(D)
+    a.push(32)
+    a.op("ADD")
+    a.push(BUFFER)
+    a.op("CALLDATACOPY")
+    for count in range(5):
+        a.load(N)
+        a.push(count)
+        a.op("EQ")
+        a.jumpi("log{}".format(count))
+    a.push(0)
+    a.op("DUP1", "REVERT")
+    for count in range(5):
+        a.label("log{}".format(count))
+        for i in reversed(range(count)):
+            a.load(P)
+            a.push(32 + 32*i)
+            a.op("ADD", "CALLDATALOAD")
+        a.load(LEN)
+        a.push(BUFFER)
+        a.op("LOG{}".format(count))
+        a.jump("next")
+    a.label("next")
+    a.load(LEN)
+    a.push(31)
+    a.op("ADD")
+    a.push(5)
+    a.op("SHR")
+    a.push(5)
+    a.op("SHL")
+    a.load(D)
+    a.op("ADD")
+    a.push(32)
+    a.op("ADD")
+    a.store(P)
+    a.jump("log")
+    a.label("done")
+    a.op("STOP")
+
+    # store answers
+    a.label("store")
+    a.push(4)
+    a.store(P)
+    a.label("slot")
+    a.op("CALLDATASIZE")
+    a.load(P)
+    a.op("LT", "ISZERO")
+    a.jumpi("done")
+    a.load(P)
+    a.push(32)
+    a.op("ADD", "CALLDATALOAD")
+    a.load(P)
+    a.op("CALLDATALOAD", "SSTORE")
+    a.load(P)
+    a.push(64)
+    a.op("ADD")
+    a.store(P)
+    a.jump("slot")
+    return a.assemble()
+
+
+def multicall_code()->bytes:
+    """ Runtime code of Multicall3 aggregate3((address target, bool allowFailure, bytes callData)[]) returns ((bool success, bytes returnData)[]) """
+    A, N, HEADS, CURSOR, I, T, TARGET, B, LENGTH, SUCCESS, PAD = (0x20*x for x in range(11))
+    OUT = 0x200
+    a = _assembler()
+    a.push(0)
+    a.op("CALLDATALOAD")
+    a.push(224)
+    a.op("SHR")
+    a.push(AGGREGATE3_SELECTOR)
+    a.op("EQ", "ISZERO")
+    a.jumpi("fail")
+    a.push(4)
+    a.op("CALLDATALOAD")
+    a.push(4)
+    a.op("ADD")
+    a.store(A)
+    a.load(A)
+    a.op("CALLDATALOAD")
+    a.store(N)
+    a.load(A)
+    a.push(32)
+    a.op("ADD")
+    a.store(HEADS)
+    # result: offset, length, element offsets, elements
+    a.push(32)
+    a.push(OUT)
+    a.op("MSTORE")
+    a.load(N)
+    a.push(OUT + 32)
+    a.op("MSTORE")
+    a.load(N)
+    a.push(5)
+    a.op("SHL")
+    a.push(OUT + 64)
+    a.op("ADD")
+    a.store(CURSOR)
+    a.push(0)
+    a.store(I)
+
+    a.label("loop")
+    a.load(N)
+    a.load(I)
+    a.op("LT", "ISZERO")
+    a.jumpi("done")
+    # call tuple
+    a.load(I)
+    a.push(5)
+    a.op("SHL")
+    a.load(HEADS)
+    a.op("ADD", "CALLDATALOAD")
+    a.load(HEADS)
+    a.op("ADD")
+    a.store(T)
+    a.load(T)
+    a.op("CALLDATALOAD")
+    a.store(TARGET)
+    a.load(T)
+    a.push(64)
+    a.op("ADD", "CALLDATALOAD")
+    a.load(T)
+    a.op("ADD")
+    a.store(B)
+    a.load(B)
+    a.op("CALLDATALOAD")
+    a.store(LENGTH)
+    # call with the calldata copied where its result will be written
+    a.load(LENGTH)
+    a.load(B)
+    a.push(32)
+    a.op("ADD")
+    a.load(CURSOR)
+    a.push(96)
+    a.op("ADD", "CALLDATACOPY")
+    a.push(0)
+    a.push(0)
+    a.load(LENGTH)
+    a.load(CURSOR)
+    a.push(96)
+    a.op("ADD")
+    a.load(TARGET)
+    a.op("GAS", "STATICCALL")
+    a.store(SUCCESS)
+    a.load(SUCCESS)
+    a.load(T)
+    a.push(32)
+    a.op("ADD", "CALLDATALOAD", "OR", "ISZERO")
+    a.jumpi("fail")
+    # element: success, 0x40, length, data padded with zeros
+    a.op("RETURNDATASIZE")
+    a.push(31)
+    a.op("ADD")
+    a.push(5)
+    a.op("SHR")
+    a.push(5)
+    a.op("SHL")
+    a.store(PAD)
+    a.push(0)
+    a.load(PAD)
+    a.load(CURSOR)
+    a.op("ADD")
+    a.push(64)
+    a.op("ADD", "MSTORE")
+    a.load(CURSOR)
+    a.push(OUT + 64)
+    a.op("SWAP1", "SUB")
+    a.load(I)
+    a.push(5)
+    a.op("SHL")
+    a.push(OUT + 64)
+    a.op("ADD", "MSTORE")
+    a.load(SUCCESS)
+    a.load(CURSOR)
+    a.op("MSTORE")
+    a.push(64)
+    a.load(CURSOR)
+    a.push(32)
+    a.op("ADD", "MSTORE")
+    a.op("RETURNDATASIZE")
+    a.load(CURSOR)
+    a.push(64)
+    a.op("ADD", "MSTORE")
+    a.op("RETURNDATASIZE")
+    a.push(0)
+    a.load(CURSOR)
+    a.push(96)
+    a.op("ADD", "RETURNDATACOPY")
+    a.load(PAD)
+    a.load(CURSOR)
+    a.op("ADD")
+    a.push(96)
+    a.op("ADD")
+    a.store(CURSOR)
+    a.load(I)
+    a.push(1)
+    a.op("ADD")
+    a.store(I)
+    a.jump("loop")
+
+    a.label("done")
+    a.push(OUT)
+    a.load(CURSOR)
+    a.op("SUB")
+    a.push(OUT)
+    a.op("RETURN")
+    a.label("fail")
+    a.push(0)
+    a.op("DUP1", "REVERT")
+    return a.assemble()
+
+
+def responder_storage(responses:dict)->dict:
+    """ responder storage answering calldata with result
+
+     Args:
+        responses (dict): calldata bytes: result bytes
+
+     Returns:
+        dict: slot: value
+     """
+    storage = dict()
+    for calldata, result in responses.items():
+        key = int.from_bytes(keccak(calldata), "big")
+        storage[key] = len(result) + 1
+        for i in range(0, len(result), 32):
+            storage[(key + 1 + i//32) % 2**256] = int.from_bytes(result[i:i+32].ljust(32, b"\x00"), "big")
+    return storage
+
+
+def emit_calldata(logs:list)->bytes:
+    """ responder calldata emitting logs
+
+     Args:
+        logs (list): [ (topics list of bytes32, data bytes), ...]
+     """
+    result = EMIT_SELECTOR.to_bytes(4, "big")
+    for topics, data in logs:
+        result += len(topics).to_bytes(32, "big") + b"".join(HexBytes(x).rjust(32, b"\x00") for x in topics)
+        result += len(data).to_bytes(32, "big") + data.ljust(math.ceil(len(data)/32)*32, b"\x00")
+    return result
+
+
+def store_calldata(storage:dict)->bytes:
+    """ responder calldata storing values
+
+     Args:
+        storage (dict): slot: value ( see responder_storage )
+     """
+    return STORE_SELECTOR.to_bytes(4, "big") + b"".join(slot.to_bytes(32, "big") + value.to_bytes(32, "big") for slot, value in storage.items())
+
+
+# PROVIDER SHIM
+def _to_wire(value):
+    """ eth-tester python values to JSON-RPC wire values ( hex quantities and data ) """
+    if isinstance(value, bool) or value == None or isinstance(value, str):
+        return value
+    if isinstance(value, int):
+        return hex(value)
+    if isinstance(value, (bytes, bytearray)):
+        return Web3.toHex(value)
+    if isinstance(value, dict):
+        return {k:_to_wire(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_wire(x) for x in value]
+    return value
+
+
+class latency_provider(BaseProvider):
+    """ JSON-RPC provider over an eth-tester chain answering like a node ( hex encoded results, JSON-RPC batch requests ),
+        counting requests and waiting latency seconds per request ( per batch request ) to mimic a remote node.
+        The chain is accessed by one thread at a time, latencies overlap.
+    """
+
+    def __init__(self, tester, latency:float=0, jitter:float=0, seed:int=1, max_logs:int=0):
+        """
+         Args:
+            tester (eth_tester.EthereumTester):
+            latency (float, optional): seconds per request. Defaults to 0.
+            jitter (float, optional): random seconds added to each request latency ( uniform from 0 ). Defaults to 0.
+            seed (int, optional): jitter random seed. Defaults to 1.
+            max_logs (int, optional): eth_getLogs results above which the range is refused, as nodes do ( 0 = no limit ). Defaults to 0.
+         """
+        super().__init__()
+        # eth-tester request and result formatting
+        from web3.providers.eth_tester import EthereumTesterProvider
+        tester_provider = EthereumTesterProvider(tester)
+        self._request = combine_middlewares(tester_provider.middlewares, Web3(tester_provider), tester_provider.make_request)
+        self.tester = tester
+        self.latency = latency
+        self.jitter = jitter
+        self.max_logs = max_logs
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0 # http requests a node would get
+        self.methods = Counter() # JSON-RPC calls by method ( batch contents included )
+
+    def reset_counts(self):
+        with self._lock:
+            self.requests = 0
+            self.methods = Counter()
+
+    def make_request(self, method, params):
+        self._wait(requests=[method])
+        return self._answer(method, params)
+
+    def make_batch_request(self, requests:list)->list:
+        """ see onchain_rpc.make_batch_request """
+        self._wait(requests=[method for method, params in requests])
+        return [self._answer(method, params) for method, params in requests]
+
+    def isConnected(self)->bool:
+        return True
+
+    def _wait(self, requests:list):
+        with self._lock:
+            self.requests += 1
+            self.methods.update(requests)
+            delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter > 0 else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _answer(self, method, params)->dict:
+        try:
+            with self._lock:
+                response = self._request(method, params)
+        except Exception as e:
+            return {"jsonrpc":"2.0", "id":0, "error":{"code":-32000, "message":"{}: {}".format(type(e).__name__, e)}}
+        response = dict(response)
+        if "result" in response:
+            response["result"] = _to_wire(response["result"])
+            if method == "eth_getLogs" and self.max_logs > 0 and len(response["result"]) > self.max_logs:
+                return {"jsonrpc":"2.0", "id":0, "error":{"code":-32005, "message":"query returned more than {} results".format(self.max_logs)}}
+        return response
+
+
+# MOCK FLEET
+def _load_abi(wrapper_class)->list:
+    return file_utilities.load_json(filename=wrapper_class._abi_filename, folder_path=wrapper_class._abi_path)
+
+
+class _responses():
+    """ ABI encoded answers of one mock contract """
+
+    def __init__(self, abi:list):
+        self._contract = Web3().eth.contract(abi=abi)
+        self._functions = {x["name"]:x for x in abi if x.get("type", "") == "function"}
+        self.items = dict()
+
+    def set(self, function_name:str, *args, result):
+        """ answer of function_name(*args) ( result as web3 returns it: single value or list/tuple of outputs ) """
+        outputs = self._functions[function_name]["outputs"]
+        values = (result,) if len(outputs) == 1 else tuple(result)
+        calldata = HexBytes(self._contract.encodeABI(fn_name=function_name, args=list(args)))
+        self.items[bytes(calldata)] = abi.encode_abi(_abi_types(outputs), values)
+
+
+class mock_chain():
+    """ eth-tester chain with a mock hypervisor fleet deployed at genesis and Rebalance events emitted along its blocks
+
+        chain = mock_chain(fleet_size=20, ticks_per_pool=200, events_per_hypervisor=50, blocks=2000)
+        w3 = chain.web3(latency=0.05)
+        gamma_hypervisor(address=chain.hypervisors[0]["address"], web3Provider=w3).tvl_price_fee(multicall=True, multicall_address=chain.multicall)
+    """
+
+    def __init__(self, fleet_size:int=10, ticks_per_pool:int=100, events_per_hypervisor:int=20, blocks:int=1000,
+                        block_time:tuple=(2, 30), seed:int=1, contracts:dict=None):
+        """
+         Args:
+            fleet_size (int, optional): hypervisors ( one pool each ). Defaults to 10.
+            ticks_per_pool (int, optional): initialized ticks of each pool ( tick density ). Defaults to 100.
+            events_per_hypervisor (int, optional): Rebalance events of each hypervisor ( event volume ). Defaults to 20.
+            blocks (int, optional): blocks mined after genesis, besides one block per event transaction ( events of a hypervisor in the same block ). Defaults to 1000.
+            block_time (tuple, optional): (min, max) seconds between blocks ( uneven block times ). Defaults to (2, 30).
+            seed (int, optional): random seed. Defaults to 1.
+            contracts (dict, optional): more mock contracts deployed at genesis, address: {calldata bytes: result bytes} ( see _responses ). Defaults to None.
+         """
+        from eth_tester import EthereumTester, PyEVMBackend
+
+        self.config = {"fleet_size":fleet_size, "ticks_per_pool":ticks_per_pool, "events_per_hypervisor":events_per_hypervisor,
+                       "blocks":blocks, "block_time":list(block_time), "seed":seed}
+        self._random = random.Random(seed)
+        self._abis = {x:_load_abi(x) for x in (erc20, univ3_pool, gamma_hypervisor)}
+        self.multicall = Web3.toChecksumAddress("0x" + "ca11"*10)
+        self.tokens = list()
+        self.pools = list()
+        self.hypervisors = list()
+
+        answers = {address:responses.items for address, responses in self._create_fleet(fleet_size=fleet_size, ticks_per_pool=ticks_per_pool).items()}
+        answers.update(contracts or dict())
+        genesis_state = PyEVMBackend.generate_genesis_state(num_accounts=1)
+        for address, responses in answers.items():
+            genesis_state[HexBytes(address)] = {"balance":0, "nonce":0, "code":responder_code(), "storage":responder_storage(responses)}
+        genesis_state[HexBytes(self.multicall)] = {"balance":0, "nonce":0, "code":multicall_code(), "storage":{}}
+        self.tester = EthereumTester(PyEVMBackend(genesis_state=genesis_state))
+        self._mine(blocks=blocks, block_time=block_time, events_per_hypervisor=events_per_hypervisor)
+
+   # PROPERTIES
+    @property
+    def head(self)->int:
+        return self.tester.get_block_by_number("latest")["number"]
+
+    def web3(self, latency:float=0, jitter:float=0, max_logs:int=0)->Web3:
+        """ New Web3 object of the chain ( with its own latency_provider: see .provider ) """
+        return Web3(latency_provider(self.tester, latency=latency, jitter=jitter, max_logs=max_logs))
+
+    def block_timestamps(self)->list:
+        """ [ (block, timestamp), ...] of all blocks """
+        return [(x, self.tester.get_block_by_number(x)["timestamp"]) for x in range(self.head + 1)]
+
+   # STATE CHANGES
+    def emit(self, address:str, logs:list)->int:
+        """ Emit event logs from a mock contract in a new block
+
+         Args:
+            address (str): mock contract
+            logs (list): [ (topics list of bytes32, data bytes), ...]
+
+         Returns:
+            int: block of the logs
+         """
+        self._send(address=address, data=emit_calldata(logs))
+        return self.head
+
+    def set_responses(self, address:str, responses:dict, slots_per_block:int=300)->int:
+        """ Change the answers of a mock contract ( from the next block on )
+
+         Args:
+            address (str): mock contract
+            responses (dict): calldata bytes: result bytes ( see _responses )
+            slots_per_block (int, optional): storage writes of each block ( block gas limit ). Defaults to 300.
+
+         Returns:
+            int: first block answering all the new results
+         """
+        storage = list(responder_storage(responses).items())
+        for i in range(0, len(storage), slots_per_block):
+            self._send(address=address, data=store_calldata(dict(storage[i:i+slots_per_block])))
+        return self.head
+
+   # HELPERS
+    def _address(self, kind:int, index:int)->str:
+        return Web3.toChecksumAddress("0x{:02x}{:038x}".format(kind, index + 1))
+
+    def _create_fleet(self, fleet_size:int, ticks_per_pool:int)->dict:
+        """ mock contracts answers
+
+         Returns:
+            dict: address: _responses
+         """
+        contracts = dict()
+        rnd = self._random
+        token_count = max(2, min(fleet_size + 1, 8))
+        for i in range(token_count):
+            address = self._address(0x70, i)
+            responses = _responses(self._abis[erc20])
+            decimals = [6, 18, 8, 18][i % 4]
+            responses.set("decimals", result=decimals)
+            responses.set("symbol", result="TK{}".format(i))
+            responses.set("name", result="Token {}".format(i))
+            responses.set("totalSupply", result=10**9 * 10**decimals)
+            contracts[address] = responses
+            self.tokens.append({"address":address, "decimals":decimals})
+
+        for i in range(fleet_size):
+            pool_address, hypervisor_address = self._address(0x90, i), self._address(0x60, i)
+            token0, token1 = self.tokens[i % (token_count - 1)], self.tokens[(i % (token_count - 1)) + 1]
+            fee, tickSpacing = rnd.choice([(500, 10), (3000, 60), (10000, 200)])
+            tick = rnd.randint(-200000, 200000)
+            compressed = tick//tickSpacing
+            baseLower, baseUpper = (compressed - rnd.randint(5, 50))*tickSpacing, (compressed + rnd.randint(5, 50))*tickSpacing
+            limitLower, limitUpper = (compressed + 1)*tickSpacing, (compressed + rnd.randint(2, 20))*tickSpacing
+
+            # pool positions: the hypervisor's and random ones up to the tick density
+            positions = [(hypervisor_address, baseLower, baseUpper, rnd.randint(10**15, 10**18)),
+                         (hypervisor_address, limitLower, limitUpper, rnd.randint(10**12, 10**15))]
+            initialized = {baseLower, baseUpper, limitLower, limitUpper}
+            while len(initialized) < ticks_per_pool:
+                lower = (compressed + rnd.randint(-3000, 3000))*tickSpacing
+                upper = lower + rnd.randint(1, 500)*tickSpacing
+                if lower >= MIN_TICK and upper <= MAX_TICK:
+                    positions.append((self._address(0x50, len(positions)), lower, upper, rnd.randint(10**12, 10**18)))
+                    initialized.update([lower, upper])
+            ticks = dict() # tick: [liquidityGross, liquidityNet]
+            for owner, lower, upper, liquidity in positions:
+                ticks.setdefault(lower, [0, 0])
+                ticks.setdefault(upper, [0, 0])
+                ticks[lower][0] += liquidity
+                ticks[lower][1] += liquidity
+                ticks[upper][0] += liquidity
+                ticks[upper][1] -= liquidity
+
+            pool = _responses(self._abis[univ3_pool])
+            feeGrowthGlobal = [rnd.randint(2**128, 2**140), rnd.randint(2**128, 2**140)]
+            pool.set("token0", result=token0["address"])
+            pool.set("token1", result=token1["address"])
+            pool.set("fee", result=fee)
+            pool.set("tickSpacing", result=tickSpacing)
+            pool.set("slot0", result=(int(math.sqrt(1.0001**tick)*2**96), tick, 0, 1, 1, 0, True))
+            pool.set("liquidity", result=sum(x[3] for x in positions if x[1] <= tick < x[2]))
+            pool.set("feeGrowthGlobal0X128", result=feeGrowthGlobal[0])
+            pool.set("feeGrowthGlobal1X128", result=feeGrowthGlobal[1])
+            for x, (liquidityGross, liquidityNet) in ticks.items():
+                pool.set("ticks", x, result=(liquidityGross, liquidityNet, rnd.randint(0, feeGrowthGlobal[0]//4), rnd.randint(0, feeGrowthGlobal[1]//4), 0, 0, 0, True))
+            bitmap = dict()
+            for x in ticks.keys():
+                bitmap[(x//tickSpacing) >> 8] = bitmap.get((x//tickSpacing) >> 8, 0) | 1 << ((x//tickSpacing) & 255)
+            for word in range((MIN_TICK//tickSpacing) >> 8, ((MAX_TICK//tickSpacing) >> 8) + 1):
+                pool.set("tickBitmap", word, result=bitmap.get(word, 0))
+            for owner, lower, upper, liquidity in positions[:2]:
+                pool.set("positions", univ3_pool.get_positionKey(ownerAddress=owner, tickLower=lower, tickUpper=upper),
+                         result=(liquidity, rnd.randint(0, feeGrowthGlobal[0]//4), rnd.randint(0, feeGrowthGlobal[1]//4), rnd.randint(0, 10**6), rnd.randint(0, 10**6)))
+            contracts[pool_address] = pool
+
+            hypervisor = _responses(self._abis[gamma_hypervisor])
+            totalSupply = rnd.randint(10**18, 10**24)
+            hypervisor.set("pool", result=pool_address)
+            hypervisor.set("token0", result=token0["address"])
+            hypervisor.set("token1", result=token1["address"])
+            hypervisor.set("baseLower", result=baseLower)
+            hypervisor.set("baseUpper", result=baseUpper)
+            hypervisor.set("limitLower", result=limitLower)
+            hypervisor.set("limitUpper", result=limitUpper)
+            hypervisor.set("currentTick", result=tick)
+            hypervisor.set("fee", result=10)
+            hypervisor.set("tickSpacing", result=tickSpacing)
+            hypervisor.set("decimals", result=18)
+            hypervisor.set("symbol", result="xTK{}".format(i))
+            hypervisor.set("name", result="Mock hypervisor {}".format(i))
+            hypervisor.set("totalSupply", result=totalSupply)
+            hypervisor.set("getTotalAmounts", result=(rnd.randint(0, 10**30), rnd.randint(0, 10**30)))
+            contracts[hypervisor_address] = hypervisor
+
+            # parked tokens
+            for token in [token0, token1]:
+                contracts[token["address"]].set("balanceOf", hypervisor_address, result=rnd.randint(0, 10**6 * 10**token["decimals"]))
+
+            self.pools.append({"address":pool_address, "tickSpacing":tickSpacing, "ticks":len(ticks)})
+            self.hypervisors.append({"address":hypervisor_address, "pool":pool_address, "baseLower":baseLower, "baseUpper":baseUpper,
+                                     "limitLower":limitLower, "limitUpper":limitUpper, "tick":tick, "totalSupply":totalSupply})
+        return contracts
+
+    def _mine(self, blocks:int, block_time:tuple, events_per_hypervisor:int):
+        """ mine blocks with uneven times, the hypervisors' Rebalance events at random ones """
+        rnd = self._random
+        event = [x for x in self._abis[gamma_hypervisor] if x.get("type", "") == "event" and x["name"] == "Rebalance"][0]
+        topic = event_abi_to_log_topic(event)
+        data_types = _abi_types([x for x in event["inputs"] if not x.get("indexed", False)])
+
+        scheduled = dict() # block: {hypervisor address: [logs]}
+        for hypervisor in self.hypervisors:
+            for block in (rnd.randint(1, blocks) for _ in range(events_per_hypervisor)) if blocks > 0 else []:
+                data = abi.encode_abi(data_types, [hypervisor["tick"] + rnd.randint(-100, 100), rnd.randint(0, 10**30), rnd.randint(0, 10**30),
+                                                   rnd.randint(0, 10**20), rnd.randint(0, 10**20), hypervisor["totalSupply"]])
+                scheduled.setdefault(block, dict()).setdefault(hypervisor["address"], list()).append(([topic], data))
+
+        # time_travel mines one block, each event transaction one more ( a second later )
+        timestamp = self.tester.get_block_by_number("latest")["timestamp"]
+        for block in range(1, blocks + 1):
+            timestamp = max(timestamp + rnd.randint(*block_time), self.tester.get_block_by_number("latest")["timestamp"] + 2)
+            self.tester.time_travel(timestamp)
+            for address, logs in scheduled.get(block, dict()).items():
+                self._send(address=address, data=emit_calldata(logs))
+
+    def _send(self, address:str, data:bytes):
+        """ transaction to a mock contract ( mined in its own block ) """
+        self.tester.send_transaction({"from":self.tester.get_accounts()[0], "to":address, "gas":10000000, "data":Web3.toHex(data)})
@@ -0,0 +1,78 @@
+""" Compare the scalar ( onchain_analysis_base.calculate_tvlPriceFees ) and vectorized ( onchain_univ3.calculate_tvlPriceFees_arrays )
+    Uniswap v3 position math on random positions, checking both return the same results.
+
+    python benchmarks/position_math.py [rows]
+"""
+import os
+import sys
+import time
+import json
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from onchain_analysis_base import calculate_tvlPriceFees
+from onchain_univ3 import calculate_tvlPriceFees_arrays
+
+
+def random_rows(count:int, seed:int=1)->list:
+    """ random position states, fee growth values close to uint256 overflow included """
+    rnd = random.Random(seed)
+    rows = list()
+    for i in range(count):
+        tick = rnd.randint(-200000, 200000)
+        tickLower = tick + rnd.randint(-5000, 4000)
+        tickUpper = tickLower + rnd.randint(10, 6000)
+        feeGrowthGlobal = [rnd.randint(0, 2**256-1) for _ in range(2)]
+        growth = [rnd.randint(0, 2**200) for _ in range(6)]
+        rows.append({"tick":tick, "tickLower":tickLower, "tickUpper":tickUpper, "liquidity":rnd.randint(0, 2**100),
+                     "feeGrowthGlobal0X128":feeGrowthGlobal[0], "feeGrowthGlobal1X128":feeGrowthGlobal[1],
+                     "feeGrowthOutside0X128_lower":(feeGrowthGlobal[0] - growth[0]) % 2**256, "feeGrowthOutside0X128_upper":(feeGrowthGlobal[0] - growth[1]) % 2**256,
+                     "feeGrowthOutside1X128_lower":(feeGrowthGlobal[1] - growth[2]) % 2**256, "feeGrowthOutside1X128_upper":(feeGrowthGlobal[1] - growth[3]) % 2**256,
+                     "feeGrowthInside0LastX128":growth[4], "feeGrowthInside1LastX128":growth[5],
+                     "tokensOwed0":rnd.randint(0, 2**64), "tokensOwed1":rnd.randint(0, 2**64),
+                     "decimals_token0":6, "decimals_token1":18})
+    return rows
+
+
+def scalar(rows:list)->list:
+    return [calculate_tvlPriceFees(position={"liquidity":row["liquidity"],
+                                             "feeGrowthInside0LastX128":row["feeGrowthInside0LastX128"], "feeGrowthInside1LastX128":row["feeGrowthInside1LastX128"],
+                                             "tokensOwed0":row["tokensOwed0"], "tokensOwed1":row["tokensOwed1"]},
+                                   tick=row["tick"], tickUpper=row["tickUpper"], tickLower=row["tickLower"],
+                                   ticks_lower={"feeGrowthOutside0X128":row["feeGrowthOutside0X128_lower"], "feeGrowthOutside1X128":row["feeGrowthOutside1X128_lower"]},
+                                   ticks_upper={"feeGrowthOutside0X128":row["feeGrowthOutside0X128_upper"], "feeGrowthOutside1X128":row["feeGrowthOutside1X128_upper"]},
+                                   feeGrowthGlobal0X128=row["feeGrowthGlobal0X128"], feeGrowthGlobal1X128=row["feeGrowthGlobal1X128"],
+                                   decimals_token0=row["decimals_token0"], decimals_token1=row["decimals_token1"])
+            for row in rows]
+
+
+def vectorized(columns:dict)->dict:
+    return calculate_tvlPriceFees_arrays(**columns)
+
+
+def main(count:int=10000):
+    rows = random_rows(count)
+    columns = {k:[row[k] for row in rows] for k in rows[0].keys()}
+
+    start = time.perf_counter()
+    result_scalar = scalar(rows)
+    time_scalar = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result_vector = vectorized(columns)
+    time_vector = time.perf_counter() - start
+
+    for key, values in result_vector.items():
+        if not np.allclose(values, [x[key] for x in result_scalar], rtol=1e-9, atol=0):
+            raise AssertionError(" scalar and vectorized {} differ".format(key))
+
+    print(json.dumps({"benchmark":"position_math", "rows":count,
+                      "scalar_seconds":round(time_scalar, 4), "vectorized_seconds":round(time_vector, 4),
+                      "speedup":round(time_scalar/time_vector, 1)}))
+
+
+if __name__ == "__main__":
+    main(count=int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
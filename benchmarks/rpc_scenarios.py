@@ -0,0 +1,220 @@
+""" RPC cost of the main read paths ( tvl_price_fee, get_tvlPriceFees, blockNumberFromTimestamp, get_chunked_events, load_tick_map )
+    on a local simulated chain ( see mock_chain ): RPC requests, wall time and peak memory per scenario, each one with cold caches.
+    Results are checked against the mock fleet and written as JSON so runs can be compared over time.
+
+    python benchmarks/rpc_scenarios.py [--fleet 10] [--ticks 100] [--events 20] [--blocks 1000] [--latency 0.01] [--jitter 0]
+                                       [--scenarios tvl_price_fee,get_chunked_events] [--output results.json] [--compare previous.json] [--no-memory]
+
+    Needs the eth-tester and py-evm packages ( pip install "eth-tester[py-evm]" ).
+"""
+import os
+import sys
+import time
+import json
+import random
+import bisect
+import argparse
+import tempfile
+import platform
+import tracemalloc
+import datetime as dt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onchain_analysis_base import web3wrap, univ3_pool, gamma_hypervisor, new_cycle
+from onchain_cache import metadata_store, block_index, event_store
+import onchain_rpc
+import onchain_metrics
+
+from mock_chain import mock_chain, latency_provider
+
+
+RESULTS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+# SCENARIOS
+def tvl_price_fee(chain:mock_chain, w3, **kwargs)->dict:
+    for hypervisor in chain.hypervisors:
+        result = gamma_hypervisor(address=hypervisor["address"], web3Provider=w3).tvl_price_fee(**kwargs)
+        if result["qtty_token0"] <= 0 and result["qtty_token1"] <= 0:
+            raise AssertionError(" hypervisor {} without tvl".format(hypervisor["address"]))
+    return {"items":len(chain.hypervisors)}
+
+def tvl_price_fee_multicall(chain:mock_chain, w3)->dict:
+    return tvl_price_fee(chain, w3, multicall=True, multicall_address=chain.multicall)
+
+def tvl_price_fee_batch(chain:mock_chain, w3)->dict:
+    return tvl_price_fee(chain, w3, batch=True)
+
+def get_tvlPriceFees(chain:mock_chain, w3)->dict:
+    for hypervisor in chain.hypervisors:
+        pool = univ3_pool(address=hypervisor["pool"], web3Provider=w3)
+        pool.get_tvlPriceFees(ownerAddress=hypervisor["address"], tickUpper=hypervisor["baseUpper"], tickLower=hypervisor["baseLower"])
+        pool.get_tvlPriceFees(ownerAddress=hypervisor["address"], tickUpper=hypervisor["limitUpper"], tickLower=hypervisor["limitLower"])
+    return {"items":2*len(chain.hypervisors)}
+
+def blockNumberFromTimestamp(chain:mock_chain, w3, samples:int=50)->dict:
+    blocks = chain.block_timestamps()
+    timestamps = [x[1] for x in blocks]
+    rnd = random.Random(len(blocks))
+    wrapper = gamma_hypervisor(address=chain.hypervisors[0]["address"], web3Provider=w3)
+    for timestamp in (rnd.randint(timestamps[0], timestamps[-1]) for _ in range(samples)):
+        expected = blocks[bisect.bisect_right(timestamps, timestamp) - 1][0]
+        found = wrapper.blockNumberFromTimestamp(timestamp)
+        if found != expected:
+            raise AssertionError(" timestamp {} found at block {} instead of {}".format(timestamp, found, expected))
+    return {"items":samples}
+
+def get_chunked_events(chain:mock_chain, w3)->dict:
+    wrapper = gamma_hypervisor(address=chain.hypervisors[0]["address"], web3Provider=w3)
+    eventfilter = {"fromBlock":0, "toBlock":wrapper.block, "address":[x["address"] for x in chain.hypervisors], "topics":[[wrapper.event_topic("Rebalance")]]}
+    count = sum(1 for x in wrapper.get_chunked_events(eventfilter))
+    expected = len(chain.hypervisors)*chain.config["events_per_hypervisor"]
+    if count != expected:
+        raise AssertionError(" {} Rebalance events found instead of {}".format(count, expected))
+    return {"items":count}
+
+def get_chunked_events_warm(chain:mock_chain, w3)->dict:
+    return get_chunked_events(chain, w3)
+# run once before measuring: event store synced
+get_chunked_events_warm.warm = True
+
+def load_tick_map(chain:mock_chain, w3)->dict:
+    count = 0
+    for pool in chain.pools:
+        ticks = univ3_pool(address=pool["address"], web3Provider=w3).load_tick_map(multicall_address=chain.multicall).ticks
+        if len(ticks) != pool["ticks"]:
+            raise AssertionError(" {} ticks of pool {} found instead of {}".format(len(ticks), pool["address"], pool["ticks"]))
+        count += len(ticks)
+    return {"items":count}
+
+
+SCENARIOS = {"tvl_price_fee":tvl_price_fee,
+             "tvl_price_fee_multicall":tvl_price_fee_multicall,
+             "tvl_price_fee_batch":tvl_price_fee_batch,
+             "get_tvlPriceFees":get_tvlPriceFees,
+             "blockNumberFromTimestamp":blockNumberFromTimestamp,
+             "get_chunked_events":get_chunked_events,
+             "get_chunked_events_warm":get_chunked_events_warm,
+             "load_tick_map":load_tick_map,
+             }
+
+
+# RUNNER
+def _cold_caches(folder:str):
+    """ empty call cache and new persistent stores """
+    os.makedirs(folder, exist_ok=True)
+    filename = os.path.join(folder, "onchain.sqlite")
+    web3wrap._call_cache.clear()
+    web3wrap._metadata_store = metadata_store(filename=filename)
+    web3wrap._block_index = block_index(filename=filename)
+    web3wrap._event_store = event_store(filename=filename)
+    # the mock node stands in for an rpc_router: calls skip web3 middlewares the same way
+    web3wrap._raw_call_providers = (onchain_rpc.rpc_router, latency_provider)
+    new_cycle()
+
+def _run(chain:mock_chain, scenario, folder:str, latency:float, jitter:float, memory:bool=False):
+    _cold_caches(folder)
+    w3 = chain.web3(latency=latency, jitter=jitter)
+    if getattr(scenario, "warm", False):
+        scenario(chain, w3)
+        w3.provider.reset_counts()
+    if memory:
+        tracemalloc.start()
+    try:
+        with onchain_metrics.metrics.budget(name=scenario.__name__) as budget:
+            start = time.perf_counter()
+            info = scenario(chain, w3)
+            wall_time = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if memory else None
+    finally:
+        if memory:
+            tracemalloc.stop()
+        # release the stores before their folder goes
+        for store in (web3wrap._metadata_store, web3wrap._block_index, web3wrap._event_store):
+            store.close()
+    return w3.provider, budget, wall_time, peak, info
+
+def run_scenario(chain:mock_chain, name:str, latency:float=0, jitter:float=0, memory:bool=True)->dict:
+    """ Run a scenario with cold caches ( a second time under tracemalloc for its peak memory )
+
+     Returns:
+        dict: {"name", "wall_time", "rpc_requests", "rpc_methods", "calls", "cache_hits", "cache_misses", "rpc_latency", "memory_peak_bytes", "items"}
+     """
+    scenario = SCENARIOS[name]
+    with tempfile.TemporaryDirectory() as folder:
+        provider, budget, wall_time, peak, info = _run(chain, scenario, folder=os.path.join(folder, "timed"), latency=latency, jitter=jitter)
+        if memory:
+            peak = _run(chain, scenario, folder=os.path.join(folder, "memory"), latency=latency, jitter=jitter, memory=True)[3]
+    return {"name":name,
+            "wall_time":round(wall_time, 4),
+            "rpc_requests":provider.requests,
+            "rpc_methods":dict(provider.methods),
+            "calls":sum(x["calls"] for x in budget.report()["rows"] if x["kind"] == "call"),
+            "cache_hits":budget.hits,
+            "cache_misses":budget.misses,
+            "rpc_latency":round(budget.latency, 4),
+            "memory_peak_bytes":peak,
+            **info}
+
+
+def compare(result:dict, previous:dict):
+    """ Print the changes from a previous run """
+    previous = {x["name"]:x for x in previous["scenarios"]}
+    for row in result["scenarios"]:
+        before = previous.get(row["name"], None)
+        if before == None:
+            continue
+        changes = {"name":row["name"],
+                   "wall_time":"{:+.1%}".format(row["wall_time"]/before["wall_time"] - 1) if before["wall_time"] else None,
+                   "rpc_requests":row["rpc_requests"] - before["rpc_requests"]}
+        if row.get("memory_peak_bytes", None) and before.get("memory_peak_bytes", None):
+            changes["memory_peak_bytes"] = "{:+.1%}".format(row["memory_peak_bytes"]/before["memory_peak_bytes"] - 1)
+        print(json.dumps({"compare":changes}))
+
+
+def main(fleet:int=10, ticks:int=100, events:int=20, blocks:int=1000, latency:float=0.01, jitter:float=0, scenarios:list=None,
+            output:str=None, previous:str=None, memory:bool=True)->dict:
+    start = time.perf_counter()
+    chain = mock_chain(fleet_size=fleet, ticks_per_pool=ticks, events_per_hypervisor=events, blocks=blocks)
+    result = {"benchmark":"rpc_scenarios",
+              "time":dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"),
+              "python":platform.python_version(),
+              "config":{**chain.config, "latency":latency, "jitter":jitter, "head":chain.head},
+              "setup_seconds":round(time.perf_counter() - start, 2),
+              "scenarios":list()}
+
+    for name in scenarios or SCENARIOS.keys():
+        row = run_scenario(chain, name=name, latency=latency, jitter=jitter, memory=memory)
+        print(json.dumps(row))
+        result["scenarios"].append(row)
+
+    if output == None:
+        os.makedirs(RESULTS_FOLDER, exist_ok=True)
+        output = os.path.join(RESULTS_FOLDER, "rpc_scenarios_{}.json".format(dt.datetime.now().strftime("%Y%m%d_%H%M%S")))
+    with open(output, "w") as f:
+        json.dump(result, f, indent=1)
+    print(" results saved to {}".format(output))
+
+    if previous != None:
+        with open(previous) as f:
+            compare(result, json.load(f))
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RPC cost of the main read paths on a local simulated chain")
+    parser.add_argument("--fleet", type=int, default=10, help="hypervisors ( one pool each )")
+    parser.add_argument("--ticks", type=int, default=100, help="initialized ticks per pool")
+    parser.add_argument("--events", type=int, default=20, help="Rebalance events per hypervisor")
+    parser.add_argument("--blocks", type=int, default=1000, help="blocks mined besides event transactions")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds added to each request")
+    parser.add_argument("--jitter", type=float, default=0, help="random seconds added to each request latency")
+    parser.add_argument("--scenarios", default=None, help="comma separated: {}".format(",".join(SCENARIOS.keys())))
+    parser.add_argument("--output", default=None, help="results json file ( defaults to benchmarks/results/ )")
+    parser.add_argument("--compare", default=None, help="previous results json file")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc runs")
+    args = parser.parse_args()
+
+    main(fleet=args.fleet, ticks=args.ticks, events=args.events, blocks=args.blocks, latency=args.latency, jitter=args.jitter,
+         scenarios=args.scenarios.split(",") if args.scenarios else None, output=args.output, previous=args.compare, memory=not args.no_memory)
@@ -0,0 +1,464 @@
+import asyncio
+import logging
+import weakref
+
+from web3 import Web3, AsyncHTTPProvider
+from web3.eth import AsyncEth
+
+from bins import file_utilities
+
+import onchain_metrics
+import onchain_analysis_base as base
+from onchain_records import slot0_record, tick_record, position_record, hypervisor_position_record, total_amounts_record
+
+
+# contract objects are only used to encode calls: no provider needed
+_codec_w3 = Web3()
+
+# chain id of each async Web3 object ( asked only once )
+_chain_ids = weakref.WeakKeyDictionary()
+
+# calls being executed by each event loop ( futures can only be awaited from their loop ): loop: {cache key: asyncio.Future}
+_inflight = weakref.WeakKeyDictionary()
+
+
+def create_async_w3(web3Provider_url:str, timeout:int=120)->Web3:
+    """ Web3 object with an async http provider """
+    return Web3(AsyncHTTPProvider(web3Provider_url, request_kwargs={'timeout': timeout}), modules={'eth': (AsyncEth,)}, middlewares=[])
+
+
+# GENERAL
+class web3wrap():
+    """ Asyncio version of onchain_analysis_base.web3wrap
+        Contract reads share the base call cache and metadata store, and identical concurrent reads share one request.
+    """
+
+    _abi_filename = "" # json file name without the extension
+    _abi_path = ""  # like data/abi/gamma
+    _abi = ""
+
+    _address = ""
+    _w3 = None
+    _contract = None
+    _block = 0
+
+    _cache = None # this contract immutable vars like decimals, name... ( loaded lazily from the metadata store )
+    _semaphore = None # limit of concurrent requests
+
+    _abi_functions = None # function name: function abi
+    _compiled = None # function name: compiled_function ( see onchain_analysis_base.compile_functions )
+
+   # SETUP
+    def __init__(self, address:str, web3Provider:Web3=None, web3Provider_url:str="", abi_filename:str="", abi_path:str="",
+                        block:int=0, semaphore:asyncio.Semaphore=None):
+        """
+         Args:
+            address (str):
+            web3Provider (Web3, optional): async Web3 object ( see create_async_w3 ). Defaults to None.
+            web3Provider_url (str, optional): used when no web3Provider. Defaults to "".
+            abi_filename (str, optional): Defaults to "".
+            abi_path (str, optional): Defaults to "".
+            block (int, optional): block to query ( 0 = latest, resolved on first call ). Defaults to 0.
+            semaphore (asyncio.Semaphore, optional): shared limit of concurrent requests. Defaults to None.
+         """
+        # set init vars
+        address = Web3.toChecksumAddress(address)
+        self._address = address
+        self._block = block
+        self._semaphore = semaphore
+        # set optionals
+        self.setup_abi(abi_filename=abi_filename, abi_path=abi_path)
+        # setup Web3
+        self.setup_w3(web3Provider=web3Provider, web3Provider_url=web3Provider_url)
+        # setup contract to encode calls
+        self._contract = _codec_w3.eth.contract(address=address, abi=self._abi)
+
+    def setup_abi(self, abi_filename:str, abi_path:str):
+        # set optionals
+        if abi_filename != "":
+            self._abi_filename = abi_filename
+        if abi_path != "":
+            self._abi_path = abi_path
+        # load abi ( parsed once per process, shared with the sync wrappers )
+        key = (self._abi_path, self._abi_filename)
+        if not key in base._abis:
+            abi = file_utilities.load_json(filename=self._abi_filename, folder_path=self._abi_path)
+            with base._setup_lock:
+                base._abis[key] = (abi, {x["name"]:x for x in abi if x.get("type","") == "function"}, base.compile_functions(abi))
+        self._abi, self._abi_functions, self._compiled = base._abis[key]
+
+    def setup_w3(self, web3Provider, web3Provider_url:str):
+        # create Web3 helper
+        if web3Provider == None and web3Provider_url != "":
+            self._w3 = create_async_w3(web3Provider_url)
+        elif web3Provider != None:
+            self._w3 = web3Provider
+        else:
+            raise ValueError(" Either web3Provider or web3Provider_url var should be defined")
+
+   # CUSTOM PROPERTIES
+    @property
+    def address(self)->str:
+        return self._address
+
+    @property
+    def w3(self)->Web3:
+        return self._w3
+
+    @property
+    def block(self)->int:
+        """ block queried ( 0 until the first call when created with latest ) """
+        return self._block
+    @block.setter
+    def block(self, value:int):
+        self._block = value
+
+    async def chain_id(self)->int:
+        if not self._w3 in _chain_ids:
+            _chain_ids[self._w3] = await self._measure(lambda: self._w3.eth.chain_id, kind="rpc", function="eth_chainId")
+        return _chain_ids[self._w3]
+
+    async def resolve_block(self)->int:
+        """ block queried ( latest block number is asked when not set ) """
+        if self._block == 0:
+            self._block = await self._measure(lambda: self._w3.eth.block_number, kind="rpc", function="eth_blockNumber")
+        return self._block
+
+    async def _measure(self, func, kind:str, function:str, **kwargs):
+        """ Make a chain read recording it in the metrics ( see onchain_metrics.rpc_metrics.measure_async ) """
+        return await onchain_metrics.metrics.measure_async(func, kind=kind, contract=type(self).__name__, function=function, **kwargs)
+
+   # CONTRACT CALLS
+    async def call_function(self, function_name:str, *args):
+        """ Call a contract function at the current block ( see onchain_analysis_base.web3wrap.call_function )
+
+         Args:
+            function_name (str): contract function name
+            *args: function arguments
+
+         Returns:
+            decoded function result ( single value or list when multiple outputs )
+         """
+        block = await self.resolve_block()
+        compiled = self._compiled.get(function_name, None)
+        calldata = compiled.encode(*args) if compiled != None else self._contract.encodeABI(fn_name=function_name, args=list(args))
+        key = (await self.chain_id(), self.address, calldata, block)
+
+        call_cache = base.web3wrap._call_cache
+        inflight = _inflight.setdefault(asyncio.get_running_loop(), dict())
+        if key in call_cache or key in inflight:
+            onchain_metrics.metrics.record(onchain_metrics.rpc_event(kind="call", contract=type(self).__name__, function=function_name, block=block, cache="hit"))
+            if key in call_cache:
+                return call_cache.get(key)
+            return await asyncio.shield(inflight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        inflight[key] = future
+        try:
+            def read():
+                return self._measure(lambda: self._w3.eth.call({"to":self.address, "data":calldata}, block_identifier=block),
+                                        kind="call", function=function_name, block=block, size=len(calldata)//2-1, cache="miss")
+            if self._semaphore != None:
+                async with self._semaphore:
+                    data = await read()
+            else:
+                data = await read()
+            result = compiled.decode(data) if compiled != None else base.decode_function_result(function_abi=self._abi_functions[function_name], data=data)
+        except Exception as e:
+            future.set_exception(e)
+            # retrieved here so it is not reported when nobody else is waiting
+            future.exception()
+            raise
+        else:
+            call_cache.set(key, result)
+            future.set_result(result)
+            return result
+        finally:
+            del inflight[key]
+
+    async def call_immutable(self, function_name:str):
+        """ Call a no arguments contract function whose result never changes once deployed
+            ( see onchain_analysis_base.web3wrap.call_immutable )
+         """
+        chain_id = await self.chain_id()
+        if self._cache == None:
+            self._cache = base.web3wrap._metadata_store.load(chain_id=chain_id, address=self.address)
+        if not function_name in self._cache:
+            self._cache[function_name] = await self.call_function(function_name)
+            base.web3wrap._metadata_store.save(chain_id=chain_id, address=self.address, field=function_name, value=self._cache[function_name])
+        return self._cache[function_name]
+
+    async def _scaled(self, function_name:str, *args)->float:
+        """ decimal adjusted function result """
+        result, decimals = await asyncio.gather(self.call_function(function_name, *args), self.call_immutable("decimals"))
+        return result/(10**decimals)
+
+    def _create(self, cls, address:str):
+        """ create a related contract object sharing provider, block and request limit """
+        return cls(address=address, web3Provider=self._w3, block=self._block, semaphore=self._semaphore)
+
+    async def _get_token(self, index:int):
+        """ token0 or token1 erc20 object of pools and hypervisors """
+        if getattr(self, "_token{}".format(index)) == None:
+            setattr(self, "_token{}".format(index), self._create(erc20, await self.call_immutable("token{}".format(index))))
+        return getattr(self, "_token{}".format(index))
+
+
+class erc20(web3wrap):
+    _abi_filename = "erc20"
+    _abi_path = "data/abi"
+
+   # PROPERTIES
+    @property
+    def decimals(self)->int:
+        return self.call_immutable("decimals")
+
+    def balanceOf(self, address:str)->float:
+        return self._scaled("balanceOf", Web3.toChecksumAddress(address))
+
+    @property
+    def totalSupply(self)->float:
+        return self._scaled("totalSupply")
+
+    @property
+    def symbol(self)->str:
+        return self.call_immutable("symbol")
+
+
+# EXCHANGES
+class univ3_pool(erc20):
+    _abi_filename = "univ3_pool"
+    _abi_path = "data/abi/uniswap/v3"
+
+    _token0:erc20 = None
+    _token1:erc20 = None
+
+    @property
+    def fee(self)->int:
+        return self.call_immutable("fee")
+
+    @property
+    def feeGrowthGlobal0X128(self)->int:
+        return self.call_function("feeGrowthGlobal0X128")
+
+    @property
+    def feeGrowthGlobal1X128(self)->int:
+        return self.call_function("feeGrowthGlobal1X128")
+
+    @property
+    def liquidity(self)->int:
+        return self.call_function("liquidity")
+
+    def observe(self, secondsAgo:list):
+        return self.call_function("observe", secondsAgo)
+
+    async def positions(self, position_key:str)->position_record:
+        return position_record(*await self.call_function("positions", position_key))
+
+    @property
+    def slot0(self)->dict:
+        return self._slot0()
+
+    async def _slot0(self)->slot0_record:
+        return slot0_record(*await self.call_function("slot0"))
+
+    @property
+    def tickSpacing(self)->int:
+        return self.call_immutable("tickSpacing")
+
+    async def ticks(self, tick:int)->tick_record:
+        return tick_record(*await self.call_function("ticks", tick))
+
+    @property
+    def token0(self)->erc20:
+        return self._get_token(0)
+
+    @property
+    def token1(self)->erc20:
+        return self._get_token(1)
+
+   # CUSTOM PROPERTIES
+    @property
+    def block(self)->int:
+        return self._block
+    @block.setter
+    def block(self, value:int):
+        self._block = value
+        if self._token0 != None:
+            self._token0.block = value
+        if self._token1 != None:
+            self._token1.block = value
+
+   # CUSTOM FUNCTIONS
+    def position(self, ownerAddress:str, tickLower:int, tickUpper:int)->dict:
+        return self.positions(base.univ3_pool.get_positionKey(ownerAddress=ownerAddress, tickLower=tickLower, tickUpper=tickUpper))
+
+    async def get_tvlPriceFees(self, ownerAddress:str, tickUpper:int, tickLower:int)->dict:
+        """ Calculate current TVL, price and uncollected fees, including owed, for each token in the pool
+            ( see onchain_analysis_base.univ3_pool.get_tvlPriceFees )
+         """
+        await self.resolve_block()
+        token0, token1 = await asyncio.gather(self.token0, self.token1)
+        pos, slot0, ticks_lower, ticks_upper, feeGrowthGlobal0X128, feeGrowthGlobal1X128, decimals_token0, decimals_token1 = await asyncio.gather(
+                self.position(ownerAddress=Web3.toChecksumAddress(ownerAddress.lower()), tickLower=tickLower, tickUpper=tickUpper),
+                self.slot0, self.ticks(tickLower), self.ticks(tickUpper),
+                self.feeGrowthGlobal0X128, self.feeGrowthGlobal1X128,
+                token0.decimals, token1.decimals)
+
+        return base.calculate_tvlPriceFees(position=pos, tick=slot0["tick"], tickUpper=tickUpper, tickLower=tickLower,
+                                           ticks_lower=ticks_lower, ticks_upper=ticks_upper,
+                                           feeGrowthGlobal0X128=feeGrowthGlobal0X128, feeGrowthGlobal1X128=feeGrowthGlobal1X128,
+                                           decimals_token0=decimals_token0, decimals_token1=decimals_token1)
+
+
+# PROTOCOLS
+class gamma_hypervisor(erc20):
+    _abi_filename = "hypervisor"
+    _abi_path = "data/abi/gamma"
+
+    _pool:univ3_pool = None
+
+    _token0:erc20 = None
+    _token1:erc20 = None
+
+   # GRAL
+    @property
+    def baseLower(self)->int:
+        return self.call_function("baseLower")
+
+    @property
+    def baseUpper(self)->int:
+        return self.call_function("baseUpper")
+
+    @property
+    def currentTick(self)->int:
+        return self.call_function("currentTick")
+
+    @property
+    def fee(self)->int:
+        return self.call_function("fee")
+
+    @property
+    def getBasePosition(self)->dict:
+        return self._get_position("getBasePosition")
+
+    @property
+    def getLimitPosition(self)->dict:
+        return self._get_position("getLimitPosition")
+
+    @property
+    def getTotalAmounts(self)->dict:
+        return self._getTotalAmounts()
+
+    @property
+    def limitLower(self)->int:
+        return self.call_function("limitLower")
+
+    @property
+    def limitUpper(self)->int:
+        return self.call_function("limitUpper")
+
+    @property
+    def name(self)->str:
+        return self.call_immutable("name")
+
+    @property
+    def pool(self)->univ3_pool:
+        return self._get_pool()
+
+    @property
+    def tickSpacing(self)->int:
+        return self.call_immutable("tickSpacing")
+
+    @property
+    def token0(self)->erc20:
+        return self._get_token(0)
+
+    @property
+    def token1(self)->erc20:
+        return self._get_token(1)
+
+    async def _get_pool(self)->univ3_pool:
+        if self._pool == None:
+            self._pool = self._create(univ3_pool, await self.call_immutable("pool"))
+        return self._pool
+
+    async def _get_position(self, function_name:str)->hypervisor_position_record:
+        tmp, token0, token1 = await asyncio.gather(self.call_function(function_name), self.token0, self.token1)
+        decimals_token0, decimals_token1 = await asyncio.gather(token0.decimals, token1.decimals)
+        return hypervisor_position_record(liquidity=tmp[0],
+                                          amount0=tmp[1]/(10**decimals_token0),
+                                          amount1=tmp[2]/(10**decimals_token1),
+                                        )
+
+    async def _getTotalAmounts(self)->total_amounts_record:
+        tmp, token0, token1 = await asyncio.gather(self.call_function("getTotalAmounts"), self.token0, self.token1)
+        decimals_token0, decimals_token1 = await asyncio.gather(token0.decimals, token1.decimals)
+        return total_amounts_record(total0=tmp[0]/(10**decimals_token0),
+                                    total1=tmp[1]/(10**decimals_token1),
+                                    )
+
+   # CUSTOM PROPERTIES
+    @property
+    def block(self):
+        return self._block
+
+    @block.setter
+    def block(self, value):
+        self._block = value
+        for item in [self._pool, self._token0, self._token1]:
+            if item != None:
+                item.block = value
+
+   # CUSTOM FUNCTIONS
+    async def tvl_price_fee(self)->dict:
+        """ Return Value locked, prices, uncollected and owed fees
+            ( see onchain_analysis_base.gamma_hypervisor.tvl_price_fee )
+         """
+        # all related objects query the same block
+        self.block = await self.resolve_block()
+
+        pool, baseLower, baseUpper, limitLower, limitUpper = await asyncio.gather(self.pool, self.baseLower, self.baseUpper, self.limitLower, self.limitUpper)
+        token0, token1 = await asyncio.gather(pool.token0, pool.token1)
+
+        # UNISWAP positions and CONTRACT parked tokens (tvl)
+        result, limit, qttyParked_token0, qttyParked_token1 = await asyncio.gather(
+                pool.get_tvlPriceFees(ownerAddress=self.address, tickUpper=baseUpper, tickLower=baseLower),
+                pool.get_tvlPriceFees(ownerAddress=self.address, tickUpper=limitUpper, tickLower=limitLower),
+                token0.balanceOf(self.address),
+                token1.balanceOf(self.address))
+
+        # sumup position keys
+        result = base.sum_tvlPriceFees(base=result, limit=limit)
+        return result.replace(qtty_token0=result.qtty_token0 + qttyParked_token0, qtty_token1=result.qtty_token1 + qttyParked_token1)
+
+
+# FAN OUT
+async def get_hypervisors_tvl_price_fee(addresses:list, web3Provider:Web3=None, web3Provider_url:str="", block:int=0, max_concurrency:int=20)->dict:
+    """ tvl_price_fee of many hypervisors at the same block, concurrently
+
+     Args:
+        addresses (list): hypervisor addresses
+        web3Provider (Web3, optional): async Web3 object ( see create_async_w3 ). Defaults to None.
+        web3Provider_url (str, optional): used when no web3Provider. Defaults to "".
+        block (int, optional): Defaults to latest.
+        max_concurrency (int, optional): maximum requests sent at the same time. Defaults to 20.
+
+     Returns:
+        dict: { hypervisor address: tvl_price_fee result or None when failed }
+     """
+    w3 = web3Provider if web3Provider != None else create_async_w3(web3Provider_url)
+    if block == 0:
+        block = await w3.eth.block_number
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    hypervisors = [gamma_hypervisor(address=x, web3Provider=w3, block=block, semaphore=semaphore) for x in addresses]
+    results = await asyncio.gather(*[x.tvl_price_fee() for x in hypervisors], return_exceptions=True)
+
+    result = dict()
+    for hypervisor, item in zip(hypervisors, results):
+        if isinstance(item, Exception):
+            logging.getLogger(__name__).error(" Could not get {} tvl_price_fee at block {} -> {}".format(hypervisor.address, block, item))
+            item = None
+        result[hypervisor.address] = item
+    return result
@@ -1,16 +1,238 @@
 from web3 import Web3
 import logging
+import requests
 
+import os
 import math
+import time
+import json
+import copy
+import weakref
+import contextlib
+import threading
+import concurrent.futures
+from collections import deque
 import datetime as dt
 from eth_abi import abi
+from eth_abi.registry import registry as abi_registry
+from eth_abi.encoding import TupleEncoder
+from eth_abi.decoding import TupleDecoder, ContextFramesBytesIO
+from eth_abi.exceptions import DecodingError
 from hexbytes import HexBytes
+from eth_utils import event_abi_to_log_topic, function_abi_to_4byte_selector
+from web3.datastructures import AttributeDict
+from web3.exceptions import BadFunctionCallOutput
 
 from bins import file_utilities
+from onchain_cache import call_cache, metadata_store, block_index, event_store
+import onchain_rpc
+import onchain_metrics
+from onchain_records import slot0_record, tick_record, position_record, tvl_record, hypervisor_position_record, total_amounts_record, snapshot_record, record_table
 
 
 _x96 = 2**96
 _x128 = math.pow(2, 128)
+_q128 = 2**128
+_q256 = 2**256
+
+# Multicall3 is deployed at the same address on most chains ( https://github.com/mds1/multicall )
+MULTICALL3_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+
+
+def _abi_types(params:list)->list:
+    """ eth_abi type strings of abi inputs/outputs definition (tuples included)"""
+    result = list()
+    for param in params:
+        if param["type"].startswith("tuple"):
+            result.append("({}){}".format(",".join(_abi_types(param["components"])), param["type"][len("tuple"):]))
+        else:
+            result.append(param["type"])
+    return result
+
+
+def decode_function_result(function_abi:dict, data:bytes):
+    """ Decode the raw return data of a contract function the same way web3 .call() does
+
+     Args:
+        function_abi (dict): function abi definition
+        data (bytes): raw returned data
+
+     Returns:
+        decoded function result ( single value or list when multiple outputs )
+     """
+    output_types = _abi_types(function_abi["outputs"])
+    result = [Web3.toChecksumAddress(value) if output_type == "address" else value
+                    for output_type, value in zip(output_types, abi.decode_abi(output_types, HexBytes(data)))]
+    return result[0] if len(result) == 1 else result
+
+
+class compiled_function():
+    """ Contract function encoder and decoder built once from its ABI: 4 byte selector and eth_abi tuple encoder/decoder
+        precomputed, so encoding a call or decoding its result skips web3's contract function objects
+        ( arguments validation and normalization, ABI lookups on each call ).
+        Results are the same as web3 .call() ones ( see decode_function_result ).
+    """
+    __slots__ = ("name", "selector", "input_types", "output_types", "_encoder", "_decoder", "_bytes_inputs", "_address_outputs")
+
+    def __init__(self, function_abi:dict):
+        self.name = function_abi["name"]
+        self.selector = function_abi_to_4byte_selector(function_abi)
+        self.input_types = _abi_types(function_abi.get("inputs", []))
+        self.output_types = _abi_types(function_abi.get("outputs", []))
+        self._encoder = TupleEncoder(encoders=[abi_registry.get_encoder(x) for x in self.input_types])
+        self._decoder = TupleDecoder(decoders=[abi_registry.get_decoder(x) for x in self.output_types])
+        # hex string arguments web3 converts to bytes ( bytes32 position keys... )
+        self._bytes_inputs = [i for i, x in enumerate(self.input_types) if x.startswith("bytes") and not "[" in x]
+        self._address_outputs = [i for i, x in enumerate(self.output_types) if x == "address"]
+
+    def encode(self, *args)->str:
+        """ Call data ( selector + encoded arguments )
+
+         Returns:
+            str: 0x... ( same as web3 encodeABI )
+         """
+        if len(self._bytes_inputs) > 0:
+            args = list(args)
+            for i in self._bytes_inputs:
+                if isinstance(args[i], str):
+                    args[i] = HexBytes(args[i])
+        return "0x" + (self.selector + self._encoder(args)).hex()
+
+    def decode(self, data):
+        """ Decode the raw return data
+
+         Args:
+            data (bytes or str): raw returned data
+
+         Returns:
+            decoded function result ( single value or list when multiple outputs )
+         """
+        values = self._decoder(ContextFramesBytesIO(bytes(HexBytes(data))))
+        if len(self._address_outputs) > 0:
+            values = list(values)
+            for i in self._address_outputs:
+                values[i] = Web3.toChecksumAddress(values[i])
+        return values[0] if len(values) == 1 else list(values)
+
+
+def compile_functions(abi:list)->dict:
+    """ compiled_function of each contract function not overloaded ( overloaded ones are left to web3 )
+
+     Returns:
+        dict: function name: compiled_function
+     """
+    names = [x["name"] for x in abi if x.get("type", "") == "function"]
+    return {x["name"]:compiled_function(x) for x in abi if x.get("type", "") == "function" and names.count(x["name"]) == 1}
+
+
+def _as_record(record_type, value):
+    """ record_type of a decoded contract result ( derived batch_result when read inside a batch block ) """
+    if isinstance(value, batch_result):
+        return value._derive(lambda x, y: record_type(*x))
+    return record_type(*value)
+
+
+# node answers refusing an eth_getLogs range for its size ( Infura, Alchemy, QuickNode, Ankr, public nodes... )
+_LOG_RANGE_ERRORS = ["query returned more than", "block range", "too many results", "response size", "max results", "query timeout"]
+# throttling or connection answers: retried by the caller, splitting the range would only send more requests
+_THROTTLE_ERRORS = ["rate limit", "too many requests", "429", "connection"]
+
+def _is_log_range_error(error:Exception)->bool:
+    """ Is the error a node refusing an eth_getLogs block range ( too many results, range too large, query timeout ) """
+    if isinstance(error, (ConnectionError, requests.exceptions.ConnectionError)):
+        return False
+    message = str(error).lower()
+    if any(x in message for x in _THROTTLE_ERRORS):
+        return False
+    if isinstance(error, (TimeoutError, requests.exceptions.ReadTimeout)):
+        return True
+    return any(x in message for x in _LOG_RANGE_ERRORS)
+
+
+def _log_to_row(log)->dict:
+    """ event log to event_store row """
+    return {"address":log["address"],
+            "topic0":Web3.toHex(log["topics"][0]),
+            "block":log["blockNumber"],
+            "log_index":log["logIndex"],
+            "transaction_index":log["transactionIndex"],
+            "transaction_hash":Web3.toHex(log["transactionHash"]),
+            "block_hash":Web3.toHex(log["blockHash"]),
+            "topics":json.dumps([Web3.toHex(x) for x in log["topics"]]),
+            "data":Web3.toHex(HexBytes(log["data"])),
+            }
+
+def _log_from_row(row:dict)->AttributeDict:
+    """ event_store row to event log ( as returned by web3 ) """
+    return AttributeDict({"address":Web3.toChecksumAddress(row["address"]),
+                          "topics":[HexBytes(x) for x in json.loads(row["topics"])],
+                          "data":row["data"],
+                          "blockNumber":row["block"],
+                          "transactionHash":HexBytes(row["transaction_hash"]),
+                          "transactionIndex":row["transaction_index"],
+                          "blockHash":HexBytes(row["block_hash"]),
+                          "logIndex":row["log_index"],
+                          "removed":False,
+                          })
+
+def _log_matches_topics(log, topics:list)->bool:
+    """ Does the event log match filter topics ( None, value or list of values per position ) """
+    for i, expected in enumerate(topics):
+        if expected == None:
+            continue
+        expected = expected if isinstance(expected, list) else [expected]
+        if len(log["topics"]) <= i or not HexBytes(log["topics"][i]) in [HexBytes(x) for x in expected]:
+            return False
+    return True
+
+
+# chain id of each Web3 object ( asked only once )
+_chain_ids = weakref.WeakKeyDictionary()
+
+# rpc_batch collecting this thread's contract reads ( see web3wrap.batch )
+_batches = threading.local()
+
+# parsed ABIs: (abi path, abi filename): (abi, {function name: function abi}, {function name: compiled_function})
+_abis = dict()
+# contract classes of each Web3 object: Web3: {(abi path, abi filename): contract class}
+_contract_factories = weakref.WeakKeyDictionary()
+# objects shared by address and block ( see web3wrap.shared ): (Web3 id, class, address, block): object
+_shared = weakref.WeakValueDictionary()
+_setup_lock = threading.RLock()
+
+# last block of each Web3 object: Web3: (block, time asked) ( see latest_block )
+_latest_blocks = weakref.WeakKeyDictionary()
+LATEST_BLOCK_MAX_AGE = 2
+
+
+def latest_block(w3:Web3, max_age:float=None)->int:
+    """ Chain last block, asked at most once every max_age seconds per Web3 object
+        so that objects created in the same cycle share one "latest" request ( see new_cycle )
+
+     Args:
+        w3 (Web3):
+        max_age (float, optional): seconds. Defaults to LATEST_BLOCK_MAX_AGE.
+
+     Returns:
+        int: block number
+     """
+    max_age = LATEST_BLOCK_MAX_AGE if max_age == None else max_age
+    with _setup_lock:
+        block, asked = _latest_blocks.get(w3, (None, 0))
+    if block == None or time.monotonic() - asked > max_age:
+        block = onchain_metrics.metrics.measure(lambda: w3.eth.block_number, kind="rpc", contract=None, function="eth_blockNumber")
+        with _setup_lock:
+            _latest_blocks[w3] = (block, time.monotonic())
+    return block
+
+
+def new_cycle(w3:Web3=None):
+    """ Forget the last block of w3 ( or all ): objects created from now on ask for it again """
+    with _setup_lock:
+        if w3 == None:
+            _latest_blocks.clear()
+        else:
+            _latest_blocks.pop(w3, None)
 
 
 # GENERAL
@@ -25,9 +247,24 @@ class web3wrap():
     _contract = None
     _block = 0
 
-    _cache = dict() # cached vars like decimals, name...
+    _cache = None # this contract immutable vars like decimals, name... ( loaded lazily from the metadata store )
     _progress_callback = None
 
+    _abi_functions = None # function name: function abi
+    _compiled = None # function name: compiled_function ( see compile_functions )
+    # process wide cache of contract call results: (chainId, address, calldata, block): decoded result
+    _call_cache = call_cache()
+    # process wide persistent store of immutable contract vars: (chainId, address, function name): value
+    _metadata_store = metadata_store()
+    # process wide persistent index of known (block, timestamp) pairs
+    _block_index = block_index()
+    # process wide persistent store of event logs: off by default, always getting logs from the node ( see use_event_store )
+    _event_store = None
+    # process wide record of chain reads: counts, latencies, call budgets ( see onchain_metrics )
+    _metrics = onchain_metrics.metrics
+    # provider classes getting compiled eth_call requests without web3 middlewares ( see call_raw )
+    _raw_call_providers = (onchain_rpc.rpc_router,)
+
    # SETUP
     def __init__(self, address:str, web3Provider:Web3=None, web3Provider_url:str="", abi_filename:str="", abi_path:str="",
                         block:int=0):
@@ -41,30 +278,86 @@ class web3wrap():
         # setup contract to query
         self.setup_contract(address=address, abi=self._abi)
 
-        # set block
-        self._block = self._w3.eth.get_block("latest").number if block == 0 else block
-    
+        # set block ( 0: chain last block, resolved when first needed )
+        self._block = block
+
+    @classmethod
+    def shared(cls, address:str, web3Provider:Web3, block:int=0)->"web3wrap":
+        """ Object of this class for address at block, created once and shared process wide ( tokens and pools of many hypervisors... ).
+            Shared objects should not have their block changed: use at_block
+
+         Args:
+            address (str):
+            web3Provider (Web3):
+            block (int, optional): Defaults to the chain last block ( see latest_block ).
+
+         Returns:
+            web3wrap: same class
+         """
+        block = latest_block(web3Provider) if block == 0 else block
+        key = (id(web3Provider), cls, address.lower(), block)
+        with _setup_lock:
+            result = _shared.get(key, None)
+            if result == None or result._block != block:
+                result = cls(address=address, web3Provider=web3Provider, block=block)
+                _shared[key] = result
+        return result
+
+    @classmethod
+    def use_event_store(cls, filename:str=None)->event_store:
+        """ Keep the event logs read by get_chunked_events in a persistent sqlite store, process wide.
+            Call with no filename to disable it again ( logs always read from the node ).
+
+         Args:
+            filename (str, optional): sqlite database file ( i.e. onchain_cache.SQLITE_FILENAME ). Defaults to None: disabled.
+
+         Returns:
+            event_store: the store in use or None
+         """
+        if web3wrap._event_store != None:
+            web3wrap._event_store.close()
+        web3wrap._event_store = event_store(filename=filename) if filename != None else None
+        return web3wrap._event_store
+
+    @classmethod
+    def flush_stores(cls):
+        """ Write the rows buffered by the persistent stores to disk ( they are also written at exit ) """
+        for store in (web3wrap._metadata_store, web3wrap._block_index, web3wrap._event_store):
+            if store != None:
+                store.flush()
+
     def setup_abi(self, abi_filename:str, abi_path:str):
         # set optionals
         if abi_filename != "":
             self._abi_filename = abi_filename
         if abi_path != "":
             self._abi_path = abi_path
-        # load abi
-        self._abi = file_utilities.load_json(filename=self._abi_filename, folder_path=self._abi_path)
-
-    def setup_w3(self, web3Provider, web3Provider_url:str):
-        # create Web3 helper
-        if web3Provider == None and web3Provider_url != "":
-            self._w3 =  Web3(Web3.HTTPProvider(web3Provider_url,request_kwargs={'timeout': 120}))  #request_kwargs={'timeout': 60}))
+        # load abi ( parsed once per process )
+        key = (self._abi_path, self._abi_filename)
+        if not key in _abis:
+            abi = file_utilities.load_json(filename=self._abi_filename, folder_path=self._abi_path)
+            with _setup_lock:
+                _abis[key] = (abi, {x["name"]:x for x in abi if x.get("type","") == "function"}, compile_functions(abi))
+        self._abi, self._abi_functions, self._compiled = _abis[key]
+
+    def setup_w3(self, web3Provider, web3Provider_url):
+        # create Web3 helper ( web3Provider_url can be a list of endpoints of the same chain )
+        if web3Provider == None and web3Provider_url not in ("", None, []):
+            self._w3 =  Web3(onchain_rpc.get_router(web3Provider_url))
         elif web3Provider != None:
             self._w3 = web3Provider
         else:
             raise ValueError(" Either web3Provider or web3Provider_url var should be defined")
 
     def setup_contract(self, address:str, abi:str):
-        # set contract
-        self._contract = self._w3.eth.contract(address=address, abi=abi)
+        # set contract ( contract classes are created once per Web3 object and ABI )
+        key = (self._abi_path, self._abi_filename)
+        with _setup_lock:
+            factories = _contract_factories.setdefault(self._w3, dict())
+            if not key in factories or factories[key].abi is not abi:
+                factories[key] = self._w3.eth.contract(abi=abi)
+            factory = factories[key]
+        self._contract = factory(address=address)
 
    # CUSTOM PROPERTIES
     @property
@@ -88,10 +381,16 @@ class web3wrap():
     # def contract(self, value:str):
     #     self._contract = value
 
+    @property
+    def chain_id(self)->int:
+        if not self._w3 in _chain_ids:
+            _chain_ids[self._w3] = self._measure(lambda: self._w3.eth.chain_id, kind="rpc", function="eth_chainId")
+        return _chain_ids[self._w3]
+
     @property
     def block(self)->int:
         """ """
-        return self._block
+        return self._resolve_block()
     @block.setter
     def block(self, value:int):
         self._block = value
@@ -99,6 +398,173 @@ class web3wrap():
     # def block(self):
     #     del self._block
 
+    def _resolve_block(self)->int:
+        if self._block == 0:
+            self._block = latest_block(self._w3)
+        return self._block
+
+    def at_block(self, block:int)->"web3wrap":
+        """ Copy of this object at another block, sharing its provider, contract and immutable vars ( no setup needed )
+
+         Args:
+            block (int):
+
+         Returns:
+            web3wrap: same class as this object
+         """
+        result = copy.copy(self)
+        result._block = block
+        return result
+
+   # CONTRACT CALLS
+    def call_function(self, function_name:str, *args):
+        """ Call a contract function at the current block.
+            All contract reads go through here: results are cached by (chain, address, calldata, block)
+            and concurrent identical calls share one RPC request.
+
+         Args:
+            function_name (str): contract function name
+            *args: function arguments
+
+         Returns:
+            decoded function result ( single value or list when multiple outputs )
+         """
+        block = self.block
+        key = self.call_key(function_name, *args, block=block)
+        batch = getattr(_batches, "active", None)
+        if batch != None and not key in self._call_cache:
+            return batch.add(key=key, wrapper=self, function_name=function_name, args=args)
+        sent = False
+        def read():
+            nonlocal sent
+            sent = True
+            return self._measure(lambda: self.call_raw(function_name, key[2], block, *args),
+                                    kind="call", function=function_name, block=block, size=len(key[2])//2-1, cache="miss")
+        result = self._call_cache.get_or_call(key=key, func=read)
+        if not sent:
+            self._metrics.record(onchain_metrics.rpc_event(kind="call", contract=type(self).__name__, function=function_name, block=block, cache="hit"))
+        return result
+
+    def call_raw(self, function_name:str, calldata:str, block:int, *args):
+        """ Send an eth_call and decode its result with the compiled decoder.
+            Providers of _raw_call_providers ( this repo's rpc_router ) get the request straight, skipping web3 middlewares
+            ( and the chain id request they make on each call ), any other provider gets it through web3 and its middlewares.
+            Overloaded functions go through web3.
+
+         Args:
+            function_name (str): contract function name
+            calldata (str): 0x... ( see encode_function )
+            block (int):
+            *args: function arguments ( only used by functions not compiled )
+
+         Returns:
+            decoded function result
+         """
+        if not function_name in self._compiled:
+            return self._contract.functions[function_name](*args).call(block_identifier=block)
+        if isinstance(self._w3.provider, self._raw_call_providers):
+            response = self._w3.provider.make_request("eth_call", [{"to":self._address, "data":calldata}, hex(block)])
+            if "error" in response:
+                raise ValueError(response["error"])
+            result = response["result"]
+        else:
+            result = self._w3.eth.call({"to":self._address, "data":calldata}, block_identifier=block)
+        if result in ("0x", "", b"", None) and len(self._compiled[function_name].output_types) > 0:
+            raise BadFunctionCallOutput(" Could not call contract function {} of {} at block {}: no data returned ( is contract deployed? )".format(function_name, self._address, block))
+        return self._compiled[function_name].decode(result)
+
+    def _measure(self, func, kind:str, function:str, **kwargs):
+        """ Make a chain read recording it in the metrics ( see onchain_metrics.rpc_metrics.measure ) """
+        return self._metrics.measure(func, kind=kind, contract=type(self).__name__, function=function, **kwargs)
+
+    def call_key(self, function_name:str, *args, block:int=None)->tuple:
+        """ Cache key of a contract call
+
+         Returns:
+            tuple: (chainId, address, calldata, block)
+         """
+        return (self.chain_id, self.address, self.encode_function(function_name, *args), self.block if block == None else block)
+
+    def encode_function(self, function_name:str, *args)->str:
+        """ Contract function call data ( selector + encoded arguments )
+
+         Returns:
+            str: 0x...
+         """
+        if function_name in self._compiled:
+            return self._compiled[function_name].encode(*args)
+        return self._contract.encodeABI(fn_name=function_name, args=list(args))
+
+    def decode_function(self, function_name:str, data:bytes):
+        """ Decode the raw return data of a contract function the same way web3 .call() does
+
+         Args:
+            function_name (str): contract function name
+            data (bytes): raw returned data
+
+         Returns:
+            decoded function result ( single value or list when multiple outputs )
+         """
+        if function_name in self._compiled:
+            return self._compiled[function_name].decode(data)
+        return decode_function_result(function_abi=self._abi_functions[function_name], data=data)
+
+    def prefetch(self, function_name:str, args:tuple, result, block:int=None):
+        """ Set a function result in the call cache so that calls with the same arguments at the same block are not sent to the chain
+
+         Args:
+            function_name (str): contract function name
+            args (tuple): function arguments
+            result: decoded function result
+            block (int, optional): Defaults to current block.
+         """
+        self._call_cache.set(self.call_key(function_name, *args, block=block), result)
+
+    def call_immutable(self, function_name:str):
+        """ Call a no arguments contract function whose result never changes once deployed ( decimals, symbol, token0... )
+            Results are kept by this object and persisted to the metadata store, so they are asked to the chain only once.
+
+         Args:
+            function_name (str): contract function name
+
+         Returns:
+            decoded function result
+         """
+        if not self.has_immutable(function_name):
+            value = self.call_function(function_name)
+            if isinstance(value, batch_result):
+                # needed right away ( addresses, decimals... ): send what the batch collected so far
+                value = value.result()
+            self._cache[function_name] = value
+            self._metadata_store.save(chain_id=self.chain_id, address=self.address, field=function_name, value=self._cache[function_name])
+        return self._cache[function_name]
+
+    def has_immutable(self, function_name:str)->bool:
+        """ Is the immutable var already known ( no need to call the chain ) """
+        if self._cache == None:
+            self._cache = self._metadata_store.load(chain_id=self.chain_id, address=self.address)
+        return function_name in self._cache
+
+    def batch(self, max_calls:int=100)->"rpc_batch":
+        """ Context collecting the contract reads made through any wrapper and sending them as JSON-RPC batch requests on exit.
+            Inside the block reads return batch_result objects ( use .result() after the block ), and the results are left in the call cache.
+            For nodes where Multicall3 is missing or its gas cap is too low.
+            Reads depending on other reads' results ( like positions keys from hypervisor ticks ) need a second block.
+
+            with hv.batch():
+                slot0 = hv.pool.slot0
+                balance = hv.token0.balanceOf(hv.address)
+            slot0["tick"].result()
+
+         Args:
+            max_calls (int, optional): maximum calls per batch request. Defaults to 100.
+
+         Returns:
+            rpc_batch:
+         """
+        active = getattr(_batches, "active", None)
+        return active if active != None else rpc_batch(max_calls=max_calls)
+
    # HELPERS
     def average_blockTime(self, blocksaway=500)->dt.datetime.timestamp:
         """ Average time of block creation
@@ -111,87 +577,134 @@ class web3wrap():
         """        
         result = 0
         if blocksaway >0:
-            block_curr = self._w3.eth.get_block('latest')
-            block_past = self._w3.eth.get_block(block_curr.number-blocksaway)
+            block_curr = self._get_block('latest')
+            block_past = self._get_block(block_curr.number-blocksaway)
             result = (block_curr.timestamp-block_past.timestamp)/blocksaway
         return result
 
     def blockNumberFromTimestamp(self, timestamp:dt.datetime.timestamp)->int:
-        """ Will 
-            At least 15 queries are needed to come close to a timestamp block number
-            
+        """ Highest block number with a timestamp lower or equal to the timestamp
+            ( see blockNumbersFromTimestamps )
+
          Args:
-            timestamp (dt.datetime.timestamp): _description_
+            timestamp (dt.datetime.timestamp):
 
          Returns:
-            int: blocknumber 
-        """        
-        
-        if int(timestamp) == 0:
+            int: blocknumber
+        """
+        return self.blockNumbersFromTimestamps(timestamps=[timestamp])[0]
+
+    def blockNumbersFromTimestamps(self, timestamps:list)->list:
+        """ Highest block number with a timestamp lower or equal to each timestamp.
+            Searches interpolate and bisect between the closest blocks already known ( persisted block index ),
+            so timestamps resolved before cost no queries and every probe made helps the next timestamps.
+
+         Args:
+            timestamps (list): of dt.datetime.timestamp
+
+         Returns:
+            list: block numbers in the same order
+         """
+        if any(int(x) == 0 for x in timestamps):
             raise ValueError("Timestamp cannot be zero!")
 
-        queries_cost = 0
+        chain_id = self.chain_id
+        head = None
+        result = dict()
+        # sorted so that probes of each search narrow the next
+        for timestamp in sorted(set(int(x) for x in timestamps)):
+
+            lower, upper = self._block_index.anchors(chain_id=chain_id, timestamp=timestamp)
+            if upper == None:
+                # beyond known blocks: get chain head ( once )
+                if head == None:
+                    head = self._index_block("latest")
+                if head[1] <= timestamp:
+                    result[timestamp] = head[0]
+                    continue
+                lower, upper = self._block_index.anchors(chain_id=chain_id, timestamp=timestamp)
+            if lower == None:
+                genesis = self._index_block(0)
+                if genesis[1] > timestamp:
+                    raise ValueError("Timestamp {} is older than the first block of the chain".format(timestamp))
+                lower, upper = self._block_index.anchors(chain_id=chain_id, timestamp=timestamp)
+
+            queries_cost = 0
+            bisect_next = False
+            while upper[0] - lower[0] > 1:
+                if bisect_next:
+                    block = (lower[0] + upper[0])//2
+                else:
+                    # interpolate block with the known timestamps
+                    block = lower[0] + ((timestamp - lower[1]) * (upper[0] - lower[0]))//(upper[1] - lower[1])
+                block = min(max(block, lower[0]+1), upper[0]-1)
+
+                blocks_range = upper[0] - lower[0]
+                probe = self._index_block(block)
+                queries_cost += 1
+                if probe[1] <= timestamp:
+                    lower = probe
+                else:
+                    upper = probe
+                # bisect when interpolation did not halve the range ( uneven block times )
+                bisect_next = not bisect_next and (upper[0] - lower[0]) > blocks_range/2
 
-        block_curr = self._w3.eth.get_block('latest')
-        first_step = math.ceil(block_curr.number*0.85)
+            logging.getLogger(__name__).debug(" Took {} queries to the chain to find block number {} of timestamp {}".format(queries_cost, lower[0], timestamp))
+            result[timestamp] = lower[0]
 
-        # make sure we have positive block result
-        while (block_curr.number+first_step) <= 0:
-            first_step -= 1
-        # calc blocks to go up/down closer to goal
-        block_past = self._w3.eth.get_block(block_curr.number-(first_step))
-        blocks_x_timestamp = abs(block_curr.timestamp-block_past.timestamp)/first_step
-        
-        block_step = (block_curr.timestamp-timestamp)/ blocks_x_timestamp
-        block_step_sign = -1
+        return [result[int(x)] for x in timestamps]
 
-        _startime = dt.datetime.utcnow()
+    def timestampFromBlockNumber(self, block:int)->int:
+        """ Block timestamp ( from the block index when known )
 
-        while block_curr.timestamp != timestamp:
-            
-            queries_cost+=1
+         Args:
+            block (int): block number
+
+         Returns:
+            int: timestamp
+         """
+        timestamp = self._block_index.timestamp(chain_id=self.chain_id, block=block)
+        if timestamp == None:
+            timestamp = self._index_block(block)[1]
+        return timestamp
+
+    def timestampsFromBlockNumbers(self, blocks:list, max_calls:int=100)->list:
+        """ Timestamps of many blocks: blocks not in the block index are asked in JSON-RPC batch requests
 
-            # make sure we have positive block result
-            while (block_curr.number+(block_step*block_step_sign)) <= 0:
-                if queries_cost == 1:
-                    # first time here, set lower block steps
-                    block_step /= 2
+         Args:
+            blocks (list): block numbers
+            max_calls (int, optional): maximum blocks per batch request. Defaults to 100.
+
+         Returns:
+            list: timestamps in the same order
+         """
+        chain_id = self.chain_id
+        missing = sorted(set(x for x in blocks if self._block_index.timestamp(chain_id=chain_id, block=x) == None))
+        for i in range(0, len(missing), max_calls):
+            chunk = missing[i:i+max_calls]
+            responses = self._measure(lambda: onchain_rpc.make_batch_request(self._w3.provider, [("eth_getBlockByNumber", [hex(x), False]) for x in chunk]),
+                                        kind="batch", function="eth_getBlockByNumber", calls=len(chunk))
+            for block, response in zip(chunk, responses):
+                if response.get("result", None) == None:
+                    # not in the batch answer: ask it alone
+                    self._index_block(block)
                 else:
-                    # change sign and lower steps
-                    block_step_sign *= -1
-                    block_step /= 2
-
-            # go to block
-            block_curr = self._w3.eth.get_block(math.floor(block_curr.number + (block_step*block_step_sign)))
-
-            blocks_x_timestamp = (abs(block_curr.timestamp-block_past.timestamp)/abs(block_curr.number-block_past.number)) if abs(block_curr.number-block_past.number) != 0 else 0
-            if blocks_x_timestamp != 0:
-                block_step = math.ceil(abs(block_curr.timestamp-timestamp)/blocks_x_timestamp)
-
-            if block_curr.timestamp < timestamp:
-                # block should be higher than current
-                block_step_sign = 1
-            elif block_curr.timestamp > timestamp:
-                # block should be lower than current
-                block_step_sign = -1
-            else:
-                # got it 
-                logging.getLogger(__name__).debug(" Took {} queries to the chain to find block number {} of timestamp {}".format(queries_cost, block_curr.number, timestamp))
-                return block_curr.number
-
-            # set block past 
-            block_past = block_curr
-
-            # 15sec while loop safe exit (an eternity to find the block)
-            if (dt.datetime.utcnow() - _startime).total_seconds() > (15):
-                if (timestamp-block_curr.timestamp) < 0:
-                    # modify block so it is not beyond timestamp
-                    block_curr = self._w3.eth.get_block(block_curr.number-1)
-                logging.getLogger(__name__).warning(" Could not find exact block number from timestamp -> took {} queries to the chain to find block number {} ({}) closest to timestamp {}  -> original-found difference {}".format(queries_cost, block_curr.number, block_curr.timestamp, timestamp, timestamp-block_curr.timestamp))
-                break
-        
-        # return closest block found
-        return block_curr.number
+                    self._block_index.add(chain_id=chain_id, block=block, timestamp=int(response["result"]["timestamp"], 16))
+        return [self._block_index.timestamp(chain_id=chain_id, block=x) for x in blocks]
+
+    def _index_block(self, block_identifier)->tuple:
+        """ Get a block from the chain and add it to the block index
+
+         Returns:
+            tuple: (block number, timestamp)
+         """
+        block = self._get_block(block_identifier)
+        self._block_index.add(chain_id=self.chain_id, block=block.number, timestamp=block.timestamp)
+        return (block.number, block.timestamp)
+
+    def _get_block(self, block_identifier):
+        """ eth_getBlockByNumber ( recorded in the metrics ) """
+        return self._measure(lambda: self._w3.eth.get_block(block_identifier), kind="get_block", function="eth_getBlockByNumber", block=block_identifier)
 
     def create_eventFilter_chunks(self, eventfilter:dict, max_blocks=1000)->list:
         """ create a list of event filters 
@@ -237,21 +750,193 @@ class web3wrap():
         # return result
         return result
 
-    def get_chunked_events(self, eventfilter, max_blocks=5000):
-        # get a list of filters with different block chunks
-        for filter in self.create_eventFilter_chunks(eventfilter=eventfilter, max_blocks=max_blocks):
-            entries = self._w3.eth.filter(filter).get_all_entries()
-            
-            # progress if no data found
-            if self._progress_callback and len(entries) == 0:
-                self._progress_callback(text="no matches from blocks {} to {}".format(filter["fromBlock"], filter["toBlock"]), 
-                                        remaining=eventfilter["toBlock"]-filter["toBlock"], 
-                                        total=eventfilter["toBlock"]-eventfilter["fromBlock"]) 
-
-            # filter blockchain data
-            for event in entries:
+    def get_chunked_events(self, eventfilter, max_blocks=5000, max_workers:int=4, target_results:int=2000, max_chunk_blocks:int=500000, reorg_depth:int=64):
+        """ Get event logs in block order.
+            When an event store is in use ( see use_event_store, off by default ), logs of filters by address and event topic
+            are read from it, synced first with the node: only blocks not already stored are asked.
+            Blocks closer than reorg_depth to the chain head are always asked and never stored.
+            web3wrap.use_event_store() disables the store again.
+            ( see get_chunked_logs for the args )
+
+         Args:
+            eventfilter (dict): {'fromBlock': GAMMA_START_BLOCK,
+                                    'toBlock': block,
+                                    'address': [self._address],
+                                    'topics': [self._topics[operation]],
+                                    }
+            reorg_depth (int, optional): blocks considered not final. Defaults to 64.
+
+         Yields:
+            event logs
+         """
+        chunk_args = {"max_blocks":max_blocks, "max_workers":max_workers, "target_results":target_results, "max_chunk_blocks":max_chunk_blocks}
+        if self._event_store == None or not eventfilter.get("address", None) or not eventfilter.get("topics", None) or eventfilter["topics"][0] == None:
+            yield from self.get_chunked_logs(eventfilter, **chunk_args)
+            return
+
+        chain_id = self.chain_id
+        addresses = [eventfilter["address"]] if isinstance(eventfilter["address"], str) else list(eventfilter["address"])
+        topic0s = eventfilter["topics"][0] if isinstance(eventfilter["topics"][0], list) else [eventfilter["topics"][0]]
+        topic0s = [Web3.toHex(HexBytes(x)) for x in topic0s]
+        pairs = [(address, topic0) for address in addresses for topic0 in topic0s]
+        # sync the whole event streams: other topic filters are applied locally
+        node_filter = {"address":[Web3.toChecksumAddress(x) for x in addresses], "topics":[topic0s]}
+
+        states = {pair:self._event_store.synced(chain_id, *pair) for pair in pairs}
+        if all(state != None and state[0] <= eventfilter["fromBlock"] and state[1] >= eventfilter["toBlock"] for state in states.values()):
+            # all stored
+            confirmed = eventfilter["toBlock"]
+        else:
+            confirmed = min(eventfilter["toBlock"], self._measure(lambda: self._w3.eth.block_number, kind="rpc", function="eth_blockNumber") - reorg_depth)
+
+            # rollback stored blocks not in the chain anymore ( reorgs deeper than reorg_depth )
+            hashes = dict()
+            for pair, state in states.items():
+                if state != None and state[2] != None and state[1] < confirmed:
+                    if not state[1] in hashes:
+                        hashes[state[1]] = Web3.toHex(self._get_block(state[1]).hash)
+                    if hashes[state[1]] != state[2]:
+                        logging.getLogger(__name__).warning(" chain reorganization found at block {}: removing {} stored {} logs after block {}".format(state[1], pair[0], pair[1], state[1]-reorg_depth))
+                        self._event_store.rollback(chain_id, *pair, block=state[1]-reorg_depth)
+                        states[pair] = self._event_store.synced(chain_id, *pair)
+
+            # sync not stored confirmed blocks
+            ranges = list()
+            if eventfilter["fromBlock"] <= confirmed:
+                for pair, state in states.items():
+                    if state == None:
+                        ranges.append([eventfilter["fromBlock"], confirmed])
+                        continue
+                    if eventfilter["fromBlock"] < state[0]:
+                        ranges.append([eventfilter["fromBlock"], state[0]-1])
+                    if confirmed > state[1]:
+                        ranges.append([state[1]+1, confirmed])
+            merged = list()
+            for fromBlock, toBlock in sorted(ranges):
+                if len(merged) > 0 and fromBlock <= merged[-1][1]+1:
+                    merged[-1][1] = max(merged[-1][1], toBlock)
+                else:
+                    merged.append([fromBlock, toBlock])
+            for fromBlock, toBlock in merged:
+                toBlock_hash = Web3.toHex(self._get_block(toBlock).hash)
+                logs = self.get_chunked_logs({**node_filter, "fromBlock":fromBlock, "toBlock":toBlock}, **chunk_args)
+                self._event_store.save(chain_id=chain_id, pairs=pairs, logs=[_log_to_row(x) for x in logs], fromBlock=fromBlock, toBlock=toBlock, toBlock_hash=toBlock_hash)
+
+        # stored blocks
+        for row in self._event_store.logs(chain_id=chain_id, addresses=addresses, topic0s=topic0s, fromBlock=eventfilter["fromBlock"], toBlock=confirmed):
+            event = _log_from_row(row)
+            if _log_matches_topics(event, eventfilter["topics"]):
                 yield event
-            
+
+        # not final blocks
+        if eventfilter["toBlock"] > confirmed:
+            for event in self.get_chunked_logs({**node_filter, "fromBlock":max(eventfilter["fromBlock"], confirmed+1), "toBlock":eventfilter["toBlock"]}, **chunk_args):
+                if _log_matches_topics(event, eventfilter["topics"]):
+                    yield event
+
+    def get_chunked_logs(self, eventfilter, max_blocks=5000, max_workers:int=4, target_results:int=2000, max_chunk_blocks:int=500000):
+        """ Get event logs from the node ( eth_getLogs ) in block chunks fetched concurrently, yielded in block order.
+            Chunk size grows while results are sparse and shrinks when they are dense.
+            Chunks the node refuses ( too many results, range too large, timeouts ) are split in halves.
+
+         Args:
+            eventfilter (dict): {'fromBlock': GAMMA_START_BLOCK,
+                                    'toBlock': block,
+                                    'address': [self._address],
+                                    'topics': [self._topics[operation]],
+                                    }
+            max_blocks (int, optional): initial blocks per chunk. Defaults to 5000.
+            max_workers (int, optional): chunks fetched at the same time. Defaults to 4.
+            target_results (int, optional): desired number of logs per chunk. Defaults to 2000.
+            max_chunk_blocks (int, optional): maximum blocks per chunk. Defaults to 500000.
+
+         Yields:
+            event logs
+         """
+        chunk_blocks = max_blocks
+        next_fromBlock = eventfilter["fromBlock"]
+        pending = deque() # (filter, future) in block order
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
+                while next_fromBlock <= eventfilter["toBlock"] or len(pending) > 0:
+                    # keep workers busy
+                    while next_fromBlock <= eventfilter["toBlock"] and len(pending) < max_workers:
+                        filter = {**eventfilter, "fromBlock":next_fromBlock, "toBlock":min(next_fromBlock+chunk_blocks-1, eventfilter["toBlock"])}
+                        pending.append((filter, executor.submit(self._get_logs, filter)))
+                        next_fromBlock = filter["toBlock"] + 1
+
+                    filter, future = pending.popleft()
+                    entries, splits = future.result()
+
+                    # adapt chunk size to logs density
+                    filter_blocks = filter["toBlock"] - filter["fromBlock"] + 1
+                    if splits > 0:
+                        chunk_blocks = max(filter_blocks//(2**splits), 1)
+                    elif len(entries) > target_results:
+                        chunk_blocks = max(chunk_blocks//2, 1)
+                    elif len(entries) < target_results/4 and filter_blocks >= chunk_blocks:
+                        chunk_blocks = min(chunk_blocks*2, max_chunk_blocks)
+
+                    # progress if no data found
+                    if self._progress_callback and len(entries) == 0:
+                        self._progress_callback(text="no matches from blocks {} to {}".format(filter["fromBlock"], filter["toBlock"]),
+                                                remaining=eventfilter["toBlock"]-filter["toBlock"],
+                                                total=eventfilter["toBlock"]-eventfilter["fromBlock"])
+
+                    # filter blockchain data
+                    for event in entries:
+                        yield event
+            finally:
+                # consumer may stop early
+                for filter, future in pending:
+                    future.cancel()
+
+    def _get_logs(self, eventfilter:dict)->tuple:
+        """ eth_getLogs splitting the block range in halves while the node refuses it
+
+         Returns:
+            tuple: (list of event logs, number of splits made)
+         """
+        try:
+            return self._measure(lambda: self._w3.eth.get_logs(eventfilter), kind="get_logs", function="eth_getLogs",
+                                    block=(eventfilter["fromBlock"], eventfilter["toBlock"]), results=lambda x: (len(x), sum(len(HexBytes(log["data"])) + 32*len(log["topics"]) for log in x))), 0
+        except Exception as e:
+            if eventfilter["toBlock"] <= eventfilter["fromBlock"] or not _is_log_range_error(e):
+                raise
+            logging.getLogger(__name__).debug(" splitting getLogs blocks {} to {}: {}".format(eventfilter["fromBlock"], eventfilter["toBlock"], e))
+            middle = (eventfilter["fromBlock"] + eventfilter["toBlock"])//2
+            lower, lower_splits = self._get_logs({**eventfilter, "toBlock":middle})
+            upper, upper_splits = self._get_logs({**eventfilter, "fromBlock":middle+1})
+            return lower + upper, 1 + max(lower_splits, upper_splits)
+
+    def event_topic(self, event_name:str)->str:
+        """ Topic0 of a contract event
+
+         Args:
+            event_name (str): like "Mint"
+
+         Returns:
+            str: 0x...
+         """
+        return Web3.toHex(event_abi_to_log_topic(self._contract.events[event_name]().abi))
+
+    def get_events(self, event_names:list, fromBlock:int, toBlock:int, **kwargs):
+        """ Decoded events of this contract in block order ( see get_chunked_events for kwargs )
+
+         Args:
+            event_names (list): like ["Mint","Burn"]
+            fromBlock (int):
+            toBlock (int):
+
+         Yields:
+            AttributeDict: {"event":..., "args":{...}, "blockNumber":..., "logIndex":..., "transactionHash":..., ...}
+         """
+        topics = {self.event_topic(x):x for x in event_names}
+        eventfilter = {"fromBlock":fromBlock, "toBlock":toBlock, "address":[self._address], "topics":[list(topics.keys())]}
+        for log in self.get_chunked_events(eventfilter, **kwargs):
+            yield self._contract.events[topics[Web3.toHex(log["topics"][0])]]().processLog(log)
+
 class erc20(web3wrap):
     _abi_filename = "erc20"
     _abi_path = "data/abi"
@@ -259,21 +944,370 @@ class erc20(web3wrap):
    # PROPERTIES
     @property
     def decimals(self)->int:
-        return self._contract.functions.decimals().call(block_identifier=self.block)
+        return self.call_immutable("decimals")
     
     def balanceOf(self, address:str)->float:
-        return self._contract.functions.balanceOf(Web3.toChecksumAddress(address)).call(block_identifier=self.block)/(10**self.decimals)
+        return self.call_function("balanceOf", Web3.toChecksumAddress(address))/(10**self.decimals)
     
     @property
     def totalSupply(self)->float:
-        return self._contract.functions.totalSupply().call(block_identifier=self.block)/(10**self.decimals)
+        return self.call_function("totalSupply")/(10**self.decimals)
     
     @property
     def symbol(self)->str:
-        return self._contract.functions.symbol().call(block_identifier=self.block)
+        return self.call_immutable("symbol")
     
     def allowance(self, owner:str, spender:str)->float:
-        return self._contract.functions.allowance(Web3.toChecksumAddress(owner), Web3.toChecksumAddress(spender)).call(block_identifier=self.block)/(10**self.decimals)
+        return self.call_function("allowance", Web3.toChecksumAddress(owner), Web3.toChecksumAddress(spender))/(10**self.decimals)
+
+
+class multicall3(web3wrap):
+    _abi_filename = "multicall3"
+    _abi_path = "data/abi"
+
+    def aggregate3(self, calls:list)->list:
+        """ Aggregate calls, allowing each to fail
+
+         Args:
+            calls (list): [ (target address, allowFailure, callData), ...]
+
+         Returns:
+            list: [ (success, returnData), ...]
+         """
+        # not cached: the aggregated results are cached individually by execute
+        block = self.block
+        calls = [(Web3.toChecksumAddress(target), allowFailure, HexBytes(callData)) for target, allowFailure, callData in calls]
+        return self._measure(lambda: self.call_raw("aggregate3", self.encode_function("aggregate3", calls), block, calls), kind="multicall", function="aggregate3",
+                                block=block, size=sum(len(x[2]) for x in calls), calls=len(calls), results=lambda x: (len(x), sum(len(data) for success, data in x)))
+
+    def execute(self, calls:list, max_calls:int=300)->list:
+        """ Execute wrapper reads in as few aggregate3 calls as possible ( at this object's block )
+            and prefetch the successful results into the call cache so that wrapper properties do not hit the chain.
+            Reads already cached are not sent.
+
+         Args:
+            calls (list): [ (web3wrap object, function name, (args,...)), ...]
+            max_calls (int, optional): maximum calls per aggregate3 call ( keep below node gas cap ). Defaults to 300.
+
+         Returns:
+            list: decoded results in the same order ( None when the call failed )
+         """
+        # remove duplicated and already cached calls
+        call_keys = [wrapper.call_key(function_name, *args, block=self.block) for wrapper, function_name, args in calls]
+        unique = dict()
+        for key, call in zip(call_keys, calls):
+            if not key in self._call_cache:
+                unique.setdefault(key, call)
+            else:
+                self._metrics.record(onchain_metrics.rpc_event(kind="call", contract=type(call[0]).__name__, function=call[1], block=key[3], cache="hit"))
+        keys = list(unique.keys())
+
+        decoded = dict()
+        for i in range(0, len(keys), max_calls):
+            chunk = keys[i:i+max_calls]
+            # key: (chainId, address, calldata, block)
+            for key, (success, returnData) in zip(chunk, self.aggregate3([(key[1], True, key[2]) for key in chunk])):
+                if not success:
+                    logging.getLogger(__name__).debug(" multicall {} call to {} failed at block {}".format(unique[key][1], key[1], self.block))
+                    continue
+                wrapper, function_name, args = unique[key]
+                self._metrics.record(onchain_metrics.rpc_event(kind="call", contract=type(wrapper).__name__, function=function_name, block=key[3],
+                                                                size=len(key[2])//2-1 + len(returnData), cache="miss", via="multicall"))
+                decoded[key] = wrapper.decode_function(function_name, returnData)
+                self._call_cache.set(key, decoded[key])
+
+        return [decoded[key] if key in decoded else self._call_cache.get(key, None) for key in call_keys]
+
+
+class batch_result():
+    """ Result of a contract read made inside a web3wrap.batch() block, known once the batch is sent.
+        Indexing and arithmetic return derived batch_results so wrapper properties work unchanged inside the block.
+        Comparing it or converting it to a number sends the batch right away.
+    """
+
+    def __init__(self, compute, batch:"rpc_batch"=None):
+        self._compute = compute
+        self._batch = batch
+        self._done = False
+        self._value = None
+
+    def result(self):
+        """ Read value ( sends the batch when still pending ) """
+        if not self._done:
+            if self._batch != None:
+                self._batch.flush()
+            self._value = self._compute()
+            self._done = True
+        return self._value
+
+    def __repr__(self):
+        return "batch_result({})".format(repr(self._value) if self._done else "pending")
+
+    def _derive(self, func, other=None):
+        return batch_result(compute=lambda: func(self.result(), other.result() if isinstance(other, batch_result) else other))
+
+    def __getitem__(self, key):
+        return self._derive(lambda x, y: x[y], key)
+    # not iterable: list() or unpacking would index it forever
+    __iter__ = None
+    def __neg__(self):
+        return self._derive(lambda x, y: -x)
+    def __add__(self, other):
+        return self._derive(lambda x, y: x + y, other)
+    def __radd__(self, other):
+        return self._derive(lambda x, y: y + x, other)
+    def __sub__(self, other):
+        return self._derive(lambda x, y: x - y, other)
+    def __rsub__(self, other):
+        return self._derive(lambda x, y: y - x, other)
+    def __mul__(self, other):
+        return self._derive(lambda x, y: x * y, other)
+    def __rmul__(self, other):
+        return self._derive(lambda x, y: y * x, other)
+    def __truediv__(self, other):
+        return self._derive(lambda x, y: x / y, other)
+    def __rtruediv__(self, other):
+        return self._derive(lambda x, y: y / x, other)
+    def __floordiv__(self, other):
+        return self._derive(lambda x, y: x // y, other)
+    def __rfloordiv__(self, other):
+        return self._derive(lambda x, y: y // x, other)
+    def __mod__(self, other):
+        return self._derive(lambda x, y: x % y, other)
+    def __rmod__(self, other):
+        return self._derive(lambda x, y: y % x, other)
+    def __pow__(self, other):
+        return self._derive(lambda x, y: x ** y, other)
+    def __rpow__(self, other):
+        return self._derive(lambda x, y: y ** x, other)
+
+    def __bool__(self):
+        return bool(self.result())
+    def __int__(self):
+        return int(self.result())
+    def __index__(self):
+        return int(self.result())
+    def __float__(self):
+        return float(self.result())
+    def __lt__(self, other):
+        return self.result() < (other.result() if isinstance(other, batch_result) else other)
+    def __le__(self, other):
+        return self.result() <= (other.result() if isinstance(other, batch_result) else other)
+    def __gt__(self, other):
+        return self.result() > (other.result() if isinstance(other, batch_result) else other)
+    def __ge__(self, other):
+        return self.result() >= (other.result() if isinstance(other, batch_result) else other)
+    def __eq__(self, other):
+        # a read value is never None: "== None" checks do not send the batch
+        if other is None:
+            return False
+        return self.result() == (other.result() if isinstance(other, batch_result) else other)
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    # value changes once read: not hashable
+    __hash__ = None
+
+
+class rpc_batch():
+    """ Contract reads sent as JSON-RPC batch eth_call requests ( see web3wrap.batch ).
+        Results are decoded and left in the call cache.
+    """
+
+    def __init__(self, max_calls:int=100):
+        """
+         Args:
+            max_calls (int, optional): maximum calls per batch request. Defaults to 100.
+         """
+        self.max_calls = max_calls
+        self._pending = dict() # call key: (wrapper, function name, args)
+        self._depth = 0
+
+    def __enter__(self):
+        if self._depth == 0:
+            _batches.active = self
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._depth -= 1
+        if self._depth == 0:
+            _batches.active = None
+            if exc_type == None:
+                self.flush()
+            else:
+                self._pending = dict()
+
+    def add(self, key:tuple, wrapper:web3wrap, function_name:str, args:tuple)->batch_result:
+        """ Add a read to the next batch
+
+         Args:
+            key (tuple): call key ( see web3wrap.call_key )
+            wrapper (web3wrap):
+            function_name (str):
+            args (tuple):
+
+         Returns:
+            batch_result:
+         """
+        self._pending.setdefault(key, (wrapper, function_name, args))
+        # reads failing in the batch are sent again alone, raising the node error
+        return batch_result(compute=lambda: wrapper._call_cache.get_or_call(key=key,
+                                func=lambda: wrapper._measure(lambda: wrapper.call_raw(function_name, key[2], key[3], *args),
+                                                                kind="call", function=function_name, block=key[3], size=len(key[2])//2-1, cache="miss")),
+                            batch=self)
+
+    def execute(self, calls:list)->list:
+        """ Execute wrapper reads in as few batch requests as possible
+            and prefetch the results into the call cache ( same as multicall3.execute ).
+            Reads already cached are not sent.
+
+         Args:
+            calls (list): [ (web3wrap object, function name, (args,...)), ...]
+
+         Returns:
+            list: decoded results in the same order ( None when the call failed )
+         """
+        keys = [wrapper.call_key(function_name, *args) for wrapper, function_name, args in calls]
+        for key, (wrapper, function_name, args) in zip(keys, calls):
+            if not key in wrapper._call_cache:
+                self.add(key=key, wrapper=wrapper, function_name=function_name, args=args)
+            else:
+                wrapper._metrics.record(onchain_metrics.rpc_event(kind="call", contract=type(wrapper).__name__, function=function_name, block=key[3], cache="hit"))
+        self.flush()
+        return [wrapper._call_cache.get(key, None) for key, (wrapper, function_name, args) in zip(keys, calls)]
+
+    def flush(self):
+        """ Send pending reads ( one batch request per provider and max_calls ) """
+        pending, self._pending = self._pending, dict()
+
+        by_provider = dict()
+        for key, (wrapper, function_name, args) in pending.items():
+            by_provider.setdefault(wrapper.w3.provider, list()).append(key)
+
+        for provider, keys in by_provider.items():
+            for i in range(0, len(keys), self.max_calls):
+                chunk = keys[i:i+self.max_calls]
+                # key: (chainId, address, calldata, block)
+                responses = onchain_metrics.metrics.measure(lambda: onchain_rpc.make_batch_request(provider, [("eth_call", [{"to":key[1], "data":key[2]}, hex(key[3])]) for key in chunk]),
+                                                            kind="batch", contract=None, function="eth_call", size=sum(len(key[2])//2-1 for key in chunk), calls=len(chunk),
+                                                            results=lambda x: (len(x), sum(len(y.get("result", None) or "0x")//2-1 for y in x)))
+                for key, response in zip(chunk, responses):
+                    wrapper, function_name, args = pending[key]
+                    wrapper._metrics.record(onchain_metrics.rpc_event(kind="call", contract=type(wrapper).__name__, function=function_name, block=key[3],
+                                                                       size=len(key[2])//2-1 + len(response.get("result", None) or "0x")//2-1,
+                                                                       cache="miss", via="batch", error=not "result" in response))
+                    if not "result" in response:
+                        logging.getLogger(__name__).debug(" batch {} call to {} failed at block {}: {}".format(function_name, key[1], key[3], response.get("error", "")))
+                        continue
+                    try:
+                        wrapper._call_cache.set(key, wrapper.decode_function(function_name, response["result"]))
+                    except DecodingError as e:
+                        logging.getLogger(__name__).debug(" batch {} call to {} returned undecodable data at block {}: {}".format(function_name, key[1], key[3], e))
+
+
+# UNISWAP V3 MATH
+def calculate_feeGrowthInside(tick:int, tickLower:int, tickUpper:int, feeGrowthGlobalX128:int, feeGrowthOutsideX128_lower:int, feeGrowthOutsideX128_upper:int)->int:
+    """ Fee growth per unit of liquidity inside a tick range, as the pool contract calculates it ( Tick.getFeeGrowthInside ).
+        Fee growth values are uint256 that are allowed to overflow: the subtractions wrap around.
+
+     Args:
+        tick (int): pool current tick
+        tickLower (int):
+        tickUpper (int):
+        feeGrowthGlobalX128 (int): pool feeGrowthGlobal0X128 or feeGrowthGlobal1X128
+        feeGrowthOutsideX128_lower (int): ticks(tickLower) feeGrowthOutside of the same token
+        feeGrowthOutsideX128_upper (int): ticks(tickUpper) feeGrowthOutside of the same token
+
+     Returns:
+        int: feeGrowthInsideX128
+     """
+    # fee growth below and above the range
+    feeGrowthBelowX128 = feeGrowthOutsideX128_lower if tick >= tickLower else feeGrowthGlobalX128 - feeGrowthOutsideX128_lower
+    feeGrowthAboveX128 = feeGrowthOutsideX128_upper if tick < tickUpper else feeGrowthGlobalX128 - feeGrowthOutsideX128_upper
+    return (feeGrowthGlobalX128 - feeGrowthBelowX128 - feeGrowthAboveX128) % _q256
+
+def calculate_tvlPriceFees(position:dict, tick:int, tickUpper:int, tickLower:int, ticks_lower:dict, ticks_upper:dict,
+                           feeGrowthGlobal0X128:int, feeGrowthGlobal1X128:int, decimals_token0:int, decimals_token1:int)->dict:
+    """ Calculate TVL, price and uncollected fees, including owed, for each token of a pool position from already read pool state
+        ( see univ3_pool.get_tvlPriceFees )
+
+     Args:
+        position (dict): univ3_pool.positions result
+        tick (int): pool current tick ( slot0 )
+        tickUpper (int):
+        tickLower (int):
+        ticks_lower (dict): univ3_pool.ticks(tickLower) result
+        ticks_upper (dict): univ3_pool.ticks(tickUpper) result
+        feeGrowthGlobal0X128 (int):
+        feeGrowthGlobal1X128 (int):
+        decimals_token0 (int):
+        decimals_token1 (int):
+
+     Returns:
+        tvl_record: same as univ3_pool.get_tvlPriceFees
+     """
+    # get decimal difference btween tokens
+    decimal_diff = decimals_token1-decimals_token0
+    
+    # Tick PRICEs
+    # calc tick prices (not decimal adjusted)
+    prices = {"priceCurrent":float(math.pow(1.0001, tick)),
+              "priceUpper":float(math.pow(1.0001, tickUpper)),
+              "priceLower":float(math.pow(1.0001, tickLower)),
+            }
+    # prepare price related vars 
+    prices_sqrt = dict()
+    prices_adj = dict()
+    for k,v in prices.items():
+        # Square root prices 
+        prices_sqrt[k] = math.sqrt(v)
+        # adjust decimals and reverse bc price in Uniswap is defined to be equal to token1/token0
+        prices_adj[k] = 1/(v/ math.pow(10, decimal_diff))
+    
+    # TVL
+    if (prices["priceCurrent"] <= prices["priceLower"]):
+        amount0 = float(position["liquidity"] * float(1 / prices_sqrt["priceLower"] - 1 / prices_sqrt["priceUpper"]))
+        amount1 = 0
+    elif (prices["priceCurrent"] < prices["priceUpper"]):
+        amount0 = float(position["liquidity"] * float(1 / prices_sqrt["priceCurrent"] - 1 / prices_sqrt["priceUpper"]))
+        amount1 = float(position["liquidity"] * float(prices_sqrt["priceCurrent"] - prices_sqrt["priceLower"]))
+    else:
+        amount1 = float(position["liquidity"] * float(prices_sqrt["priceUpper"] - prices_sqrt["priceLower"]))
+        amount0 = 0
+    
+    amount0 = amount0 / math.pow(10, float(decimals_token0))
+    amount1 = amount1 / math.pow(10, float(decimals_token1))
+
+    # UNCOLLECTED FEES
+    # token0 fee
+    feeGrowthInside0X128 = calculate_feeGrowthInside(tick=tick, tickLower=tickLower, tickUpper=tickUpper, feeGrowthGlobalX128=feeGrowthGlobal0X128,
+                                                     feeGrowthOutsideX128_lower=ticks_lower["feeGrowthOutside0X128"], feeGrowthOutsideX128_upper=ticks_upper["feeGrowthOutside0X128"])
+    fees0 = ((feeGrowthInside0X128 - position["feeGrowthInside0LastX128"]) % _q256) * position["liquidity"] // _q128 / (10**decimals_token0)
+    # token1 fee
+    feeGrowthInside1X128 = calculate_feeGrowthInside(tick=tick, tickLower=tickLower, tickUpper=tickUpper, feeGrowthGlobalX128=feeGrowthGlobal1X128,
+                                                     feeGrowthOutsideX128_lower=ticks_lower["feeGrowthOutside1X128"], feeGrowthOutsideX128_upper=ticks_upper["feeGrowthOutside1X128"])
+    fees1 = ((feeGrowthInside1X128 - position["feeGrowthInside1LastX128"]) % _q256) * position["liquidity"] // _q128 / (10**decimals_token1)
+
+    # OWED FEES
+    tokensOwed0 = position["tokensOwed0"] / (10**decimals_token0)
+    tokensOwed1 = position["tokensOwed1"] / (10**decimals_token1)
+
+    # retur result
+    return tvl_record(qtty_token0=amount0,
+                      qtty_token1=amount1,
+                      price_token0=prices["priceCurrent"]/math.pow(10, decimal_diff),
+                      price_token1=prices_adj["priceCurrent"],
+                      fees_uncollected_token0=fees0,
+                      fees_uncollected_token1=fees1,
+                      fees_owed_token0=tokensOwed0,
+                      fees_owed_token1=tokensOwed1,
+                    )
+
+
+def sum_tvlPriceFees(base:dict, limit:dict)->tvl_record:
+    """ Sum up base and limit positions calculate_tvlPriceFees results ( prices are averaged ) """
+    return tvl_record(*[(base[k] + limit[k])/2 if k in ["price_token0","price_token1"] else base[k] + limit[k]
+                        for k in tvl_record._fields])
 
 
 # EXCHANGES
@@ -283,17 +1317,18 @@ class univ3_pool(erc20):
 
     _token0:erc20 = None
     _token1:erc20 = None
+    _tick_map = None
 
     @property
     def factory(self)->str:
-        return self._contract.functions.factory().call(block_identifier=self.block)
+        return self.call_immutable("factory")
 
     @property
     def fee(self)->int:
         """ The pool's fee in hundredths of a bip, i.e. 1e-6  
 
         """        
-        return self._contract.functions.fee().call(block_identifier=self.block)
+        return self.call_immutable("fee")
 
     @property
     def feeGrowthGlobal0X128(self)->int:
@@ -301,7 +1336,7 @@ class univ3_pool(erc20):
          Returns:
             int: as Q128.128 fees of token0
          """      
-        return self._contract.functions.feeGrowthGlobal0X128().call(block_identifier=self.block)
+        return self.call_function("feeGrowthGlobal0X128")
     
     @property
     def feeGrowthGlobal1X128(self)->int:
@@ -309,18 +1344,18 @@ class univ3_pool(erc20):
          Returns:
             int: as Q128.128 fees of token1
          """        
-        return self._contract.functions.feeGrowthGlobal1X128().call(block_identifier=self.block)
+        return self.call_function("feeGrowthGlobal1X128")
 
     @property
     def liquidity(self)->int:
-        return self._contract.functions.liquidity().call(block_identifier=self.block)
+        return self.call_function("liquidity")
 
     @property
     def maxLiquidityPerTick(self)->int:
-        return self._contract.functions.maxLiquidityPerTick().call(block_identifier=self.block)
+        return self.call_immutable("maxLiquidityPerTick")
     
     def observations(self, input:int):
-        return self._contract.functions.observations(input).call(block_identifier=self.block)
+        return self.call_function("observations", input)
     
     def observe(self, secondsAgo:int):
         """observe _summary_
@@ -333,9 +1368,25 @@ class univ3_pool(erc20):
                     secondsPerLiquidityCumulativeX128s   uint160[] :  242821134689165142944235398318169
             
          """        
-        return self._contract.functions.observe(secondsAgo).call(block_identifier=self.block)
+        return self.call_function("observe", secondsAgo)
+
+    def twap(self, windows:list, multicall_address:str=MULTICALL3_ADDRESS, batch:bool=False)->dict:
+        """ Time weighted average tick and prices of several windows in one observe call
+            ( memoized by the chain's shared onchain_pricing.twap_oracle, see shared_twap_oracle )
+
+         Args:
+            windows (list): seconds, like [300, 3600]
+            multicall_address (str, optional): Multicall3 contract address. Defaults to MULTICALL3_ADDRESS.
+            batch (bool, optional): use JSON-RPC batch requests instead of Multicall3. Defaults to False.
+
+         Returns:
+            dict: {window: {"tick":, "price_token0":, "price_token1":, "seconds":}}
+         """
+        import onchain_pricing
 
-    def positions(self, position_key:str)->dict:
+        return onchain_pricing.shared_twap_oracle(self.chain_id, multicall_address=multicall_address, batch=batch).twap(pool=self, windows=windows)
+
+    def positions(self, position_key:str)->position_record:
         """ 
 
          Args:
@@ -349,13 +1400,7 @@ class univ3_pool(erc20):
                     tokensOwed0   uint128 :  0
                     tokensOwed1   uint128 :  0
          """
-        result = self._contract.functions.positions(position_key).call(block_identifier=self.block)
-        return {"liquidity":result[0],
-                "feeGrowthInside0LastX128":result[1],
-                "feeGrowthInside1LastX128":result[2],
-                "tokensOwed0":result[3],
-                "tokensOwed1":result[4],
-                }
+        return _as_record(position_record, self.call_function("positions", position_key))
 
     @property  
     def protocolFees(self):
@@ -365,10 +1410,10 @@ class univ3_pool(erc20):
             _type_: token0   uint128 :  0
                     token1   uint128 :  0
          """        
-        return self._contract.functions.protocolFees().call(block_identifier=self.block)
+        return self.call_function("protocolFees")
 
     @property
-    def slot0(self)->dict:
+    def slot0(self)->slot0_record:
         """ The 0th storage slot in the pool stores many values, and is exposed as a single method to save gas when accessed externally.
 
          Returns:
@@ -380,28 +1425,19 @@ class univ3_pool(erc20):
                     feeProtocol   uint8 :  0
                     unlocked   bool :  true
          """
-        tmp = self._contract.functions.slot0().call(block_identifier=self.block)
-        return {
-                "sqrtPriceX96": tmp[0],
-                "tick": tmp[1],
-                "observationIndex": tmp[2],
-                "observationCardinality": tmp[3],
-                "observationCardinalityNext": tmp[4],
-                "feeProtocol": tmp[5],
-                "unlocked": tmp[6],
-        }
+        return _as_record(slot0_record, self.call_function("slot0"))
 
     def snapshotCumulativeInside(self, tickLower:int, tickUpper:int):
-        return self._contract.functions.snapshotCumulativeInside(tickLower,tickUpper).call(block_identifier=self.block)
+        return self.call_function("snapshotCumulativeInside", tickLower, tickUpper)
 
     def tickBitmap(self, input:int)->int:
-        return self._contract.functions.tickBitmap(input).call(block_identifier=self.block)
+        return self.call_function("tickBitmap", input)
 
     @property
     def tickSpacing(self)->int:
-        return self._contract.functions.tickSpacing().call(block_identifier=self.block)
+        return self.call_immutable("tickSpacing")
 
-    def ticks(self, tick:int)->dict:
+    def ticks(self, tick:int)->tick_record:
         """  
 
          Args:
@@ -417,16 +1453,7 @@ class univ3_pool(erc20):
                         secondsOutside   uint32 :  0
                         initialized   bool :  false
          """
-        result = self._contract.functions.ticks(tick).call(block_identifier=self.block)
-        return {"liquidityGross":result[0],
-                "liquidityNet":result[1],
-                "feeGrowthOutside0X128":result[2],
-                "feeGrowthOutside1X128":result[3],
-                "tickCumulativeOutside":result[4],
-                "secondsPerLiquidityOutsideX128":result[5],
-                "secondsOutside":result[6],
-                "initialized":result[7],
-            }
+        return _as_record(tick_record, self.call_function("ticks", tick))
 
     @property
     def token0(self)->erc20:
@@ -436,8 +1463,7 @@ class univ3_pool(erc20):
             erc20: 
          """        
         if self._token0 == None:
-            self._token0 = erc20(address=self._contract.functions.token0().call(block_identifier=self.block),
-                                 web3Provider=self._w3)
+            self._token0 = erc20.shared(address=self.call_immutable("token0"), web3Provider=self._w3, block=self.block)
         return self._token0
     
     @property
@@ -448,8 +1474,7 @@ class univ3_pool(erc20):
             erc20: 
          """        
         if self._token1 == None:
-            self._token1 = erc20(address=self._contract.functions.token1().call(block_identifier=self.block),
-                                 web3Provider=self._w3)
+            self._token1 = erc20.shared(address=self.call_immutable("token1"), web3Provider=self._w3, block=self.block)
         return self._token1
     
    #WRITE FUNCTION WITHOUT STATE CHANGE
@@ -461,13 +1486,20 @@ class univ3_pool(erc20):
    # CUSTOM PROPERTIES
     @property
     def block(self)->int:
-        return self._block
+        return self._resolve_block()
     @block.setter
     def block(self, value:int):
-        # set block 
+        # set block ( tokens may be shared: get the ones at the new block )
         self._block = value
-        self.token0.block = value
-        self.token1.block = value
+        self._token0 = None
+        self._token1 = None
+
+    def at_block(self, block:int)->"univ3_pool":
+        result = super().at_block(block)
+        result._token0 = None if self._token0 == None else self._token0.at_block(block)
+        result._token1 = None if self._token1 == None else self._token1.at_block(block)
+        result._tick_map = None
+        return result
 
 
    # CUSTOM FUNCTIONS
@@ -484,7 +1516,7 @@ class univ3_pool(erc20):
                 "priceLower":priceLower
             }
 
-    def get_tvlPriceFees(self, ownerAddress:str, tickUpper:int, tickLower:int)->dict:
+    def get_tvlPriceFees(self, ownerAddress:str, tickUpper:int, tickLower:int)->tvl_record:
         """ Calculate current TVL, price and uncollected fees, including owed, for each token in the pool
 
          Args:
@@ -493,7 +1525,7 @@ class univ3_pool(erc20):
             tickLower (int): 
 
          Returns:
-            dict:  {"qtty_token0": ,
+            tvl_record:  {"qtty_token0": ,
                     "qtty_token1": ,
                     "price_token0": ,
                     "price_token1": ,
@@ -508,80 +1540,19 @@ class univ3_pool(erc20):
             tickLower=tickLower,
             tickUpper=tickUpper,)
 
-        # catch most used vars 
-        decimals_token0 = self.token0.decimals
-        decimals_token1 = self.token1.decimals
-        
-        # get decimal difference btween tokens
-        decimal_diff = decimals_token1-decimals_token0
-        
-        # Tick PRICEs
-        # calc tick prices (not decimal adjusted)
-        prices = self.get_rawPrices(tickUpper, tickLower)
-        # prepare price related vars 
-        prices_sqrt = dict()
-        prices_adj = dict()
-        for k,v in prices.items():
-            # Square root prices 
-            prices_sqrt[k] = math.sqrt(v)
-            # adjust decimals and reverse bc price in Uniswap is defined to be equal to token1/token0
-            prices_adj[k] = 1/(v/ math.pow(10, decimal_diff))
-        
-        # TVL
-        if (prices["priceCurrent"] <= prices["priceLower"]):
-            amount0 = float(pos["liquidity"] * float(1 / prices_sqrt["priceLower"] - 1 / prices_sqrt["priceUpper"]))
-            amount1 = 0
-        elif (prices["priceCurrent"] < prices["priceUpper"]):
-            amount0 = float(pos["liquidity"] * float(1 / prices_sqrt["priceCurrent"] - 1 / prices_sqrt["priceUpper"]))
-            amount1 = float(pos["liquidity"] * float(prices_sqrt["priceCurrent"] - prices_sqrt["priceLower"]))
-        else:
-            amount1 = float(pos["liquidity"] * float(prices_sqrt["priceUpper"] - prices_sqrt["priceLower"]))
-            amount0 = 0
-        
-        amount0 = amount0 / math.pow(10, float(decimals_token0))
-        amount1 = amount1 / math.pow(10, float(decimals_token1))
-
-        # UNCOLLECTED FEES  
+        # UNCOLLECTED FEES data
         ticks_lower = self.ticks(tickLower)
         ticks_upper = self.ticks(tickUpper)
-        # token0 fee
-        feeGrowthOutside0X128_lower = ticks_lower["feeGrowthOutside0X128"]
-        feeGrowthOutside0X128_upper = ticks_upper["feeGrowthOutside0X128"]
-        feeGrowthInside0LastX128 = pos["feeGrowthInside0LastX128"]
-        fees0 = ((self.feeGrowthGlobal0X128 - feeGrowthOutside0X128_lower - feeGrowthOutside0X128_upper - feeGrowthInside0LastX128)/_x128)*pos["liquidity"]/(10**decimals_token0)
-        # token1 fee
-        feeGrowthOutside1X128_lower = ticks_lower["feeGrowthOutside1X128"]
-        feeGrowthOutside1X128_upper = ticks_upper["feeGrowthOutside1X128"]
-        feeGrowthInside1LastX128 = pos["feeGrowthInside1LastX128"]
-        fees1 = ((self.feeGrowthGlobal1X128 - feeGrowthOutside1X128_lower - feeGrowthOutside1X128_upper - feeGrowthInside1LastX128)/_x128)*pos["liquidity"]/(10**decimals_token1)
-        ################################################################################################
-        # TODO: I can't seem to get both tokens POSITIVE uncollected fees. Ive tried ... CHANGE THIS ASAP
-        if fees0 < 0 :
-            fees0 = 0
-        if fees1 < 0 :
-            fees1 = 0
-        #################################################################################################
-
-
-
-        # OWED FEES
-        tokensOwed0 = pos["tokensOwed0"] / (10**decimals_token0)
-        tokensOwed1 = pos["tokensOwed1"] / (10**decimals_token1)
-
-        # retur result
-        return {"qtty_token0": amount0,
-                "qtty_token1": amount1,
-                "price_token0": prices["priceCurrent"]/math.pow(10, decimal_diff),
-                "price_token1": prices_adj["priceCurrent"],
-                "fees_uncollected_token0": fees0,
-                "fees_uncollected_token1": fees1,
-                "fees_owed_token0": tokensOwed0,
-                "fees_owed_token1": tokensOwed1,
-            }
-        
+
+        return calculate_tvlPriceFees(position=pos, tick=self.slot0["tick"], tickUpper=tickUpper, tickLower=tickLower,
+                                      ticks_lower=ticks_lower, ticks_upper=ticks_upper,
+                                      feeGrowthGlobal0X128=self.feeGrowthGlobal0X128, feeGrowthGlobal1X128=self.feeGrowthGlobal1X128,
+                                      decimals_token0=self.token0.decimals, decimals_token1=self.token1.decimals)
+
 
    # HELPERS
-    def get_positionKey(self, ownerAddress:str, tickLower:int, tickUpper:int):
+    @staticmethod
+    def get_positionKey(ownerAddress:str, tickLower:int, tickUpper:int):
         """ 
 
          Args:
@@ -596,6 +1567,50 @@ class univ3_pool(erc20):
         values =[ownerAddress,tickLower,tickUpper]
         return Web3.solidityKeccak(val_types, values).hex()
 
+    def load_tick_map(self, block:int=None, batch:bool=False, multicall_address:str=MULTICALL3_ADDRESS):
+        """ All initialized ticks of the pool with their liquidity, to query depth, slippage and range TVL locally
+            ( see onchain_univ3.tick_map ).
+            The first load scans the whole tickBitmap in bulk, later blocks are updated from Mint and Burn events
+            on a copy of the last map: maps returned before keep their block.
+
+         Args:
+            block (int, optional): Defaults to current block.
+            batch (bool, optional): use JSON-RPC batch requests instead of Multicall3. Defaults to False.
+            multicall_address (str, optional): Multicall3 contract address. Defaults to MULTICALL3_ADDRESS.
+
+         Returns:
+            onchain_univ3.tick_map:
+         """
+        # numpy is only needed here
+        import onchain_univ3
+
+        block = self.block if block == None else block
+        if self._tick_map == None or self._tick_map.block > block:
+            self._tick_map = onchain_univ3.load_tick_map(pool=self, block=block, batch=batch, multicall_address=multicall_address)
+        elif self._tick_map.block < block:
+            # maps already returned stay at their block
+            tick_map = self._tick_map.copy()
+            tick_map.update(pool=self, block=block)
+            self._tick_map = tick_map
+        return self._tick_map
+
+    def stream(self, ws_url:str, **kwargs):
+        """ Price, tick, liquidity and fee growth changes pushed from WebSocket subscriptions ( see onchain_stream.pool_stream )
+
+            async for delta in pool.stream(ws_url="wss://..."):
+                print(delta["block"], delta["snapshot"]["tick"])
+
+         Args:
+            ws_url (str): ws(s) endpoint of this pool's chain
+
+         Returns:
+            async iterator of deltas
+         """
+        # websockets is only needed here
+        import onchain_stream
+
+        return onchain_stream.pool_stream(pools=[self], ws_url=ws_url, **kwargs).subscribe()
+
 
 
 # PROTOCOLS
@@ -611,152 +1626,191 @@ class gamma_hypervisor(erc20):
    # GRAL
     @property
     def baseLower(self):
-        return self._contract.functions.baseLower().call(block_identifier=self.block)
+        return self.call_function("baseLower")
 
     @property
     def baseUpper(self):
-        return self._contract.functions.baseUpper().call(block_identifier=self.block)
+        return self.call_function("baseUpper")
 
     @property
     def currentTick(self)->int:
-        return self._contract.functions.currentTick().call(block_identifier=self.block)
+        return self.call_function("currentTick")
     
     @property
     def deposit0Max(self)->float:
-        return self._contract.functions.deposit0Max().call(block_identifier=self.block)
+        return self.call_function("deposit0Max")
 
     @property
     def deposit1Max(self)->float:
-        return self._contract.functions.deposit1Max().call(block_identifier=self.block)
+        return self.call_function("deposit1Max")
 
     @property
     def directDeposit(self)->bool:
-        return self._contract.functions.directDeposit().call(block_identifier=self.block)
+        return self.call_function("directDeposit")
 
     @property
     def fee(self)->int:
-        if not "fee" in self._cache:
-            self._cache["fee"] = self._contract.functions.fee().call(block_identifier=self.block)
-        return self._cache["fee"]
+        # owner can change it: not immutable
+        return self.call_function("fee")
 
     @property
-    def getBasePosition(self)->dict:
+    def getBasePosition(self)->hypervisor_position_record:
         """
          Returns:
-            dict:   { 
+            hypervisor_position_record:   { 
                 liquidity   28.7141300490401993
                 amount0     72.329994
                 amount1     56.5062023318300677907
                 }
          """
-        tmp =  self._contract.functions.getBasePosition().call(block_identifier=self.block)
-        return {    "liquidity":tmp[0],
-                    "amount0":tmp[1]/(10**self.token0.decimals),
-                    "amount1":tmp[2]/(10**self.token1.decimals),
-                }
+        tmp =  self.call_function("getBasePosition")
+        return hypervisor_position_record(liquidity=tmp[0],
+                                          amount0=tmp[1]/(10**self.token0.decimals),
+                                          amount1=tmp[2]/(10**self.token1.decimals),
+                                        )
     
     @property
-    def getLimitPosition(self)->dict:
+    def getLimitPosition(self)->hypervisor_position_record:
         """
          Returns:
-            dict:   { 
+            hypervisor_position_record:   { 
                 liquidity   28.7141300490401993
                 amount0     72.329994
                 amount1     56.5062023318300677907
                 }
          """
-        tmp = self._contract.functions.getLimitPosition().call(block_identifier=self.block)
-        return {    "liquidity":tmp[0],
-                    "amount0":tmp[1]/(10**self.token0.decimals),
-                    "amount1":tmp[2]/(10**self.token1.decimals),
-                }
+        tmp = self.call_function("getLimitPosition")
+        return hypervisor_position_record(liquidity=tmp[0],
+                                          amount0=tmp[1]/(10**self.token0.decimals),
+                                          amount1=tmp[2]/(10**self.token1.decimals),
+                                        )
     
     @property
-    def getTotalAmounts(self)->dict:
+    def getTotalAmounts(self)->total_amounts_record:
         """ _
 
          Returns:
-            _type_: total0   2.902086313
+            total_amounts_record: total0   2.902086313
                     total1  56.5062023318300678136
          """
-        tmp = self._contract.functions.getTotalAmounts().call(block_identifier=self.block)
-        return {"total0":tmp[0]/(10**self.token0.decimals),
-                "total1":tmp[1]/(10**self.token1.decimals),
-                }
+        tmp = self.call_function("getTotalAmounts")
+        return total_amounts_record(total0=tmp[0]/(10**self.token0.decimals),
+                                    total1=tmp[1]/(10**self.token1.decimals),
+                                    )
     
     @property
     def limitLower(self):
-        return self._contract.functions.limitLower().call(block_identifier=self.block)
+        return self.call_function("limitLower")
     
     @property
     def limitUpper(self):
-        return self._contract.functions.limitUpper().call(block_identifier=self.block)
+        return self.call_function("limitUpper")
     
     @property
     def maxTotalSupply(self)->int:
-        return self._contract.functions.maxTotalSupply().call(block_identifier=self.block)/(10**self.decimals)
+        return self.call_function("maxTotalSupply")/(10**self.decimals)
 
     @property
     def name(self)->str:
-        if not "name" in self._cache:
-            self._cache["name"] = self._contract.functions.name().call(block_identifier=self.block)
-        return self._cache["name"]
+        return self.call_immutable("name")
 
     def nonces(self, owner:str):
-        return self._contract.functions.nonces()(Web3.toChecksumAddress(owner)).call(block_identifier=self.block)
+        return self.call_function("nonces", Web3.toChecksumAddress(owner))
 
     @property
     def owner(self)->str:
-        return self._contract.functions.owner().call(block_identifier=self.block)
+        return self.call_function("owner")
 
     @property
     def pool(self)->str:
         if self._pool == None:
-            self._pool = univ3_pool(address=self._contract.functions.pool().call(block_identifier=self.block), web3Provider=self._w3)
+            self._pool = univ3_pool.shared(address=self.call_immutable("pool"), web3Provider=self._w3, block=self.block)
         return self._pool
 
     @property
     def tickSpacing(self)->int:
-        return self._contract.functions.tickSpacing().call(block_identifier=self.block)
+        return self.call_immutable("tickSpacing")
 
     @property
     def token0(self)->erc20:
         if self._token0 == None:
-            self._token0 = erc20(address=self._contract.functions.token0().call(block_identifier=self.block),
-                                 web3Provider=self._w3)
+            self._token0 = erc20.shared(address=self.call_immutable("token0"), web3Provider=self._w3, block=self.block)
         return self._token0
     
     @property
     def token1(self)->erc20:
         if self._token1 == None:
-            self._token1 = erc20(address=self._contract.functions.token1().call(block_identifier=self.block),
-                                 web3Provider=self._w3)
+            self._token1 = erc20.shared(address=self.call_immutable("token1"), web3Provider=self._w3, block=self.block)
         return self._token1
     
     @property
     def witelistedAddress(self)->str:
-        return self._contract.functions.witelistedAddress().call(block_identifier=self.block)
+        return self.call_function("witelistedAddress")
 
    # CUSTOM PROPERTIES
     @property
     def block(self):
         """ """
-        return self._block
+        return self._resolve_block()
 
     @block.setter
     def block(self, value):
+        # pool and tokens may be shared: get the ones at the new block
         self._block = value
-        self.pool.block = value
-        self.token0.block = value
-        self.token1.block = value
+        self._pool = None
+        self._token0 = None
+        self._token1 = None
+
+    def at_block(self, block:int)->"gamma_hypervisor":
+        result = super().at_block(block)
+        result._pool = None if self._pool == None else self._pool.at_block(block)
+        result._token0 = None if self._token0 == None else self._token0.at_block(block)
+        result._token1 = None if self._token1 == None else self._token1.at_block(block)
+        return result
 
 
    # CUSTOM FUNCTIONS
-    def tvl_price_fee(self)->dict:
-        """ Return Value locked, prices, uncollected and owed fees 
+    def prefetch_snapshot(self, multicall_address:str=MULTICALL3_ADDRESS, batch:bool=False):
+        """ Read everything tvl_price_fee needs at the current block using two Multicall3 aggregate3 calls
+            ( instead of ~25 separate eth_calls ), leaving the results in the call cache for the hypervisor, pool and token objects.
+
+         Args:
+            multicall_address (str, optional): Multicall3 contract address. Defaults to MULTICALL3_ADDRESS.
+            batch (bool, optional): use two JSON-RPC batch requests instead of Multicall3. Defaults to False.
+         """
+        multicall = rpc_batch() if batch else multicall3(address=multicall_address, web3Provider=self._w3, block=self.block)
+
+        # 1st round: hypervisor positions and addresses ( when not already known )
+        calls = [(self, x, ()) for x in ["pool", "token0", "token1"] if not self.has_immutable(x)]
+        calls += [(self, x, ()) for x in ["baseLower", "baseUpper", "limitLower", "limitUpper"]]
+        multicall.execute(calls)
+
+        # hypervisors are created with the pool's token pair: no need to ask the pool for its tokens
+        self.pool.prefetch("token0", (), self.token0.address)
+        self.pool.prefetch("token1", (), self.token1.address)
+
+        # 2nd round: pool and token state
+        calls = [(self.pool, x, ()) for x in ["slot0", "feeGrowthGlobal0X128", "feeGrowthGlobal1X128"]]
+        for tickLower, tickUpper in [(self.baseLower, self.baseUpper), (self.limitLower, self.limitUpper)]:
+            calls.append((self.pool, "positions", (self.pool.get_positionKey(ownerAddress=self.address, tickLower=tickLower, tickUpper=tickUpper),)))
+            calls.append((self.pool, "ticks", (tickLower,)))
+            calls.append((self.pool, "ticks", (tickUpper,)))
+        for token in [self.pool.token0, self.pool.token1]:
+            if not token.has_immutable("decimals"):
+                calls.append((token, "decimals", ()))
+            calls.append((token, "balanceOf", (self.address,)))
+        multicall.execute(calls)
+
+    def tvl_price_fee(self, multicall:bool=False, multicall_address:str=MULTICALL3_ADDRESS, batch:bool=False)->tvl_record:
+        """ Return Value locked, prices, uncollected and owed fees
+
+         Args:
+            multicall (bool, optional): read all needed data in batch using Multicall3 ( see prefetch_snapshot ). Defaults to False.
+            multicall_address (str, optional): Multicall3 contract address. Defaults to MULTICALL3_ADDRESS.
+            batch (bool, optional): read all needed data using JSON-RPC batch requests ( see prefetch_snapshot ). Defaults to False.
 
         Returns:
-            dict: {"qtty_token0": ,
+            tvl_record: {"qtty_token0": ,
                     "qtty_token1": ,
                     "price_token0": ,
                     "price_token1": ,
@@ -765,23 +1819,203 @@ class gamma_hypervisor(erc20):
                     "feesOwed_token0": ,
                     "feesOwed_token1": ,
                     }
-        """      
-        # UNISWAP positions  
+        """
+        if multicall or batch:
+            self.prefetch_snapshot(multicall_address=multicall_address, batch=batch)
+
+        # UNISWAP positions
         result = self.pool.get_tvlPriceFees(ownerAddress=self.address, tickUpper=self.baseUpper, tickLower=self.baseLower)
         limit = self.pool.get_tvlPriceFees(ownerAddress=self.address, tickUpper=self.limitUpper, tickLower=self.limitLower)
         # sumup position keys
-        for k in result.keys():
-            if not k in ["price_token0","price_token1"]:
-                result[k] += limit[k]
-            else:
-                result[k] += limit[k]
-                result[k] /= 2
+        result = sum_tvlPriceFees(base=result, limit=limit)
 
         # CONTRACT parked tokens (tvl)
         qttyParked_token0 = self.pool.token0.balanceOf(self.address)
         qttyParked_token1 = self.pool.token1.balanceOf(self.address)
-        result["qtty_token0"] += qttyParked_token0
-        result["qtty_token1"] += qttyParked_token1
 
         # return result
+        return result.replace(qtty_token0=result.qtty_token0 + qttyParked_token0, qtty_token1=result.qtty_token1 + qttyParked_token1)
+
+    def get_rebalances(self, fromBlock:int=0, toBlock:int=None):
+        """ Rebalance events of this hypervisor with amounts decimal adjusted
+
+         Args:
+            fromBlock (int, optional): Defaults to 0.
+            toBlock (int, optional): Defaults to this object's block.
+
+         Yields:
+            dict: {"block":, "logIndex":, "tick":, "totalAmount0":, "totalAmount1":, "feeAmount0":, "feeAmount1":, "totalSupply":}
+         """
+        toBlock = self.block if toBlock == None else toBlock
+        for event in self.get_events(["Rebalance"], fromBlock=fromBlock, toBlock=toBlock):
+            yield self._rebalance_row(event)
+
+    def rebalance_apr(self, window:int=100, fromBlock:int=0, usd_price=None)->float:
+        """ Fee APR of the last rebalances ( visor_v1 formula, see onchain_fleet.rebalance_apr )
+
+         Args:
+            window (int, optional): rebalances used. Defaults to 100.
+            fromBlock (int, optional): first block to look for rebalances. Defaults to 0.
+            usd_price (callable, optional): usd_price(token address, block)->float. Defaults to None ( values in token1 ).
+
+         Returns:
+            float: APR ( None with less than 2 rebalances )
+         """
+        import onchain_fleet
+
+        engine = onchain_fleet.rebalance_apr(hypervisors=[self], window=window, fromBlock=fromBlock, usd_price=usd_price)
+        engine.update(block=self.block)
+        return engine.apr(self.address)
+
+    def _rebalance_row(self, event)->dict:
+        """ Rebalance event decimal adjusted """
+        decimals0, decimals1 = self.pool.token0.decimals, self.pool.token1.decimals
+        return {"block":event.blockNumber, "logIndex":event.logIndex, "tick":event.args.tick,
+                "totalAmount0":event.args.totalAmount0/10**decimals0, "totalAmount1":event.args.totalAmount1/10**decimals1,
+                "feeAmount0":event.args.feeAmount0/10**decimals0, "feeAmount1":event.args.feeAmount1/10**decimals1,
+                "totalSupply":event.args.totalSupply/10**self.decimals}
+
+    def stream(self, ws_url:str, **kwargs):
+        """ tvl_price_fee changes pushed from WebSocket subscriptions, read only when this hypervisor or its pool emit events
+            ( see onchain_stream.hypervisor_stream )
+
+            async for delta in hypervisor.stream(ws_url="wss://..."):
+                print(delta["block"], delta["changed"])
+
+         Args:
+            ws_url (str): ws(s) endpoint of this hypervisor's chain
+
+         Returns:
+            async iterator of deltas
+         """
+        # websockets is only needed here
+        import onchain_stream
+
+        return onchain_stream.hypervisor_stream(hypervisors=[self], ws_url=ws_url, **kwargs).subscribe()
+
+    def history(self, blocks:list=None, timestamps:list=None, start_timestamp:int=None, end_timestamp:int=None, interval:int=86400,
+                max_workers:int=8, checkpoint:str=None, dataframe:bool=False,
+                multicall:bool=True, multicall_address:str=MULTICALL3_ADDRESS, batch:bool=False):
+        """ tvl_price_fee time series.
+            Each block is read by a copy of this object at that block ( see prefetch_snapshot ), immutable vars are read once for all,
+            blocks are read in parallel and, when a checkpoint file is set, each finished block is saved to it
+            so an interrupted history resumes where it was left.
+
+         Args:
+            blocks (list, optional): block numbers. Defaults to None.
+            timestamps (list, optional): when no blocks, the last block of each timestamp. Defaults to None.
+            start_timestamp (int, optional): when no blocks or timestamps, first timestamp of the series. Defaults to None.
+            end_timestamp (int, optional): last timestamp of the series. Defaults to this object's block timestamp.
+            interval (int, optional): seconds between start and end series timestamps. Defaults to 86400.
+            max_workers (int, optional): blocks read at the same time. Defaults to 8.
+            checkpoint (str, optional): file path to save finished blocks to and resume from ( one json per line ). Defaults to None.
+            dataframe (bool, optional): return a pandas DataFrame. Defaults to False.
+            multicall (bool, optional): read each block using Multicall3. Defaults to True.
+            multicall_address (str, optional): Multicall3 contract address. Defaults to MULTICALL3_ADDRESS.
+            batch (bool, optional): read each block using JSON-RPC batch requests. Defaults to False.
+
+         Returns:
+            record_table: columns {"block":[...], "timestamp":[...], "qtty_token0":[...], ... } ( see tvl_price_fee ) held in typed arrays
+                          ( see onchain_records.record_table ) or pandas.DataFrame
+         """
+        if blocks == None:
+            if timestamps == None:
+                if start_timestamp == None:
+                    raise ValueError(" Either blocks, timestamps or start_timestamp should be defined")
+                end_timestamp = self.timestampFromBlockNumber(self.block) if end_timestamp == None else end_timestamp
+                timestamps = list(range(int(start_timestamp), int(end_timestamp)+1, interval))
+            blocks = self.blockNumbersFromTimestamps(timestamps)
+        blocks = sorted(set(blocks))
+
+        # rows are stored in block order as they are read
+        result = record_table(snapshot_record, size=len(blocks))
+        positions = {block:i for i, block in enumerate(blocks)}
+        done = set()
+
+        # resume
+        if checkpoint != None and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                for line in f:
+                    if line.strip() != "":
+                        row = snapshot_record.from_dict(json.loads(line))
+                        if row.block in positions:
+                            result.set(positions[row.block], row)
+                            done.add(row.block)
+        pending = [x for x in blocks if not x in done]
+
+        # immutable vars of all objects, once
+        for token in [self.token0, self.token1, self.pool.token0, self.pool.token1]:
+            token.decimals
+
+        if len(pending) > 0:
+            logging.getLogger(__name__).debug(" reading {} blocks of hypervisor {} history ({} already in checkpoint)".format(len(pending), self.address, len(done)))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor, \
+                 (open(checkpoint, "a") if checkpoint != None else contextlib.nullcontext()) as f:
+                futures = [executor.submit(self._history_row, block, multicall, multicall_address, batch) for block in pending]
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        row = future.result()
+                        result.set(positions[row.block], row)
+                        if f != None:
+                            f.write(json.dumps(row.to_dict()) + "\n")
+                            f.flush()
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+        if dataframe:
+            return result.to_dataframe()
         return result
+
+    def _history_row(self, block:int, multicall:bool, multicall_address:str, batch:bool)->snapshot_record:
+        """ history row of a block """
+        hypervisor = self.at_block(block)
+        return snapshot_record(block=block, timestamp=self.timestampFromBlockNumber(block),
+                               **hypervisor.tvl_price_fee(multicall=multicall and not batch, multicall_address=multicall_address, batch=batch))
+
+
+class gamma_hypervisor_factory(web3wrap):
+    """ Creates hypervisors: lists them from its HypervisorCreated events """
+    _abi_filename = "hypervisor_factory"
+    _abi_path = "data/abi/gamma"
+
+    def get_hypervisors(self, fromBlock:int=0, toBlock:int=None)->list:
+        """ Hypervisors created by this factory.
+            When an event store is in use ( see use_event_store, off by default ) its events are kept there, so later calls only ask the node for new blocks
+
+         Args:
+            fromBlock (int, optional): factory creation block. Defaults to 0.
+            toBlock (int, optional): Defaults to this object's block.
+
+         Returns:
+            list: hypervisor addresses in creation order
+         """
+        toBlock = self.block if toBlock == None else toBlock
+        return [Web3.toChecksumAddress(x.args.hypervisor) for x in self.get_events(["HypervisorCreated"], fromBlock=fromBlock, toBlock=toBlock)]
+
+
+class gamma_hypervisor_registry(web3wrap):
+    """ Gamma registry of active hypervisors: lists them from its HypeAdded and HypeRemoved events """
+    _abi_filename = "hypervisor_registry"
+    _abi_path = "data/abi/gamma"
+
+    def get_hypervisors(self, fromBlock:int=0, toBlock:int=None)->list:
+        """ Hypervisors in the registry at toBlock ( see gamma_hypervisor_factory.get_hypervisors )
+
+         Args:
+            fromBlock (int, optional): registry creation block. Defaults to 0.
+            toBlock (int, optional): Defaults to this object's block.
+
+         Returns:
+            list: hypervisor addresses in registration order
+         """
+        toBlock = self.block if toBlock == None else toBlock
+        result = dict()
+        for event in self.get_events(["HypeAdded", "HypeRemoved"], fromBlock=fromBlock, toBlock=toBlock):
+            address = Web3.toChecksumAddress(event.args.hype)
+            if event.event == "HypeAdded":
+                result[address] = event.blockNumber
+            else:
+                result.pop(address, None)
+        return list(result.keys())
@@ -0,0 +1,364 @@
+import os
+import json
+import atexit
+import bisect
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# default local database used by the persistent stores
+SQLITE_FILENAME = "data/cache/onchain.sqlite"
+
+
+class _flight():
+    """ A call being executed by one thread that other threads wait for """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._error = None
+
+    def done(self, result):
+        self._result = result
+        self._event.set()
+
+    def fail(self, error:Exception):
+        self._error = error
+        self._event.set()
+
+    def wait(self):
+        self._event.wait()
+        if self._error != None:
+            raise self._error
+        return self._result
+
+
+class call_cache():
+    """ Thread safe LRU read-through cache with in-flight request coalescing (singleflight):
+        concurrent threads asking for the same key share one execution of the call.
+
+        Meant for calls pinned to a block ( key should contain the block ), which never change.
+    """
+
+    def __init__(self, maxsize:int=200000):
+        """
+         Args:
+            maxsize (int, optional): maximum number of items kept ( least recently used are evicted ). Defaults to 200000.
+         """
+        self._maxsize = maxsize
+        self._items = OrderedDict()
+        self._inflight = dict()
+        self._lock = threading.Lock()
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get_or_call(self, key, func):
+        """ Return the cached value of key or execute func to get it ( only once for concurrent callers )
+
+         Args:
+            key: hashable key
+            func (callable): no arguments function returning the value
+
+         Returns:
+            value
+         """
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            flight = self._inflight.get(key, None)
+            leader = flight == None
+            if leader:
+                flight = self._inflight[key] = _flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return flight.wait()
+
+        try:
+            result = func()
+        except Exception as e:
+            with self._lock:
+                del self._inflight[key]
+            flight.fail(e)
+            raise
+
+        with self._lock:
+            self._set(key, result)
+            del self._inflight[key]
+        flight.done(result)
+        return result
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+        return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = self.coalesced = 0
+
+    def __contains__(self, key)->bool:
+        with self._lock:
+            return key in self._items
+
+    def __len__(self)->int:
+        return len(self._items)
+
+    @property
+    def maxsize(self)->int:
+        return self._maxsize
+    @maxsize.setter
+    def maxsize(self, value:int):
+        with self._lock:
+            self._maxsize = value
+            self._evict()
+
+    def _set(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        while len(self._items) > self._maxsize:
+            self._items.popitem(last=False)
+
+
+class sqlite_store():
+    """ Base of the persistent stores: one lazily opened sqlite connection shared by threads
+        and buffered writes ( flushed every flush_every rows and at exit )
+    """
+
+    _tables = [] # create table statements
+    _insert = "" # insert statement of buffered rows
+
+    def __init__(self, filename:str=SQLITE_FILENAME, flush_every:int=100):
+        """
+         Args:
+            filename (str, optional): sqlite database file. Defaults to SQLITE_FILENAME.
+            flush_every (int, optional): pending rows written to disk at once. Defaults to 100.
+         """
+        self._filename = filename
+        self._flush_every = flush_every
+        self._connection = None
+        self._lock = threading.RLock()
+        self._pending = list()
+        atexit.register(self.flush)
+
+    @property
+    def filename(self)->str:
+        return self._filename
+
+    @property
+    def connection(self)->sqlite3.Connection:
+        if self._connection == None:
+            with self._lock:
+                if self._connection == None:
+                    if os.path.dirname(self._filename) != "":
+                        os.makedirs(os.path.dirname(self._filename), exist_ok=True)
+                    connection = sqlite3.connect(self._filename, check_same_thread=False)
+                    connection.execute("PRAGMA journal_mode=WAL")
+                    connection.execute("PRAGMA synchronous=NORMAL")
+                    for statement in self._tables:
+                        connection.execute(statement)
+                    connection.commit()
+                    self._connection = connection
+        return self._connection
+
+    def flush(self):
+        """ write pending rows to disk """
+        with self._lock:
+            if len(self._pending) > 0:
+                self.connection.executemany(self._insert, self._pending)
+                self.connection.commit()
+                self._pending = list()
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            if self._connection != None:
+                self._connection.close()
+                self._connection = None
+
+    def _write(self, row:tuple):
+        with self._lock:
+            self._pending.append(row)
+            if len(self._pending) >= self._flush_every:
+                self.flush()
+
+
+class metadata_store(sqlite_store):
+    """ Persistent store of contract values that never change once deployed ( decimals, symbol, token0, pool... )
+        Values are json encoded and saved by (chainId, address, field).
+    """
+
+    _tables = ["CREATE TABLE IF NOT EXISTS metadata (chain_id INTEGER, address TEXT, field TEXT, value TEXT, PRIMARY KEY (chain_id, address, field))"]
+    _insert = "INSERT OR REPLACE INTO metadata (chain_id, address, field, value) VALUES (?,?,?,?)"
+
+    def load(self, chain_id:int, address:str)->dict:
+        """ All values stored for a contract
+
+         Returns:
+            dict: {field: value}
+         """
+        with self._lock:
+            result = {field:json.loads(value) for field, value in self.connection.execute(
+                        "SELECT field, value FROM metadata WHERE chain_id=? AND address=?", (chain_id, address.lower())).fetchall()}
+            # not yet flushed values
+            for pending_chain_id, pending_address, field, value in self._pending:
+                if pending_chain_id == chain_id and pending_address == address.lower():
+                    result[field] = json.loads(value)
+        return result
+
+    def save(self, chain_id:int, address:str, field:str, value):
+        self._write((chain_id, address.lower(), field, json.dumps(value)))
+
+
+class block_index(sqlite_store):
+    """ Persistent sparse index of known (block, timestamp) pairs of each chain.
+        Kept in memory sorted by block ( timestamps are sorted too ) once a chain is first used.
+    """
+
+    _tables = ["CREATE TABLE IF NOT EXISTS blocks (chain_id INTEGER, block INTEGER, timestamp INTEGER, PRIMARY KEY (chain_id, block))"]
+    _insert = "INSERT OR REPLACE INTO blocks (chain_id, block, timestamp) VALUES (?,?,?)"
+
+    def __init__(self, filename:str=SQLITE_FILENAME, flush_every:int=100):
+        super().__init__(filename=filename, flush_every=flush_every)
+        self._chains = dict() # chainId: ([blocks], [timestamps])
+
+    def add(self, chain_id:int, block:int, timestamp:int):
+        with self._lock:
+            blocks, timestamps = self._chain(chain_id)
+            i = bisect.bisect_left(blocks, block)
+            if i < len(blocks) and blocks[i] == block:
+                return
+            blocks.insert(i, block)
+            timestamps.insert(i, timestamp)
+            self._write((chain_id, block, timestamp))
+
+    def timestamp(self, chain_id:int, block:int)->int:
+        """ Timestamp of a known block
+
+         Returns:
+            int: timestamp or None when not known
+         """
+        with self._lock:
+            blocks, timestamps = self._chain(chain_id)
+            i = bisect.bisect_left(blocks, block)
+            if i < len(blocks) and blocks[i] == block:
+                return timestamps[i]
+        return None
+
+    def anchors(self, chain_id:int, timestamp:int)->tuple:
+        """ Known blocks closest to a timestamp
+
+         Returns:
+            tuple: ( (block, timestamp) of the highest known block with timestamp <= the timestamp or None,
+                     (block, timestamp) of the lowest known block with timestamp > the timestamp or None )
+         """
+        with self._lock:
+            blocks, timestamps = self._chain(chain_id)
+            i = bisect.bisect_right(timestamps, timestamp)
+            lower = (blocks[i-1], timestamps[i-1]) if i > 0 else None
+            upper = (blocks[i], timestamps[i]) if i < len(blocks) else None
+        return lower, upper
+
+    def _chain(self, chain_id:int)->tuple:
+        if not chain_id in self._chains:
+            rows = self.connection.execute("SELECT block, timestamp FROM blocks WHERE chain_id=? ORDER BY block", (chain_id,)).fetchall()
+            self._chains[chain_id] = ([x[0] for x in rows], [x[1] for x in rows])
+        return self._chains[chain_id]
+
+
+class event_store(sqlite_store):
+    """ Persistent store of event logs by (chainId, address, topic0, block, logIndex)
+        and of the block range already synced for each (address, topic0).
+    """
+
+    _tables = ["CREATE TABLE IF NOT EXISTS logs (chain_id INTEGER, address TEXT, topic0 TEXT, block INTEGER, log_index INTEGER, transaction_index INTEGER, transaction_hash TEXT, block_hash TEXT, topics TEXT, data TEXT, PRIMARY KEY (chain_id, address, topic0, block, log_index))",
+               "CREATE TABLE IF NOT EXISTS logs_sync (chain_id INTEGER, address TEXT, topic0 TEXT, from_block INTEGER, to_block INTEGER, to_block_hash TEXT, PRIMARY KEY (chain_id, address, topic0))",
+               # logs saved with checksum addresses by older versions were never found
+               "UPDATE OR REPLACE logs SET address=lower(address), topic0=lower(topic0) WHERE address<>lower(address) OR topic0<>lower(topic0)"]
+    _fields = ["address", "topic0", "block", "log_index", "transaction_index", "transaction_hash", "block_hash", "topics", "data"]
+
+    def synced(self, chain_id:int, address:str, topic0:str)->tuple:
+        """ Block range stored for an address and event topic
+
+         Returns:
+            tuple: (from block, to block, to block hash) or None when nothing is stored
+         """
+        with self._lock:
+            return self.connection.execute("SELECT from_block, to_block, to_block_hash FROM logs_sync WHERE chain_id=? AND address=? AND topic0=?",
+                                            (chain_id, address.lower(), topic0.lower())).fetchone()
+
+    def save(self, chain_id:int, pairs:list, logs, fromBlock:int, toBlock:int, toBlock_hash:str=None):
+        """ Store all logs of a block range of (address, topic0) pairs and extend their synced ranges with it
+
+         Args:
+            chain_id (int):
+            pairs (list): of (address, topic0) synced
+            logs (iterable): of dict with keys as event_store._fields ( topics json encoded )
+            fromBlock (int):
+            toBlock (int):
+            toBlock_hash (str, optional): hash of toBlock, used to detect reorgs. Defaults to None.
+         """
+        pairs = [(address.lower(), topic0.lower()) for address, topic0 in pairs]
+        with self._lock:
+            try:
+                # keys stored lower case, as they are queried
+                self.connection.executemany("INSERT OR REPLACE INTO logs (chain_id, {}) VALUES (?,{})".format(", ".join(self._fields), ",".join(["?"]*len(self._fields))),
+                                            ((chain_id, x["address"].lower(), x["topic0"].lower(), *[x[k] for k in self._fields[2:]])
+                                                for x in logs if (x["address"].lower(), x["topic0"].lower()) in pairs))
+                for address, topic0 in pairs:
+                    state = self.synced(chain_id=chain_id, address=address, topic0=topic0)
+                    if state == None:
+                        state = (fromBlock, toBlock, toBlock_hash)
+                    elif fromBlock <= state[1]+1 and toBlock >= state[0]-1:
+                        # contiguous
+                        state = (min(fromBlock, state[0]),
+                                 max(toBlock, state[1]),
+                                 toBlock_hash if toBlock >= state[1] else state[2])
+                    else:
+                        continue
+                    self.connection.execute("INSERT OR REPLACE INTO logs_sync (chain_id, address, topic0, from_block, to_block, to_block_hash) VALUES (?,?,?,?,?,?)",
+                                            (chain_id, address, topic0, *state))
+                self.connection.commit()
+            except:
+                self.connection.rollback()
+                raise
+
+    def rollback(self, chain_id:int, address:str, topic0:str, block:int):
+        """ Remove logs after a block ( chain reorganization ) """
+        with self._lock:
+            self.connection.execute("DELETE FROM logs WHERE chain_id=? AND address=? AND topic0=? AND block>?", (chain_id, address.lower(), topic0.lower(), block))
+            self.connection.execute("UPDATE logs_sync SET to_block=?, to_block_hash=NULL WHERE chain_id=? AND address=? AND topic0=?", (block, chain_id, address.lower(), topic0.lower()))
+            self.connection.execute("DELETE FROM logs_sync WHERE chain_id=? AND address=? AND topic0=? AND to_block<from_block", (chain_id, address.lower(), topic0.lower()))
+            self.connection.commit()
+
+    def logs(self, chain_id:int, addresses:list, topic0s:list, fromBlock:int, toBlock:int):
+        """ Stored logs in block order
+
+         Yields:
+            dict: with keys as event_store._fields
+         """
+        addresses = [x.lower() for x in addresses]
+        topic0s = [x.lower() for x in topic0s]
+        with self._lock:
+            rows = self.connection.execute("SELECT {} FROM logs WHERE chain_id=? AND address IN ({}) AND topic0 IN ({}) AND block BETWEEN ? AND ? ORDER BY block, log_index".format(
+                                                ", ".join(self._fields), ",".join(["?"]*len(addresses)), ",".join(["?"]*len(topic0s))),
+                                            (chain_id, *addresses, *topic0s, fromBlock, toBlock)).fetchall()
+        for row in rows:
+            yield dict(zip(self._fields, row))
@@ -0,0 +1,379 @@
+import sys
+import json
+import time
+import queue
+import logging
+import argparse
+import threading
+import concurrent.futures
+
+from web3 import Web3
+
+import onchain_rpc
+import onchain_metrics
+from onchain_pricing import usd_pricer
+from onchain_fleet import CHAIN_IDS, discover_hypervisors, rebalance_apr, adaptor_row
+from onchain_analysis_base import gamma_hypervisor, univ3_pool, multicall3, MULTICALL3_ADDRESS
+
+
+# end of a stage's input or output
+_done = object()
+
+
+class _failure():
+    """ error raised by a stage's input, passed on to its consumer """
+
+    def __init__(self, error:Exception):
+        self.error = error
+
+
+class _finished():
+    """ end of a merge source """
+
+    def __init__(self, name:str):
+        self.name = name
+
+
+def _put(target:queue.Queue, item, stop:threading.Event)->bool:
+    """ put that blocks while the queue is full and gives up once stop is set ( consumer gone ) """
+    while not stop.is_set():
+        try:
+            target.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+# PIPELINE
+def stage(items, func, workers:int=4, queue_size:int=None):
+    """ Apply func to items in worker threads, yielding results as they finish ( not in items order ).
+        Items are pulled and results pushed through bounded queues, so a stage never runs more than queue_size items
+        ahead of its consumer. None results are dropped and items raising are logged and dropped,
+        so one failing item does not stop the others. Stages are chained by passing a stage as the items of the next one.
+
+        snapshots = stage(hypervisors, lambda hv: (hv, hv.tvl_price_fee()), workers=8)
+        rows = stage(snapshots, enrich, workers=2)
+
+     Args:
+        items (iterable): stage input ( consumed in a thread )
+        func (callable): func(item)->result
+        workers (int, optional): items processed at the same time. Defaults to 4.
+        queue_size (int, optional): items waiting in each queue. Defaults to 2 * workers.
+
+     Yields:
+        func results
+     """
+    queue_size = 2 * workers if queue_size == None else queue_size
+    inputs = queue.Queue(maxsize=queue_size)
+    outputs = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def feed():
+        try:
+            for item in items:
+                if not _put(inputs, item, stop):
+                    break
+        except Exception as e:
+            _put(outputs, _failure(e), stop)
+        finally:
+            # stop upstream stages when this one was closed early
+            if stop.is_set() and hasattr(items, "close"):
+                items.close()
+            for _ in range(workers):
+                _put(inputs, _done, stop)
+
+    def work():
+        while not stop.is_set():
+            try:
+                item = inputs.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _done:
+                break
+            try:
+                result = func(item)
+            except Exception as e:
+                logging.getLogger(__name__).error(" {} failed on {}: {}".format(getattr(func, "__name__", "stage"), getattr(item, "address", item), e))
+                continue
+            if result is not None:
+                _put(outputs, result, stop)
+        _put(outputs, _done, stop)
+
+    threads = [threading.Thread(target=feed, daemon=True)] + [threading.Thread(target=work, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    finished = 0
+    try:
+        while finished < workers:
+            result = outputs.get()
+            if result is _done:
+                finished += 1
+            elif isinstance(result, _failure):
+                raise result.error
+            else:
+                yield result
+    finally:
+        stop.set()
+
+
+def merge(sources:dict, queue_size:int=64, timeout:float=None):
+    """ Yield the items of several iterables as they come, each one consumed in its own thread.
+        Sources raising, or not finished within timeout, are logged and left out from that point.
+
+     Args:
+        sources (dict): {name: iterable}
+        queue_size (int, optional): items waiting to be consumed. Defaults to 64.
+        timeout (float, optional): seconds for all sources. Defaults to None ( no limit ).
+
+     Yields:
+        source items
+     """
+    deadline = None if timeout == None else time.monotonic() + timeout
+    outputs = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def consume(name:str, items):
+        try:
+            for item in items:
+                if not _put(outputs, item, stop):
+                    break
+        except Exception as e:
+            logging.getLogger(__name__).error(" {} failed: {}".format(name, e))
+        finally:
+            if stop.is_set() and hasattr(items, "close"):
+                items.close()
+            _put(outputs, _finished(name), stop)
+
+    threads = {name:threading.Thread(target=consume, args=(name, items), daemon=True) for name, items in sources.items()}
+    for thread in threads.values():
+        thread.start()
+    pending = set(threads.keys())
+    try:
+        while len(pending) > 0:
+            try:
+                item = outputs.get(timeout=None if deadline == None else max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                logging.getLogger(__name__).error(" {} did not finish in {} seconds".format(sorted(pending), timeout))
+                break
+            if isinstance(item, _finished):
+                pending.discard(item.name)
+            else:
+                yield item
+    finally:
+        stop.set()
+
+
+# SINKS
+# adaptor row fields ( see onchain_fleet.adaptor_row )
+ADAPTOR_FIELDS = ["pool", "chain", "project", "symbol", "tvlUsd", "apyBase", "underlyingTokens", "poolMeta"]
+
+
+class ndjson_sink():
+    """ Writes rows as one JSON object per line, flushed as they come ( path "-" writes to stdout ) """
+
+    def __init__(self, path:str):
+        self.path = path
+        self.rows = 0
+        self._file = sys.stdout if path == "-" else open(path, "w")
+
+    def write(self, row:dict):
+        self._file.write(json.dumps(row) + "\n")
+        self._file.flush()
+        self.rows += 1
+
+    def close(self):
+        if self._file is not sys.stdout:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class parquet_sink():
+    """ Writes adaptor rows to a Parquet file, one row group every row_group_size rows ( needs the pyarrow package ) """
+
+    def __init__(self, path:str, row_group_size:int=1000):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError(" parquet_sink needs the pyarrow package ( pip install pyarrow )") from e
+        self.path = path
+        self.rows = 0
+        self.row_group_size = row_group_size
+        self._pa = pa
+        self._schema = pa.schema([("pool", pa.string()), ("chain", pa.string()), ("project", pa.string()), ("symbol", pa.string()),
+                                  ("tvlUsd", pa.float64()), ("apyBase", pa.float64()), ("underlyingTokens", pa.list_(pa.string())),
+                                  ("poolMeta", pa.string())])
+        self._writer = pq.ParquetWriter(path, self._schema)
+        self._buffer = list()
+
+    def write(self, row:dict):
+        self._buffer.append(row)
+        self.rows += 1
+        if len(self._buffer) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._buffer) > 0:
+            columns = {name:[row[name] for row in self._buffer] for name in ADAPTOR_FIELDS}
+            self._writer.write_table(self._pa.Table.from_pydict(columns, schema=self._schema))
+            self._buffer = list()
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_sink(path:str, format:str=None):
+    """ ndjson_sink or parquet_sink
+
+     Args:
+        path (str): output file ( "-" for stdout )
+        format (str, optional): "ndjson" or "parquet". Defaults to the path extension ( ndjson when not .parquet ).
+     """
+    format = ("parquet" if path.endswith(".parquet") else "ndjson") if format == None else format
+    if format == "parquet":
+        return parquet_sink(path)
+    if format == "ndjson":
+        return ndjson_sink(path)
+    raise ValueError(" unknown export format {}".format(format))
+
+
+# ADAPTOR EXPORT
+def _snapshot(hypervisor:gamma_hypervisor, multicall_address:str):
+    """ (hypervisor, tvl_price_fee) of a hypervisor with supply ( None without ) """
+    multicall = multicall3(address=multicall_address, web3Provider=hypervisor.w3, block=hypervisor.block)
+    multicall.execute([(hypervisor, "pool", ()), (hypervisor, "totalSupply", ())])
+    if hypervisor.call_function("totalSupply") == 0:
+        return None
+    snapshot = hypervisor.tvl_price_fee(multicall=True, multicall_address=multicall_address)
+    # adaptor row metadata
+    multicall.execute([(hypervisor.pool.token0, "symbol", ()), (hypervisor.pool.token1, "symbol", ()), (hypervisor.pool, "fee", ())])
+    return hypervisor, snapshot
+
+def _chain_prices(hypervisors:list, config:dict, multicall_address:str, block:int)->dict:
+    """ usd prices at block of the tokens routed through the pools of all hypervisors and the config pricing pools ( see onchain_pricing.usd_pricer ) """
+    w3 = hypervisors[0].w3
+    multicall = multicall3(address=multicall_address, web3Provider=w3, block=block)
+    multicall.execute([(hv, "pool", ()) for hv in hypervisors])
+    pools = [hv.pool for hv in hypervisors] + [univ3_pool(address=x, web3Provider=w3, block=block) for x in config.get("pricing_pools", [])]
+    multicall.execute([(pool, function_name, ()) for pool in pools for function_name in ["token0", "token1"]])
+    pricer = usd_pricer(pools=pools, usd_tokens=config.get("usd_tokens", []), multicall_address=multicall_address)
+    return pricer.prices(block=block)
+
+def export_chain(chain:str, config:dict, multicall_address:str=MULTICALL3_ADDRESS, snapshot_workers:int=8, enrich_workers:int=2, queue_size:int=None):
+    """ Stream the adaptor rows of a chain's hypervisors with supply as each one is ready ( rows of onchain_fleet.scan_chain, unsorted ):
+            discovered hypervisors -> tvl_price_fee ( snapshot_workers at a time ) -> usd tvl and APR ( enrich_workers at a time ) -> rows
+        USD prices and APRs are read once for the whole chain ( see onchain_pricing.usd_pricer and onchain_fleet.rebalance_apr )
+        while the first snapshots are read.
+
+     Args:
+        chain (str): defillama chain name, like "ethereum"
+        config (dict): scan_chain config
+        multicall_address (str, optional): Multicall3 contract address. Defaults to MULTICALL3_ADDRESS.
+        snapshot_workers (int, optional): hypervisors read at the same time. Defaults to 8.
+        enrich_workers (int, optional): snapshots valued at the same time. Defaults to 2.
+        queue_size (int, optional): items waiting between stages. Defaults to 2 * stage workers.
+
+     Yields:
+        dict: {"pool":, "chain":, "project":, "symbol":, "tvlUsd":, "apyBase":, "underlyingTokens":, "poolMeta":}
+     """
+    w3 = Web3(onchain_rpc.get_router(config["rpc"]))
+    block = onchain_metrics.metrics.measure(lambda: w3.eth.block_number, kind="rpc", contract=None, function="eth_blockNumber")
+    chain_id = onchain_metrics.metrics.measure(lambda: w3.eth.chain_id, kind="rpc", contract=None, function="eth_chainId")
+    if CHAIN_IDS.get(chain, chain_id) != chain_id:
+        raise ValueError(" {} rpc is connected to chain id {}".format(chain, chain_id))
+    addresses = discover_hypervisors(w3=w3, factories=config.get("factories", None), registries=config.get("registries", None), block=block)
+    logging.getLogger(__name__).info(" {} hypervisors found on {} at block {}".format(len(addresses), chain, block))
+    if len(addresses) == 0:
+        return
+    hypervisors = [gamma_hypervisor(address=x, web3Provider=w3, block=block) for x in addresses]
+
+    # no rebalance can be older than the hypervisor factories or registries
+    fromBlock = min([x.get("block", 0) for x in config.get("factories", []) + config.get("registries", [])] or [0])
+    side = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    try:
+        prices = side.submit(_chain_prices, hypervisors, config, multicall_address, block)
+        aprs = side.submit(lambda: rebalance_apr(hypervisors=hypervisors, fromBlock=fromBlock).update(block=block))
+
+        def snapshot(hypervisor:gamma_hypervisor):
+            return _snapshot(hypervisor, multicall_address)
+
+        def valued(snapshots):
+            # chain wide prices and APRs failing fail the chain ( instead of every row )
+            try:
+                for i, item in enumerate(snapshots):
+                    if i == 0:
+                        prices.result()
+                        aprs.result()
+                    yield item
+            finally:
+                snapshots.close()
+
+        def enrich(item):
+            hypervisor, snapshot = item
+            return adaptor_row(chain=chain, hypervisor=hypervisor, snapshot=snapshot, prices=prices.result(), apr=aprs.result()[hypervisor.address])
+
+        snapshots = stage(hypervisors, snapshot, workers=snapshot_workers, queue_size=queue_size)
+        yield from stage(valued(snapshots), enrich, workers=enrich_workers, queue_size=queue_size)
+    finally:
+        side.shutdown(wait=False)
+
+def export_fleet(config:dict, path:str, format:str=None, timeout:float=None, multicall_address:str=MULTICALL3_ADDRESS,
+                 snapshot_workers:int=8, enrich_workers:int=2, queue_size:int=None)->int:
+    """ Write the adaptor rows of several chains to NDJSON or Parquet as they are ready ( see export_chain ): chains are read at the same time,
+        memory does not grow with the fleet and a slow hypervisor or chain does not hold back the others.
+        Chains failing, or not finished within timeout, are left out from that point.
+
+     Args:
+        config (dict): {chain: scan_chain config, ...}
+        path (str): output file ( "-" for stdout )
+        format (str, optional): "ndjson" or "parquet". Defaults to the path extension.
+        timeout (float, optional): seconds for the whole export. Defaults to None ( no limit ).
+        multicall_address (str, optional): Multicall3 contract address. Defaults to MULTICALL3_ADDRESS.
+        snapshot_workers (int, optional): hypervisors of each chain read at the same time. Defaults to 8.
+        enrich_workers (int, optional): snapshots of each chain valued at the same time. Defaults to 2.
+        queue_size (int, optional): items waiting between stages. Defaults to 2 * stage workers.
+
+     Returns:
+        int: rows written
+     """
+    start = time.monotonic()
+    sources = {chain:export_chain(chain=chain, config=chain_config, multicall_address=multicall_address,
+                                  snapshot_workers=snapshot_workers, enrich_workers=enrich_workers, queue_size=queue_size)
+               for chain, chain_config in config.items()}
+    with open_sink(path, format=format) as sink:
+        for row in merge(sources, timeout=timeout):
+            if sink.rows == 0:
+                logging.getLogger(__name__).info(" first row exported in {:.2f} seconds".format(time.monotonic() - start))
+            sink.write(row)
+    logging.getLogger(__name__).info(" {} rows exported to {} in {:.2f} seconds".format(sink.rows, path, time.monotonic() - start))
+    return sink.rows
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    parser = argparse.ArgumentParser(description="Stream defillama adaptor rows of the hypervisor fleet to NDJSON or Parquet")
+    parser.add_argument("config", help="fleet config json file ( see onchain_fleet.scan_chain )")
+    parser.add_argument("output", help="output file: .ndjson, .parquet or - for stdout")
+    parser.add_argument("--format", default=None, choices=["ndjson", "parquet"], help="defaults to the output extension")
+    parser.add_argument("--timeout", type=float, default=None, help="seconds for the whole export")
+    parser.add_argument("--snapshot-workers", type=int, default=8, help="hypervisors of each chain read at the same time")
+    parser.add_argument("--enrich-workers", type=int, default=2, help="snapshots of each chain valued at the same time")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        fleet_config = json.load(f)
+    export_fleet(config=fleet_config, path=args.output, format=args.format, timeout=args.timeout,
+                 snapshot_workers=args.snapshot_workers, enrich_workers=args.enrich_workers)
@@ -0,0 +1,488 @@
+import sys
+import json
+import math
+import time
+import logging
+import multiprocessing
+from collections import deque
+
+from web3 import Web3
+
+import onchain_rpc
+from onchain_pricing import usd_pricer
+from onchain_analysis_base import web3wrap, univ3_pool, gamma_hypervisor, gamma_hypervisor_factory, gamma_hypervisor_registry, multicall3, rpc_batch, MULTICALL3_ADDRESS
+
+
+# defillama chain names ( see defillama_gamma_adaptors )
+CHAIN_IDS = {"ethereum":1, "optimism":10, "polygon":137, "arbitrum":42161, "celo":42220}
+
+
+class hypervisor_refresher():
+    """ Keeps the last tvl_price_fee snapshot of many hypervisors of one chain and moves them to newer blocks
+        reading only what the hypervisor and pool events of the block delta made stale:
+            pool Swap: slot0 and fee growth ( and the hypervisor range ticks when the swaps crossed them )
+            hypervisor Deposit, Withdraw and pool Mint, Burn, Collect of the hypervisor: positions and parked balances
+            hypervisor Rebalance: everything
+        Everything else is carried from the last snapshot, so RPC use follows on-chain activity instead of fleet size.
+        ( parked balances changed by plain token transfers to the hypervisor are not detected )
+
+        refresher = hypervisor_refresher(hypervisors=[gamma_hypervisor(address=x, web3Provider=w3) for x in addresses])
+        while True:
+            results = refresher.refresh()
+    """
+
+    _hypervisor_events = ["Deposit", "Withdraw", "Rebalance"]
+    _pool_events = ["Swap", "Mint", "Burn", "Collect"]
+
+    def __init__(self, hypervisors:list, multicall_address:str=MULTICALL3_ADDRESS, batch:bool=False):
+        """
+         Args:
+            hypervisors (list): of gamma_hypervisor objects sharing the same provider
+            multicall_address (str, optional): Multicall3 contract address. Defaults to MULTICALL3_ADDRESS.
+            batch (bool, optional): use JSON-RPC batch requests instead of Multicall3. Defaults to False.
+         """
+        self.hypervisors = {hv.address:hv for hv in hypervisors}
+        # create pool and token objects once ( block copies share them )
+        for hv in hypervisors:
+            hv.pool.token0, hv.pool.token1
+        self.multicall_address = multicall_address
+        self.batch = batch
+
+        self.block = None
+        # address: tvl_price_fee result at self.block
+        self.results = dict()
+        # address: {group: [(role, function name, args, value), ...]} read at self.block
+        self._values = dict()
+
+        # hypervisors and pools event topics: (role, event name)
+        self._topics = dict()
+        for hypervisor in hypervisors[:1]:
+            for role, wrapper, event_names in [("hypervisor", hypervisor, self._hypervisor_events), ("pool", hypervisor.pool, self._pool_events)]:
+                abi_events = [x.get("name", "") for x in wrapper._abi if x.get("type", "") == "event"]
+                for event_name in event_names:
+                    if event_name in abi_events:
+                        self._topics[wrapper.event_topic(event_name)] = (role, event_name)
+
+    def refresh(self, block:int=None, logs:list=None)->dict:
+        """ Move all snapshots to block
+
+         Args:
+            block (int, optional): Defaults to the chain's last block.
+            logs (list, optional): hypervisor and pool event logs of the block delta ( see log_filter ), when already known.
+                                   Defaults to None ( read with get_chunked_events ).
+
+         Returns:
+            dict: {hypervisor address: tvl_price_fee result}
+         """
+        any_hypervisor = next(iter(self.hypervisors.values()))
+        if block == None:
+            block = any_hypervisor._measure(lambda: any_hypervisor.w3.eth.block_number, kind="rpc", function="eth_blockNumber")
+        if self.block != None and block <= self.block:
+            return self.results
+
+        stale = self._stale_groups(block, logs=logs)
+        hypervisors = {address:hv.at_block(block) for address, hv in self.hypervisors.items()}
+        executor = rpc_batch() if self.batch else multicall3(address=self.multicall_address, web3Provider=any_hypervisor.w3, block=block)
+
+        # carry what did not change
+        for address, groups in self._values.items():
+            for group, values in groups.items():
+                if not group in stale[address]:
+                    roles = self._roles(hypervisors[address])
+                    for role, function_name, args, value in values:
+                        roles[role].prefetch(function_name, args, value)
+
+        # read what did
+        executor.execute([call for address, groups in stale.items() if "ranges" in groups
+                                for call in self._group_calls(hypervisors[address], "ranges")])
+        executor.execute([call for address, groups in stale.items()
+                                for group in groups if group != "ranges"
+                                for call in self._group_calls(hypervisors[address], group)])
+        logging.getLogger(__name__).debug(" refreshing {} hypervisors to block {}: {} with stale data".format(
+                    len(hypervisors), block, len([x for x in stale.values() if len(x) > 0])))
+
+        # snapshots ( from the call cache )
+        for address, hv in hypervisors.items():
+            if len(stale[address]) > 0 or not address in self.results:
+                self.results[address] = hv.tvl_price_fee()
+            roles = self._roles(hv)
+            self._values[address] = {group:[(role, function_name, args, roles[role].call_function(function_name, *args))
+                                            for role, function_name, args in self._group_calls(hv, group, roles=True)]
+                                     for group in ["ranges", "pool", "positions", "ticks"]}
+        self.block = block
+        return self.results
+
+    def invalidate(self, addresses:list=None):
+        """ Read everything of these hypervisors again on the next refresh
+
+         Args:
+            addresses (list, optional): hypervisor or pool addresses. Defaults to None ( all ).
+         """
+        addresses = None if addresses == None else set(x.lower() for x in addresses)
+        for address, hv in self.hypervisors.items():
+            if addresses == None or address.lower() in addresses or hv.pool.address.lower() in addresses:
+                self._values.pop(address, None)
+
+    def log_filter(self)->dict:
+        """ addresses and topics of the events making snapshots stale
+
+         Returns:
+            dict: {"address": [hypervisor and pool addresses], "topics": [[event topics]]}
+         """
+        pools = {hv.pool.address.lower():hv.pool.address for hv in self.hypervisors.values()}
+        return {"address":list(self.hypervisors.keys()) + list(pools.values()), "topics":[list(self._topics.keys())]}
+
+   # HELPERS
+    def _roles(self, hv:gamma_hypervisor)->dict:
+        return {"hypervisor":hv, "pool":hv.pool, "token0":hv.pool.token0, "token1":hv.pool.token1}
+
+    def _group_calls(self, hv:gamma_hypervisor, group:str, roles:bool=False)->list:
+        """ reads tvl_price_fee makes, by group
+
+         Returns:
+            list: [ (wrapper, function name, args), ...] or [ (role, function name, args), ...]
+         """
+        if group == "ranges":
+            calls = [("hypervisor", x, ()) for x in ["baseLower", "baseUpper", "limitLower", "limitUpper"]]
+        elif group == "pool":
+            calls = [("pool", x, ()) for x in ["slot0", "feeGrowthGlobal0X128", "feeGrowthGlobal1X128"]]
+        elif group == "positions":
+            calls = [("pool", "positions", (hv.pool.get_positionKey(ownerAddress=hv.address, tickLower=tickLower, tickUpper=tickUpper),))
+                            for tickLower, tickUpper in [(hv.baseLower, hv.baseUpper), (hv.limitLower, hv.limitUpper)]]
+            calls += [(x, "balanceOf", (Web3.toChecksumAddress(hv.address),)) for x in ["token0", "token1"]]
+        elif group == "ticks":
+            calls = [("pool", "ticks", (x,)) for x in [hv.baseLower, hv.baseUpper, hv.limitLower, hv.limitUpper]]
+        else:
+            raise ValueError(" unknown group {}".format(group))
+        if roles:
+            return calls
+        wrappers = self._roles(hv)
+        return [(wrappers[role], function_name, args) for role, function_name, args in calls]
+
+    def _stale_groups(self, block:int, logs:list=None)->dict:
+        """ Groups of reads changed since self.block, from the events of the block delta
+
+         Returns:
+            dict: {hypervisor address: set of groups}
+         """
+        everything = {"ranges", "pool", "positions", "ticks"}
+        if self.block == None:
+            return {address:set(everything) for address in self.hypervisors.keys()}
+        stale = {address:set(x for x in everything if not x in self._values.get(address, {})) for address in self.hypervisors.keys()}
+
+        # hypervisors by pool
+        pools = dict()
+        for address, hv in self.hypervisors.items():
+            pools.setdefault(hv.pool.address.lower(), list()).append(address)
+        addresses = {x.lower():x for x in self.hypervisors.keys()}
+        # current tick of each pool, to find crossed range ticks
+        ticks = {pool:next((self._value(x, "pool", "slot0")[1] for x in hypervisors if x in self._values), None) for pool, hypervisors in pools.items()}
+
+        if logs == None:
+            any_hypervisor = next(iter(self.hypervisors.values()))
+            logs = any_hypervisor.get_chunked_events({"fromBlock":self.block+1, "toBlock":block, **self.log_filter()})
+        for log in logs:
+            # logs of events not followed ( given logs may come from a wider filter )
+            if len(log["topics"]) == 0 or not Web3.toHex(log["topics"][0]) in self._topics:
+                continue
+            role, event_name = self._topics[Web3.toHex(log["topics"][0])]
+            emitter = log["address"].lower()
+            if role == "hypervisor":
+                if emitter in addresses:
+                    stale[addresses[emitter]] |= everything if event_name == "Rebalance" else {"positions"}
+                continue
+            if not emitter in pools:
+                continue
+
+            pool = self.hypervisors[pools[emitter][0]].pool
+            event = pool._contract.events[event_name]().processLog(log)
+            if event_name == "Swap":
+                for address in pools[emitter]:
+                    stale[address].add("pool")
+                    if not address in self._values or ticks[emitter] == None:
+                        stale[address] |= everything
+                        continue
+                    # swaps crossing a range tick change its fee growth outside
+                    range_ticks = [x[3] for x in self._values[address]["ranges"]]
+                    if any((ticks[emitter] >= x) != (event.args.tick >= x) for x in range_ticks):
+                        stale[address].add("ticks")
+                ticks[emitter] = event.args.tick
+            elif event.args.owner.lower() in addresses:
+                stale[addresses[event.args.owner.lower()]].add("positions")
+        return stale
+
+    def _value(self, address:str, group:str, function_name:str):
+        """ value read at self.block """
+        return next(x[3] for x in self._values[address][group] if x[1] == function_name)
+
+
+class rebalance_apr():
+    """ Fee APR of many hypervisors from their last rebalances ( visor_v1 formula, see defillama_gamma_adaptors/README.md ):
+            APR = yearly fees / average TVL
+            yearly fees = sum of rebalance fees / seconds between the first and last rebalance of the window * seconds in a year
+            average TVL = ( sum of rebalance total amounts - sum of fees ) / rebalances ( fees not subtracted when higher )
+        Each update reads the Rebalance events of the whole fleet since the last one in a single get_chunked_events pass
+        and slides each hypervisor window keeping its sums, added to as rebalances come and summed again exactly ( math.fsum )
+        when old ones leave, so that they do not drift over an unbounded stream.
+
+        engine = rebalance_apr(hypervisors=[gamma_hypervisor(address=x, web3Provider=w3) for x in addresses], fromBlock=GAMMA_START_BLOCK)
+        aprs = engine.update()
+    """
+
+    _year = 60*60*24*365
+
+    def __init__(self, hypervisors:list, window:int=100, fromBlock:int=0, usd_price=None):
+        """
+         Args:
+            hypervisors (list): of gamma_hypervisor objects sharing the same provider
+            window (int, optional): rebalances used. Defaults to 100.
+            fromBlock (int, optional): first block to look for rebalances. Defaults to 0.
+            usd_price (callable, optional): usd_price(token address, block)->float used to value rebalances.
+                                            Defaults to None ( valued in token1 at the rebalance tick: APR does not depend on the unit ).
+         """
+        self.hypervisors = {hv.address:hv for hv in hypervisors}
+        self.window = window
+        self.usd_price = usd_price
+        # last block read
+        self.block = fromBlock - 1
+
+        # address: last rebalances [ {"block":, "timestamp":, "totalAmountUSD":, "grossFeesUSD":}, ...]
+        self._windows = {address:deque() for address in self.hypervisors.keys()}
+        # address: [ sum of totalAmountUSD, sum of grossFeesUSD ] of the window
+        self._sums = {address:[0.0, 0.0] for address in self.hypervisors.keys()}
+
+    def update(self, block:int=None)->dict:
+        """ Add the rebalances up to block
+
+         Args:
+            block (int, optional): Defaults to the chain's last block.
+
+         Returns:
+            dict: {hypervisor address: APR} ( see aprs )
+         """
+        any_hypervisor = next(iter(self.hypervisors.values()))
+        if block == None:
+            block = any_hypervisor._measure(lambda: any_hypervisor.w3.eth.block_number, kind="rpc", function="eth_blockNumber")
+        if block <= self.block:
+            return self.aprs()
+
+        # new rebalances of each hypervisor ( only the last window ones matter )
+        addresses = {x.lower():x for x in self.hypervisors.keys()}
+        eventfilter = {"fromBlock":self.block+1, "toBlock":block, "address":list(self.hypervisors.keys()),
+                       "topics":[[any_hypervisor.event_topic("Rebalance")]]}
+        new = {address:deque(maxlen=self.window) for address in self.hypervisors.keys()}
+        for log in any_hypervisor.get_chunked_events(eventfilter):
+            address = addresses.get(log["address"].lower(), None)
+            if address != None:
+                hv = self.hypervisors[address]
+                new[address].append(hv._rebalance_row(hv._contract.events.Rebalance().processLog(log)))
+
+        rows = [(address, row) for address, items in new.items() for row in items]
+        blocks = sorted(set(row["block"] for address, row in rows))
+        timestamps = dict(zip(blocks, any_hypervisor.timestampsFromBlockNumbers(blocks)))
+        for address, row in rows:
+            self._add(address=address, row=row, timestamp=timestamps[row["block"]])
+
+        logging.getLogger(__name__).debug(" {} rebalances of {} hypervisors added up to block {}".format(len(rows), len(self.hypervisors), block))
+        self.block = block
+        return self.aprs()
+
+    def apr(self, address:str)->float:
+        """ APR of a hypervisor window
+
+         Returns:
+            float: None with less than 2 rebalances
+         """
+        window = self._windows[Web3.toChecksumAddress(address)]
+        if len(window) < 2:
+            return None
+        aggregated_tvl, aggregated_fees = self._sums[Web3.toChecksumAddress(address)]
+        seconds_passed = window[-1]["timestamp"] - window[0]["timestamp"]
+        average_tvl = (aggregated_tvl - aggregated_fees if aggregated_tvl > aggregated_fees else aggregated_tvl)/len(window)
+        if seconds_passed <= 0 or average_tvl <= 0:
+            return None
+        return (aggregated_fees/seconds_passed*self._year)/average_tvl
+
+    def aprs(self)->dict:
+        """
+         Returns:
+            dict: {hypervisor address: APR}
+         """
+        return {address:self.apr(address) for address in self.hypervisors.keys()}
+
+    def rebalances(self, address:str)->list:
+        """ rebalances in the window of a hypervisor, oldest first """
+        return list(self._windows[Web3.toChecksumAddress(address)])
+
+    def _add(self, address:str, row:dict, timestamp:int):
+        hv = self.hypervisors[address]
+        if self.usd_price != None:
+            price0 = self.usd_price(hv.pool.token0.address, row["block"])
+            price1 = self.usd_price(hv.pool.token1.address, row["block"])
+        else:
+            price0 = 1.0001**row["tick"] * 10**(hv.pool.token0.decimals - hv.pool.token1.decimals)
+            price1 = 1
+        item = {"block":row["block"], "timestamp":timestamp,
+                "totalAmountUSD":row["totalAmount0"]*price0 + row["totalAmount1"]*price1,
+                "grossFeesUSD":row["feeAmount0"]*price0 + row["feeAmount1"]*price1}
+
+        window, sums = self._windows[address], self._sums[address]
+        window.append(item)
+        if len(window) > self.window:
+            window.popleft()
+            sums[0] = math.fsum(x["totalAmountUSD"] for x in window)
+            sums[1] = math.fsum(x["grossFeesUSD"] for x in window)
+        else:
+            sums[0] += item["totalAmountUSD"]
+            sums[1] += item["grossFeesUSD"]
+
+
+# FLEET SCANNER
+def discover_hypervisors(w3:Web3, factories:list=None, registries:list=None, block:int=None)->list:
+    """ Hypervisors of a chain from on-chain factory and registry events ( no subgraph ).
+        When an event store is in use ( see web3wrap.use_event_store, off by default ) events are kept there, so each scan only asks the node for the blocks since the last one.
+
+     Args:
+        w3 (Web3):
+        factories (list, optional): [ {"address":, "block": creation block}, ...]. Defaults to None.
+        registries (list, optional): [ {"address":, "block": creation block}, ...]. Defaults to None.
+        block (int, optional): Defaults to the chain's last block.
+
+     Returns:
+        list: hypervisor addresses
+     """
+    block = w3.eth.block_number if block == None else block
+    result = dict()
+    for cls, items in [(gamma_hypervisor_factory, factories or []), (gamma_hypervisor_registry, registries or [])]:
+        for item in items:
+            source = cls(address=item["address"], web3Provider=w3, block=block)
+            for address in source.get_hypervisors(fromBlock=item.get("block", 0), toBlock=block):
+                result.setdefault(address, None)
+    return list(result.keys())
+
+
+def scan_chain(chain:str, config:dict, multicall_address:str=MULTICALL3_ADDRESS)->list:
+    """ Snapshot all hypervisors of a chain with supply, as defillama adaptor rows ( see defillama_gamma_adaptors/visor_v2 )
+
+     Args:
+        chain (str): defillama chain name, like "ethereum"
+        config (dict): {"rpc": url or list of urls ( or endpoint options, see onchain_rpc.get_router ),
+                        "factories": [ {"address":, "block":}, ...],
+                        "registries": [ {"address":, "block":}, ...],
+                        "usd_tokens": [ stablecoin addresses ],
+                        "pricing_pools": [ pool addresses routing tokens to usd_tokens, besides the hypervisor pools ]
+                        }
+        multicall_address (str, optional): Multicall3 contract address. Defaults to MULTICALL3_ADDRESS.
+
+     Returns:
+        list: [ {"pool":, "chain":, "project":, "symbol":, "tvlUsd":, "apyBase": last 100 rebalances APR, "underlyingTokens":, "poolMeta":}, ...]
+     """
+    try:
+        w3 = Web3(onchain_rpc.get_router(config["rpc"]))
+        block = w3.eth.block_number
+        if CHAIN_IDS.get(chain, w3.eth.chain_id) != w3.eth.chain_id:
+            raise ValueError(" {} rpc is connected to chain id {}".format(chain, w3.eth.chain_id))
+        addresses = discover_hypervisors(w3=w3, factories=config.get("factories", None), registries=config.get("registries", None), block=block)
+        logging.getLogger(__name__).info(" {} hypervisors found on {} at block {}".format(len(addresses), chain, block))
+        if len(addresses) == 0:
+            return list()
+
+        # hypervisor, pool and token vars read in 3 multicall rounds ( immutables are read only once, see call_immutable )
+        hypervisors = [gamma_hypervisor(address=x, web3Provider=w3, block=block) for x in addresses]
+        multicall = multicall3(address=multicall_address, web3Provider=w3, block=block)
+        multicall.execute([(hv, function_name, ()) for hv in hypervisors for function_name in ["pool", "totalSupply"]])
+        hypervisors = [hv for hv in hypervisors if hv.call_function("totalSupply") > 0]
+        if len(hypervisors) == 0:
+            return list()
+        multicall.execute([(hv.pool, function_name, ()) for hv in hypervisors for function_name in ["token0", "token1", "fee"]])
+        multicall.execute([(token, function_name, ()) for hv in hypervisors for token in [hv.pool.token0, hv.pool.token1]
+                                for function_name in ["symbol", "decimals"]])
+
+        snapshots = hypervisor_refresher(hypervisors=hypervisors, multicall_address=multicall_address).refresh(block=block)
+        # no rebalance can be older than the hypervisor factories or registries
+        fromBlock = min([x.get("block", 0) for x in config.get("factories", []) + config.get("registries", [])] or [0])
+        aprs = rebalance_apr(hypervisors=hypervisors, fromBlock=fromBlock).update(block=block)
+
+        pools = [hv.pool for hv in hypervisors] + [univ3_pool(address=x, web3Provider=w3, block=block) for x in config.get("pricing_pools", [])]
+        pricer = usd_pricer(pools=pools, usd_tokens=config.get("usd_tokens", []), multicall_address=multicall_address)
+        prices = pricer.prices(block=block)
+
+        return [adaptor_row(chain=chain, hypervisor=hv, snapshot=snapshots[hv.address], prices=prices, apr=aprs[hv.address]) for hv in hypervisors]
+    finally:
+        # pool worker processes exit without running atexit handlers: write the buffered store rows now
+        web3wrap.flush_stores()
+
+
+def adaptor_row(chain:str, hypervisor:gamma_hypervisor, snapshot:dict, prices:dict, apr:float)->dict:
+    """ defillama adaptor row of a hypervisor ( see defillama_gamma_adaptors/visor_v2 )
+
+     Args:
+        chain (str): defillama chain name
+        hypervisor (gamma_hypervisor):
+        snapshot (dict): hypervisor tvl_price_fee result
+        prices (dict): {token address lowercase: usd price} ( see onchain_pricing.usd_pricer.prices )
+        apr (float): fee APR ( None when unknown )
+
+     Returns:
+        dict: {"pool":, "chain":, "project":, "symbol":, "tvlUsd":, "apyBase":, "underlyingTokens":, "poolMeta":}
+     """
+    token0, token1 = hypervisor.pool.token0.address.lower(), hypervisor.pool.token1.address.lower()
+    # tokens without a route to a usd token are not valued
+    tvlUsd = snapshot["qtty_token0"]*(prices.get(token0, None) or 0) + snapshot["qtty_token1"]*(prices.get(token1, None) or 0)
+    return {"pool":hypervisor.address.lower(),
+            "chain":chain.capitalize(),
+            "project":"visor",
+            "symbol":"{}-{}".format(hypervisor.pool.token0.symbol, hypervisor.pool.token1.symbol),
+            "tvlUsd":tvlUsd,
+            "apyBase":apr or 0,
+            "underlyingTokens":[token0, token1],
+            "poolMeta":"{:g}% uniswapv3 pool".format(hypervisor.pool.fee/10000),
+            }
+
+
+def scan_fleet(config:dict, timeout:float=600, multicall_address:str=MULTICALL3_ADDRESS)->list:
+    """ Snapshot the hypervisors of several chains at once: one worker process per chain, each with its own provider.
+        Chains not finished within timeout, or failing, are left out of the result.
+
+     Args:
+        config (dict): {chain: scan_chain config, ...}
+        timeout (float, optional): seconds for the whole scan. Defaults to 600.
+        multicall_address (str, optional): Multicall3 contract address. Defaults to MULTICALL3_ADDRESS.
+
+     Returns:
+        list: adaptor rows of all chains, by tvlUsd
+     """
+    deadline = time.monotonic() + timeout
+    result = list()
+    stop_workers = False
+    pool = multiprocessing.Pool(processes=max(1, len(config)))
+    try:
+        jobs = {chain:pool.apply_async(scan_chain, (chain, chain_config, multicall_address)) for chain, chain_config in config.items()}
+        for chain, job in jobs.items():
+            try:
+                result += job.get(timeout=max(0, deadline - time.monotonic()))
+            except multiprocessing.TimeoutError:
+                stop_workers = True
+                logging.getLogger(__name__).error(" {} scan did not finish in {} seconds".format(chain, timeout))
+            except Exception as e:
+                logging.getLogger(__name__).error(" {} scan failed: {}".format(chain, e))
+    except BaseException:
+        stop_workers = True
+        raise
+    finally:
+        if stop_workers:
+            # stop workers still running
+            pool.terminate()
+        else:
+            # all jobs done: let workers exit cleanly
+            pool.close()
+        pool.join()
+    return sorted(result, key=lambda x: x["tvlUsd"], reverse=True)
+
+
+if __name__ == "__main__":
+    # python onchain_fleet.py fleet_config.json [timeout seconds]
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    with open(sys.argv[1]) as f:
+        fleet_config = json.load(f)
+    print(json.dumps(scan_fleet(config=fleet_config, timeout=float(sys.argv[2]) if len(sys.argv) > 2 else 600), indent=4))
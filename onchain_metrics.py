@@ -0,0 +1,467 @@
+import time
+import bisect
+import logging
+import threading
+import contextlib
+
+
+# latency histogram upper bounds in seconds ( Prometheus default buckets )
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class rpc_event():
+    """ One chain read made by a wrapper
+
+        kind: "call" ( contract function ), "get_block", "get_logs", "multicall" ( aggregate3 request ), "batch" ( JSON-RPC batch request ) or "rpc" ( other methods )
+        contract: wrapper class name ( None for reads not made by a wrapper )
+        function: contract function name or RPC method
+        block: block number or identifier read
+        latency: seconds ( None for calls sent inside a multicall or batch request: see via )
+        size: payload bytes ( calldata sent and data returned when known )
+        cache: "hit" or "miss" ( calls only )
+        via: "multicall" or "batch" when the call was sent inside one of those requests
+        calls: reads sent in the request ( multicall and batch requests )
+        results: logs returned ( get_logs )
+        error: the read raised
+        time: epoch seconds when it ended
+    """
+    __slots__ = ("kind", "contract", "function", "block", "latency", "size", "cache", "via", "calls", "results", "error", "time")
+
+    def __init__(self, kind:str, contract:str, function:str, block=None, latency:float=None, size:int=0, cache:str=None,
+                        via:str=None, calls:int=1, results:int=None, error:bool=False):
+        self.kind = kind
+        self.contract = contract
+        self.function = function
+        self.block = block
+        self.latency = latency
+        self.size = size
+        self.cache = cache
+        self.via = via
+        self.calls = calls
+        self.results = results
+        self.error = error
+        self.time = time.time()
+
+    @property
+    def is_request(self)->bool:
+        """ Did it send a request to the node ( calls inside multicall/batch requests and cache hits did not ) """
+        return self.cache != "hit" and self.via == None
+
+    def to_dict(self)->dict:
+        return {x:getattr(self, x) for x in self.__slots__}
+
+    def __repr__(self):
+        return "rpc_event({})".format(", ".join("{}={!r}".format(x, getattr(self, x)) for x in self.__slots__))
+
+
+class histogram():
+    """ Cumulative latency histogram with fixed buckets """
+
+    def __init__(self, buckets:tuple=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0]*(len(self.buckets)+1) # last: above the highest bucket
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value:float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    @property
+    def mean(self)->float:
+        return self.sum/self.count if self.count > 0 else None
+
+    def quantile(self, q:float)->float:
+        """ Quantile estimated interpolating inside its bucket ( as Prometheus histogram_quantile )
+
+         Args:
+            q (float): 0 to 1
+
+         Returns:
+            float: seconds ( None when empty )
+         """
+        if self.count == 0:
+            return None
+        rank = q*self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count > 0 and cumulative + count >= rank:
+                lower = self.buckets[i-1] if i > 0 else 0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower)*(rank - cumulative)/count, self.max)
+            cumulative += count
+        return self.max
+
+    def cumulative(self)->list:
+        """ [ (upper bound, observations lower or equal), ...] ending with (inf, count) """
+        result = list()
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + [float("inf")], self.counts):
+            cumulative += count
+            result.append((bound, cumulative))
+        return result
+
+
+class call_budget():
+    """ Chain reads made while a rpc_metrics.budget() block runs, aggregated by kind, contract and function """
+
+    def __init__(self, name:str="", max_requests:int=None, thread:int=None):
+        """
+         Args:
+            name (str, optional): shown in reports. Defaults to "".
+            max_requests (int, optional): requests to the node allowed ( a warning is logged when exceeded ). Defaults to no limit.
+            thread (int, optional): only count reads of this thread ident. Defaults to all threads.
+         """
+        self.name = name
+        self.max_requests = max_requests
+        self.thread = thread
+        self.started = time.perf_counter()
+        self.wall_time = None
+        self.rows = dict() # (kind, contract, function): {"calls", "hits", "misses", "requests", "errors", "latency", "size"}
+
+    def add(self, event:rpc_event):
+        row = self.rows.get((event.kind, event.contract, event.function), None)
+        if row == None:
+            row = self.rows[(event.kind, event.contract, event.function)] = {"calls":0, "hits":0, "misses":0, "requests":0, "errors":0, "latency":0.0, "size":0}
+        row["calls"] += event.calls
+        if event.cache == "hit":
+            row["hits"] += 1
+        elif event.cache == "miss":
+            row["misses"] += 1
+        if event.is_request:
+            row["requests"] += 1
+        if event.error:
+            row["errors"] += 1
+        row["latency"] += event.latency or 0
+        row["size"] += event.size
+
+   # PROPERTIES
+    @property
+    def requests(self)->int:
+        """ requests sent to the node """
+        return sum(x["requests"] for x in self.rows.values())
+
+    @property
+    def hits(self)->int:
+        return sum(x["hits"] for x in self.rows.values())
+
+    @property
+    def misses(self)->int:
+        return sum(x["misses"] for x in self.rows.values())
+
+    @property
+    def latency(self)->float:
+        """ seconds waiting for the node ( concurrent requests add up ) """
+        return sum(x["latency"] for x in self.rows.values())
+
+    @property
+    def size(self)->int:
+        return sum(x["size"] for x in self.rows.values())
+
+    @property
+    def exceeded(self)->bool:
+        return self.max_requests != None and self.requests > self.max_requests
+
+    def report(self)->dict:
+        """ Budget report
+
+         Returns:
+            dict: {"name", "wall_time", "requests", "hits", "misses", "latency", "size", "max_requests",
+                    "rows":[ {"kind", "contract", "function", "calls", "hits", "misses", "requests", "errors", "latency", "size"}, ...] }
+         """
+        return {"name":self.name,
+                "wall_time":self.wall_time if self.wall_time != None else time.perf_counter() - self.started,
+                "requests":self.requests,
+                "hits":self.hits,
+                "misses":self.misses,
+                "latency":self.latency,
+                "size":self.size,
+                "max_requests":self.max_requests,
+                "rows":[{"kind":kind, "contract":contract, "function":function, **row}
+                            for (kind, contract, function), row in sorted(self.rows.items(), key=lambda x: -x[1]["requests"])],
+                }
+
+    def __str__(self):
+        report = self.report()
+        lines = ["call budget {}: {} requests, {} cache hits, {:.3f}s rpc latency, {} bytes in {:.3f}s{}".format(
+                        report["name"], report["requests"], report["hits"], report["latency"], report["size"], report["wall_time"],
+                        " ( exceeds {} )".format(self.max_requests) if self.exceeded else "")]
+        for row in report["rows"]:
+            lines.append("  {:<10} {:<40} requests {:>6}  calls {:>6}  hits {:>6}  misses {:>6}  errors {:>4}  {:>9.3f}s  {:>10} bytes".format(
+                        row["kind"], "{}.{}".format(row["contract"], row["function"]) if row["contract"] else row["function"],
+                        row["requests"], row["calls"], row["hits"], row["misses"], row["errors"], row["latency"], row["size"]))
+        return "\n".join(lines)
+
+
+class rpc_metrics():
+    """ Process wide record of chain reads: counters and latency histograms by kind, contract and function,
+        call budgets of code blocks and listeners receiving every event ( tracing exporters )
+    """
+
+    def __init__(self, buckets:tuple=LATENCY_BUCKETS):
+        self.enabled = True
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = dict() # (kind, contract, function, cache, via): {"count", "errors", "size", "calls"}
+        self._histograms = dict() # (kind, contract, function): histogram
+        self._budgets = list()
+        self._listeners = list()
+
+    def record(self, event:rpc_event):
+        """ Add a read to counters, histograms, active budgets and listeners """
+        if not self.enabled:
+            return
+        with self._lock:
+            key = (event.kind, event.contract, event.function, event.cache, event.via)
+            counter = self._counters.get(key, None)
+            if counter == None:
+                counter = self._counters[key] = {"count":0, "errors":0, "size":0, "calls":0}
+            counter["count"] += 1
+            counter["calls"] += event.calls
+            counter["size"] += event.size
+            if event.error:
+                counter["errors"] += 1
+            if event.latency != None:
+                key = (event.kind, event.contract, event.function)
+                if not key in self._histograms:
+                    self._histograms[key] = histogram(self.buckets)
+                self._histograms[key].observe(event.latency)
+            if len(self._budgets) > 0:
+                thread = threading.get_ident()
+                for budget in self._budgets:
+                    if budget.thread == None or budget.thread == thread:
+                        budget.add(event)
+            listeners = self._listeners
+        for listener in listeners:
+            try:
+                listener(event)
+            except Exception:
+                logging.getLogger(__name__).exception(" metrics listener {} failed".format(listener))
+
+    def measure(self, func, kind:str, contract:str, function:str, block=None, size:int=0, calls:int=1, results=None, cache:str=None):
+        """ Call func ( a chain read ) and record its latency
+
+         Args:
+            func (callable): no arguments function making the read
+            kind (str): see rpc_event
+            contract (str): wrapper class name
+            function (str): contract function name or RPC method
+            block (optional): block read
+            size (int, optional): payload bytes sent. Defaults to 0.
+            calls (int, optional): reads sent in the request. Defaults to 1.
+            results (callable, optional): result -> (number of results, bytes returned). Defaults to None.
+            cache (str, optional): "miss" for calls read because they were not cached. Defaults to None.
+
+         Returns:
+            func result
+         """
+        if not self.enabled:
+            return func()
+        started = time.perf_counter()
+        try:
+            result = func()
+        except Exception:
+            self.record(rpc_event(kind=kind, contract=contract, function=function, block=block, latency=time.perf_counter() - started,
+                                    size=size, cache=cache, calls=calls, error=True))
+            raise
+        latency = time.perf_counter() - started
+        count, returned = results(result) if results != None else (None, 0)
+        self.record(rpc_event(kind=kind, contract=contract, function=function, block=block, latency=latency,
+                                size=size + returned, cache=cache, calls=calls, results=count))
+        return result
+
+    async def measure_async(self, func, kind:str, contract:str, function:str, block=None, size:int=0, calls:int=1, results=None, cache:str=None):
+        """ Await func() ( an async chain read ) and record its latency, same as measure
+
+         Returns:
+            func result
+         """
+        if not self.enabled:
+            return await func()
+        started = time.perf_counter()
+        try:
+            result = await func()
+        except Exception:
+            self.record(rpc_event(kind=kind, contract=contract, function=function, block=block, latency=time.perf_counter() - started,
+                                    size=size, cache=cache, calls=calls, error=True))
+            raise
+        latency = time.perf_counter() - started
+        count, returned = results(result) if results != None else (None, 0)
+        self.record(rpc_event(kind=kind, contract=contract, function=function, block=block, latency=latency,
+                                size=size + returned, cache=cache, calls=calls, results=count))
+        return result
+
+    @contextlib.contextmanager
+    def budget(self, name:str="", max_requests:int=None, thread_only:bool=False):
+        """ Context counting the chain reads made inside the block
+
+            with metrics.budget("tvl_price_fee", max_requests=20) as budget:
+                hypervisor.tvl_price_fee()
+            print(budget)
+
+         Args:
+            name (str, optional): shown in reports. Defaults to "".
+            max_requests (int, optional): requests to the node allowed ( a warning is logged when exceeded ). Defaults to no limit.
+            thread_only (bool, optional): do not count reads of other threads ( worker pools included ). Defaults to False.
+
+         Yields:
+            call_budget:
+         """
+        budget = call_budget(name=name, max_requests=max_requests, thread=threading.get_ident() if thread_only else None)
+        with self._lock:
+            self._budgets = self._budgets + [budget]
+        try:
+            yield budget
+        finally:
+            with self._lock:
+                self._budgets = [x for x in self._budgets if x is not budget]
+            budget.wall_time = time.perf_counter() - budget.started
+            if budget.exceeded:
+                logging.getLogger(__name__).warning(" call budget {} exceeded: {} requests of {} allowed".format(name, budget.requests, max_requests))
+
+    def add_listener(self, listener):
+        """ Call listener(rpc_event) on every read recorded ( from the thread that made it ) """
+        with self._lock:
+            self._listeners = self._listeners + [listener]
+
+    def remove_listener(self, listener):
+        with self._lock:
+            self._listeners = [x for x in self._listeners if x is not listener]
+
+    def counters(self)->list:
+        """ Counters copy
+
+         Returns:
+            list: [ {"kind", "contract", "function", "cache", "via", "count", "calls", "errors", "size"}, ...]
+         """
+        with self._lock:
+            return [{"kind":kind, "contract":contract, "function":function, "cache":cache, "via":via, **counter}
+                        for (kind, contract, function, cache, via), counter in self._counters.items()]
+
+    def histograms(self)->dict:
+        """ Latency histograms copy
+
+         Returns:
+            dict: (kind, contract, function): histogram
+         """
+        with self._lock:
+            result = dict()
+            for key, value in self._histograms.items():
+                result[key] = histogram(value.buckets)
+                result[key].counts, result[key].count, result[key].sum, result[key].max = list(value.counts), value.count, value.sum, value.max
+            return result
+
+    def summary(self)->list:
+        """ Per method stats
+
+         Returns:
+            list: [ {"kind", "contract", "function", "count", "hits", "misses", "errors", "size", "mean", "p50", "p95", "p99", "max"}, ...] by count
+         """
+        rows = dict()
+        for counter in self.counters():
+            row = rows.setdefault((counter["kind"], counter["contract"], counter["function"]),
+                                    {"count":0, "hits":0, "misses":0, "errors":0, "size":0, "mean":None, "p50":None, "p95":None, "p99":None, "max":None})
+            row["count"] += counter["count"]
+            row["errors"] += counter["errors"]
+            row["size"] += counter["size"]
+            if counter["cache"] == "hit":
+                row["hits"] += counter["count"]
+            elif counter["cache"] == "miss":
+                row["misses"] += counter["count"]
+        for key, value in self.histograms().items():
+            if key in rows:
+                rows[key].update({"mean":value.mean, "p50":value.quantile(0.5), "p95":value.quantile(0.95), "p99":value.quantile(0.99), "max":value.max})
+        return sorted([{"kind":kind, "contract":contract, "function":function, **row} for (kind, contract, function), row in rows.items()],
+                        key=lambda x: -x["count"])
+
+    def reset(self):
+        with self._lock:
+            self._counters = dict()
+            self._histograms = dict()
+
+
+# process wide metrics of the wrappers ( see web3wrap._metrics )
+metrics = rpc_metrics()
+
+
+# EXPORTERS
+def _label_value(value)->str:
+    return str("" if value == None else value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(**labels)->str:
+    return "{" + ",".join('{}="{}"'.format(k, _label_value(v)) for k, v in labels.items()) + "}"
+
+def prometheus_text(metrics:rpc_metrics=metrics, prefix:str="onchain")->str:
+    """ Metrics in Prometheus text exposition format ( serve it from any http handler or write it for the node exporter textfile collector )
+
+     Args:
+        metrics (rpc_metrics, optional): Defaults to the process wide metrics.
+        prefix (str, optional): metric names prefix. Defaults to "onchain".
+
+     Returns:
+        str:
+     """
+    lines = ["# HELP {}_rpc_reads_total Chain reads by kind, contract, function, cache result and transport".format(prefix),
+             "# TYPE {}_rpc_reads_total counter".format(prefix)]
+    counters = metrics.counters()
+    for counter in counters:
+        lines.append("{}_rpc_reads_total{} {}".format(prefix, _labels(kind=counter["kind"], contract=counter["contract"], function=counter["function"],
+                                                                    cache=counter["cache"], via=counter["via"]), counter["count"]))
+    lines += ["# HELP {}_rpc_errors_total Chain reads that raised".format(prefix),
+              "# TYPE {}_rpc_errors_total counter".format(prefix)]
+    for counter in counters:
+        if counter["errors"] > 0:
+            lines.append("{}_rpc_errors_total{} {}".format(prefix, _labels(kind=counter["kind"], contract=counter["contract"], function=counter["function"],
+                                                                         cache=counter["cache"], via=counter["via"]), counter["errors"]))
+    lines += ["# HELP {}_rpc_payload_bytes_total Payload bytes sent and returned".format(prefix),
+              "# TYPE {}_rpc_payload_bytes_total counter".format(prefix)]
+    for counter in counters:
+        lines.append("{}_rpc_payload_bytes_total{} {}".format(prefix, _labels(kind=counter["kind"], contract=counter["contract"], function=counter["function"],
+                                                                            cache=counter["cache"], via=counter["via"]), counter["size"]))
+    lines += ["# HELP {}_rpc_latency_seconds Chain read latency".format(prefix),
+              "# TYPE {}_rpc_latency_seconds histogram".format(prefix)]
+    for (kind, contract, function), value in metrics.histograms().items():
+        for bound, count in value.cumulative():
+            lines.append("{}_rpc_latency_seconds_bucket{} {}".format(prefix, _labels(kind=kind, contract=contract, function=function,
+                                                                                   le="+Inf" if bound == float("inf") else repr(float(bound))), count))
+        lines.append("{}_rpc_latency_seconds_sum{} {}".format(prefix, _labels(kind=kind, contract=contract, function=function), repr(value.sum)))
+        lines.append("{}_rpc_latency_seconds_count{} {}".format(prefix, _labels(kind=kind, contract=contract, function=function), value.count))
+    return "\n".join(lines) + "\n"
+
+
+def opentelemetry_listener(tracer=None):
+    """ Listener creating one OpenTelemetry span per chain read sent to the node ( needs the opentelemetry-api package )
+
+        metrics.add_listener(opentelemetry_listener())
+
+     Args:
+        tracer (opentelemetry.trace.Tracer, optional): Defaults to the global tracer provider's tracer for this module.
+
+     Returns:
+        callable: rpc_event listener
+     """
+    try:
+        from opentelemetry import trace
+    except ImportError as e:
+        raise ImportError(" opentelemetry_listener needs the opentelemetry-api package ( pip install opentelemetry-api )") from e
+
+    tracer = trace.get_tracer(__name__) if tracer == None else tracer
+
+    def listener(event:rpc_event):
+        if event.latency == None:
+            return
+        end = int(event.time*1e9)
+        attributes = {"rpc.kind":event.kind, "rpc.function":event.function, "rpc.payload_bytes":event.size, "rpc.calls":event.calls}
+        for name, value in (("rpc.contract", event.contract), ("rpc.block", event.block), ("rpc.cache", event.cache), ("rpc.results", event.results)):
+            if value != None:
+                attributes[name] = value if isinstance(value, (int, str)) else str(value)
+        span = tracer.start_span("{}.{}".format(event.contract, event.function) if event.contract else event.function,
+                                    start_time=end - int(event.latency*1e9), attributes=attributes)
+        if event.error:
+            span.set_status(trace.Status(trace.StatusCode.ERROR))
+        span.end(end_time=end)
+
+    return listener
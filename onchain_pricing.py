@@ -0,0 +1,378 @@
+import heapq
+import bisect
+import logging
+import threading
+from collections import OrderedDict
+
+from onchain_analysis_base import multicall3, rpc_batch, MULTICALL3_ADDRESS
+
+
+_q96 = 2**96
+
+# (chain id, multicall address, batch): twap_oracle shared by the pools of that chain ( see shared_twap_oracle )
+_twap_oracles = dict()
+_twap_oracles_lock = threading.Lock()
+
+
+class usd_pricer():
+    """ USD token prices from a graph of Uniswap v3 pools.
+        Each token is routed to a USD stablecoin through the deepest path ( token->WETH->USDC... ): the path whose
+        shallowest pool holds the most USD of the token it prices from. Routes are found once ( update_routes ) and
+        prices of all routed tokens at a block come from one read of the slot0 of each routed pool, memoized by (token, block).
+
+        pricer = usd_pricer(pools=[univ3_pool(address=x, web3Provider=w3) for x in addresses], usd_tokens=[USDC, USDT, DAI])
+        price = pricer.price(token=WETH, block=block)
+    """
+
+    def __init__(self, pools:list, usd_tokens:list, multicall_address:str=MULTICALL3_ADDRESS, batch:bool=False, max_prices:int=100000):
+        """
+         Args:
+            pools (list): of univ3_pool objects sharing the same provider
+            usd_tokens (list): addresses of tokens priced 1 USD
+            multicall_address (str, optional): Multicall3 contract address. Defaults to MULTICALL3_ADDRESS.
+            batch (bool, optional): use JSON-RPC batch requests instead of Multicall3. Defaults to False.
+            max_prices (int, optional): (token, block) prices kept ( least recently used are evicted ). Defaults to 100000.
+         """
+        self.pools = {x.address.lower():x for x in pools}
+        self.usd_tokens = set(x.lower() for x in usd_tokens)
+        self.multicall_address = multicall_address
+        self.batch = batch
+        self.max_prices = max_prices
+
+        # token: [(pool address, other token), ...]
+        self.graph = dict()
+        for address, pool in self.pools.items():
+            token0, token1 = pool.token0.address.lower(), pool.token1.address.lower()
+            self.graph.setdefault(token0, list()).append((address, token1))
+            self.graph.setdefault(token1, list()).append((address, token0))
+
+        # token: (pool address, token priced from) ( usd tokens are not routed )
+        self.routes = None
+        self.routes_block = None
+
+        self._prices = OrderedDict()
+        self._lock = threading.Lock()
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, token:str, block:int)->float:
+        """ same as price ( so the pricer can be passed as a usd_price function ) """
+        return self.price(token=token, block=block)
+
+   # ROUTES
+    def update_routes(self, block:int=None)->dict:
+        """ Find the deepest path of each token to a USD token at block ( widest path over pool depth in USD )
+
+         Args:
+            block (int, optional): Defaults to the block of the first pool.
+
+         Returns:
+            dict: {token: (pool address, token priced from)}
+         """
+        block = next(iter(self.pools.values())).block if block == None else block
+        pools = {address:pool.at_block(block) for address, pool in self.pools.items()}
+        self._executor(block).execute([call for pool in pools.values()
+                                            for call in [(pool, "slot0", ()), (pool.token0, "decimals", ()), (pool.token1, "decimals", ()),
+                                                         (pool.token0, "balanceOf", (pool.address,)), (pool.token1, "balanceOf", (pool.address,))]])
+
+        prices = {token:1.0 for token in self.usd_tokens}
+        depth = {token:float("inf") for token in self.usd_tokens}
+        routes = dict()
+        heap = [(-depth[token], token) for token in self.usd_tokens]
+        done = set()
+        while len(heap) > 0:
+            token_depth, token = heapq.heappop(heap)
+            if token in done:
+                continue
+            done.add(token)
+            for address, other in self.graph.get(token, []):
+                if other in done:
+                    continue
+                pool = pools[address]
+                price = self._route_price(pool, token, prices[token], pool.call_function("slot0")[0])
+                if price == None:
+                    continue
+                # USD value of the priced token held by the pool
+                token_wrapper = pool.token0 if pool.token0.address.lower() == token else pool.token1
+                capacity = min(-token_depth, token_wrapper.balanceOf(pool.address) * prices[token])
+                if capacity > depth.get(other, 0):
+                    depth[other] = capacity
+                    prices[other] = price
+                    routes[other] = (address, token)
+                    heapq.heappush(heap, (-capacity, other))
+
+        unrouted = [x for x in self.graph.keys() if not x in routes and not x in self.usd_tokens]
+        if len(unrouted) > 0:
+            logging.getLogger(__name__).warning(" {} tokens without a route to a usd token: {}".format(len(unrouted), unrouted))
+        with self._lock:
+            self.routes = routes
+            self.routes_block = block
+        return routes
+
+   # PRICES
+    def price(self, token:str, block:int)->float:
+        """ USD price of a token at block
+
+         Returns:
+            float: None when the token has no route to a usd token
+         """
+        token = token.lower()
+        if token in self.usd_tokens:
+            return 1.0
+        key = (token, block)
+        with self._lock:
+            if key in self._prices:
+                self.hits += 1
+                self._prices.move_to_end(key)
+                return self._prices[key]
+        return self.prices(block=block).get(token, None)
+
+    def prices(self, block:int)->dict:
+        """ USD price of every routed token at block, from one read of the routed pools slot0
+
+         Returns:
+            dict: {token: price}
+         """
+        if self.routes == None:
+            self.update_routes(block=block)
+        routes = self.routes
+
+        pools = {address:self.pools[address].at_block(block) for address in set(x[0] for x in routes.values())}
+        results = self._executor(block).execute([(pool, "slot0", ()) for pool in pools.values()])
+        sqrtPrices = {address:(None if result == None else result[0]) for address, result in zip(pools.keys(), results)}
+
+        result = {token:1.0 for token in self.usd_tokens}
+        def solve(token:str)->float:
+            if not token in result:
+                address, parent = routes[token]
+                parent_price = solve(parent)
+                result[token] = None if parent_price == None or sqrtPrices[address] == None else \
+                                self._route_price(pools[address], parent, parent_price, sqrtPrices[address])
+            return result[token]
+        for token in routes.keys():
+            solve(token)
+
+        with self._lock:
+            self.misses += 1
+            for token, price in result.items():
+                self._prices[(token, block)] = price
+                self._prices.move_to_end((token, block))
+            while len(self._prices) > self.max_prices:
+                self._prices.popitem(last=False)
+        return result
+
+   # HELPERS
+    def _route_price(self, pool, token:str, token_price:float, sqrtPriceX96:int)->float:
+        """ USD price of the other token of pool from the price of token """
+        if sqrtPriceX96 == 0:
+            return None
+        # token1 per token0, decimal adjusted
+        price0 = (sqrtPriceX96/_q96)**2 * 10**(pool.token0.decimals - pool.token1.decimals)
+        if pool.token0.address.lower() == token:
+            return token_price / price0
+        return token_price * price0
+
+    def _executor(self, block:int):
+        any_pool = next(iter(self.pools.values()))
+        return rpc_batch() if self.batch else multicall3(address=self.multicall_address, web3Provider=any_pool.w3, block=block)
+
+
+class twap_oracle():
+    """ Time weighted average ticks and prices of Uniswap v3 pools from their oracle ( observe ).
+        All windows asked for a pool at a block are merged into one observe call, and the calls of all pools are sent together.
+        Pools whose oracle does not reach back a window ( observe reverts ) are answered from their observations ring buffer,
+        averaging over the oldest observation available ( see the "seconds" field ). Results are memoized by (pool, block, window).
+
+        oracle = twap_oracle()
+        twaps = oracle.twaps(requests=[(pool, [300, 3600]), (other_pool, [1800])], block=block)
+        price = twaps[0][3600]["price_token0"]
+    """
+
+    def __init__(self, multicall_address:str=MULTICALL3_ADDRESS, batch:bool=False, max_results:int=100000):
+        """
+         Args:
+            multicall_address (str, optional): Multicall3 contract address. Defaults to MULTICALL3_ADDRESS.
+            batch (bool, optional): use JSON-RPC batch requests instead of Multicall3. Defaults to False.
+            max_results (int, optional): (pool, block, window) results kept ( least recently used are evicted ). Defaults to 100000.
+         """
+        self.multicall_address = multicall_address
+        self.batch = batch
+        self.max_results = max_results
+
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+        # stats
+        self.fallbacks = 0
+
+    def twap(self, pool, windows:list, block:int=None)->dict:
+        """ TWAPs of one pool ( see twaps )
+
+         Args:
+            pool (univ3_pool):
+            windows (list): seconds
+            block (int, optional): Defaults to the pool's block.
+
+         Returns:
+            dict: {window: {"tick":, "price_token0":, "price_token1":, "seconds":}}
+         """
+        return self.twaps(requests=[(pool, windows)], block=pool.block if block == None else block)[0]
+
+    def twaps(self, requests:list, block:int)->list:
+        """ TWAPs of many pools and windows at a block
+
+         Args:
+            requests (list): [ (univ3_pool, [window seconds, ...]), ...] ( pools sharing the same provider )
+            block (int):
+
+         Returns:
+            list: in the same order, {window: {"tick": arithmetic mean tick,
+                                               "price_token0": token1 per token0 at the mean tick ( decimal adjusted ),
+                                               "price_token1": token0 per token1,
+                                               "seconds": seconds averaged ( lower than window when the oracle does not reach back )}}
+                   or None for the windows of pools that could not be read
+         """
+        # windows not memoized, by pool
+        pools = dict()
+        windows = dict()
+        with self._lock:
+            for pool, items in requests:
+                address = pool.address.lower()
+                for window in items:
+                    if not (address, block, window) in self._results:
+                        pools.setdefault(address, pool.at_block(block))
+                        windows.setdefault(address, set()).add(window)
+
+        if len(pools) > 0:
+            self._read(pools=pools, windows={address:sorted(items) for address, items in windows.items()}, block=block)
+
+        with self._lock:
+            result = list()
+            for pool, items in requests:
+                address = pool.address.lower()
+                result.append({window:self._results.get((address, block, window), None) for window in items})
+                for window in items:
+                    if (address, block, window) in self._results:
+                        self._results.move_to_end((address, block, window))
+        return result
+
+   # HELPERS
+    def _read(self, pools:dict, windows:dict, block:int):
+        """ read and memoize windows of pools at block: one observe call per pool, ring buffer for pools failing """
+        executor = self._executor(pools, block)
+        calls = [(pool, "observe", ([0] + windows[address],)) for address, pool in pools.items()]
+        calls += [(token, "decimals", ()) for pool in pools.values() for token in [pool.token0, pool.token1] if not token.has_immutable("decimals")]
+        results = executor.execute(calls)
+
+        cumulatives = dict()
+        failed = list()
+        for (address, pool), result in zip(pools.items(), results):
+            if result == None:
+                failed.append(address)
+            else:
+                # seconds asked: tick cumulative
+                cumulatives[address] = dict(zip([0] + windows[address], result[0]))
+
+        if len(failed) > 0:
+            self.fallbacks += len(failed)
+            logging.getLogger(__name__).debug(" {} pools oracle do not reach back the windows asked at block {}: using their observations".format(len(failed), block))
+            cumulatives.update(self._read_observations(pools={x:pools[x] for x in failed}, windows=windows, block=block, executor=executor))
+
+        with self._lock:
+            for address, items in cumulatives.items():
+                pool = pools[address]
+                for window in windows[address]:
+                    seconds, tickCumulative = items[window] if isinstance(items[window], tuple) else (window, items[window])
+                    self._results[(address, block, window)] = None if seconds <= 0 else \
+                                self._twap(pool=pool, tickCumulative_delta=items[0] - tickCumulative, seconds=seconds)
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+
+    def _read_observations(self, pools:dict, windows:dict, block:int, executor)->dict:
+        """ tick cumulatives rebuilt from the observations ring buffer ( Oracle.observeSingle ), windows limited to the oldest observation
+
+         Returns:
+            dict: {pool address: {0: tick cumulative now, window: (seconds covered, tick cumulative then), ...}}
+         """
+        slot0s = dict(zip(pools.keys(), executor.execute([(pool, "slot0", ()) for pool in pools.values()])))
+        executor.execute([(pool, "observations", (i,)) for address, pool in pools.items() if slot0s[address] != None
+                                for i in range(slot0s[address][3])])
+        now = next(iter(pools.values())).timestampFromBlockNumber(block)
+
+        result = dict()
+        for address, pool in pools.items():
+            if slot0s[address] == None:
+                continue
+            tick, index, cardinality = slot0s[address][1], slot0s[address][2], slot0s[address][3]
+            # (blockTimestamp, tickCumulative) of initialized observations, oldest first
+            observations = [pool.call_function("observations", (index + 1 + i) % cardinality) for i in range(cardinality)]
+            observations = [(x[0], x[1]) for x in observations if x != None and x[3]]
+            if len(observations) == 0:
+                continue
+
+            result[address] = {0:_observe(observations=observations, tick=tick, time=now, target=now)}
+            for window in windows[address]:
+                target = max(now - window, observations[0][0])
+                result[address][window] = (now - target, _observe(observations=observations, tick=tick, time=now, target=target))
+        return result
+
+    def _twap(self, pool, tickCumulative_delta:int, seconds:int)->dict:
+        # arithmetic mean tick rounded to negative infinity ( OracleLibrary.consult )
+        tick = int(tickCumulative_delta / seconds)
+        if tickCumulative_delta < 0 and tickCumulative_delta % seconds != 0:
+            tick -= 1
+        price = 1.0001**tick * 10**(pool.token0.decimals - pool.token1.decimals)
+        return {"tick":tick, "price_token0":price, "price_token1":1/price, "seconds":seconds}
+
+    def _executor(self, pools:dict, block:int):
+        any_pool = next(iter(pools.values()))
+        return rpc_batch() if self.batch else multicall3(address=self.multicall_address, web3Provider=any_pool.w3, block=block)
+
+
+def shared_twap_oracle(chain_id:int, multicall_address:str=MULTICALL3_ADDRESS, batch:bool=False)->twap_oracle:
+    """ twap_oracle of a chain, created once and shared process wide so that its results are memoized across calls
+        ( results are keyed by pool address: one oracle per chain )
+
+     Args:
+        chain_id (int):
+        multicall_address (str, optional): Multicall3 contract address. Defaults to MULTICALL3_ADDRESS.
+        batch (bool, optional): use JSON-RPC batch requests instead of Multicall3. Defaults to False.
+
+     Returns:
+        twap_oracle:
+     """
+    key = (chain_id, multicall_address.lower(), batch)
+    with _twap_oracles_lock:
+        if not key in _twap_oracles:
+            _twap_oracles[key] = twap_oracle(multicall_address=multicall_address, batch=batch)
+        return _twap_oracles[key]
+
+
+def _observe(observations:list, tick:int, time:int, target:int)->int:
+    """ Tick cumulative at target time ( Oracle.observeSingle )
+
+     Args:
+        observations (list): [ (blockTimestamp, tickCumulative), ...] oldest first, target not older than the first
+        tick (int): current tick
+        time (int): current timestamp
+        target (int): timestamp
+
+     Returns:
+        int: tick cumulative
+     """
+    last = observations[-1]
+    if last[0] <= target:
+        # after the last observation: extend it with the current tick
+        return last[1] + tick*(target - last[0])
+
+    timestamps = [x[0] for x in observations]
+    i = bisect.bisect_right(timestamps, target)
+    before, after = observations[i-1], observations[i]
+    if before[0] == target:
+        return before[1]
+    # interpolate ( int56 division truncates toward zero )
+    delta = after[1] - before[1]
+    step = abs(delta) // (after[0] - before[0]) * (1 if delta >= 0 else -1)
+    return before[1] + step*(target - before[0])
@@ -0,0 +1,236 @@
+import sys
+from array import array
+from collections.abc import Mapping
+
+
+class record(Mapping):
+    """ Immutable slotted result of a contract read ( or of a calculation over them ).
+        Behaves like the read-only dict it replaces: record["tick"], .keys(), .items(), .get(), dict(record), **record
+        and equality with dicts, besides attribute access ( record.tick ).
+
+        Subclasses set __slots__ = _fields and _types: one array typecode per field used by record_table columns
+        ( "d" float, "q" signed 64 bit int, "?" bool, "O" any python object like uint256 values ).
+    """
+    __slots__ = ()
+    _fields = ()
+    _types = ()
+
+    def __init__(self, *values, **kwargs):
+        if len(kwargs) > 0:
+            try:
+                values = values + tuple(kwargs.pop(x) for x in self._fields[len(values):])
+            except KeyError as e:
+                raise TypeError(" {} missing field {}".format(self.__class__.__name__, e))
+            if len(kwargs) > 0:
+                raise TypeError(" {} unexpected fields {}".format(self.__class__.__name__, list(kwargs.keys())))
+        if len(values) != len(self._fields):
+            raise TypeError(" {} takes {} values ({} given)".format(self.__class__.__name__, len(self._fields), len(values)))
+        for name, value in zip(self._fields, values):
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_dict(cls, data:dict):
+        """ record from a dict with ( at least ) its fields """
+        return cls(*[data[x] for x in cls._fields])
+
+    def replace(self, **changes):
+        """ new record with some fields changed """
+        return self.__class__(*[changes.pop(x) if x in changes else getattr(self, x) for x in self._fields], **changes)
+
+    def to_dict(self)->dict:
+        return {x:getattr(self, x) for x in self._fields}
+
+   # MAPPING
+    def __getitem__(self, key:str):
+        if key in self._fields:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key)->bool:
+        return key in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self)->int:
+        return len(self._fields)
+
+   # IMMUTABLE
+    def __setattr__(self, name:str, value):
+        raise AttributeError(" {} is immutable ( see replace )".format(self.__class__.__name__))
+
+    def __delattr__(self, name:str):
+        raise AttributeError(" {} is immutable".format(self.__class__.__name__))
+
+    def __reduce__(self):
+        return (self.__class__, tuple(getattr(self, x) for x in self._fields))
+
+    def __repr__(self)->str:
+        return "{}({})".format(self.__class__.__name__, ", ".join("{}={!r}".format(x, getattr(self, x)) for x in self._fields))
+
+
+# POOL
+class slot0_record(record):
+    """ univ3_pool.slot0 """
+    __slots__ = _fields = ("sqrtPriceX96", "tick", "observationIndex", "observationCardinality", "observationCardinalityNext", "feeProtocol", "unlocked")
+    _types = ("O", "q", "q", "q", "q", "q", "?")
+
+class tick_record(record):
+    """ univ3_pool.ticks """
+    __slots__ = _fields = ("liquidityGross", "liquidityNet", "feeGrowthOutside0X128", "feeGrowthOutside1X128",
+                           "tickCumulativeOutside", "secondsPerLiquidityOutsideX128", "secondsOutside", "initialized")
+    _types = ("O", "O", "O", "O", "q", "O", "q", "?")
+
+class position_record(record):
+    """ univ3_pool.positions """
+    __slots__ = _fields = ("liquidity", "feeGrowthInside0LastX128", "feeGrowthInside1LastX128", "tokensOwed0", "tokensOwed1")
+    _types = ("O", "O", "O", "O", "O")
+
+class tvl_record(record):
+    """ univ3_pool.get_tvlPriceFees and gamma_hypervisor.tvl_price_fee """
+    __slots__ = _fields = ("qtty_token0", "qtty_token1", "price_token0", "price_token1",
+                           "fees_uncollected_token0", "fees_uncollected_token1", "fees_owed_token0", "fees_owed_token1")
+    _types = ("d",) * 8
+
+
+# HYPERVISOR
+class hypervisor_position_record(record):
+    """ gamma_hypervisor.getBasePosition and getLimitPosition ( amounts decimal adjusted ) """
+    __slots__ = _fields = ("liquidity", "amount0", "amount1")
+    _types = ("O", "d", "d")
+
+class total_amounts_record(record):
+    """ gamma_hypervisor.getTotalAmounts ( decimal adjusted ) """
+    __slots__ = _fields = ("total0", "total1")
+    _types = ("d", "d")
+
+class snapshot_record(record):
+    """ gamma_hypervisor.history row: tvl_price_fee at a block """
+    __slots__ = _fields = ("block", "timestamp") + tvl_record._fields
+    _types = ("q", "q") + tvl_record._types
+
+
+# BULK
+def _new_column(typecode:str, size:int=0):
+    if typecode == "O":
+        return [None] * size
+    return array("b" if typecode == "?" else typecode, bytes(size * (1 if typecode == "?" else 8)))
+
+class record_table(Mapping):
+    """ Many records of one type held as struct-of-arrays: one typed array.array column per field ( 8 bytes a value ),
+        instead of one object per record. Columns that get a value not fitting its type ( None, uint256 overflow ) fall back to lists.
+
+        Behaves like the dict of columns it replaces ( table["qtty_token0"] is a list-like column ),
+        rows are read back as records with row(i) or rows().
+    """
+
+    def __init__(self, record_type, records=None, size:int=0):
+        """
+         Args:
+            record_type (type): record subclass of the rows
+            records (iterable, optional): rows to append. Defaults to None.
+            size (int, optional): rows preallocated ( zeroed, to be filled with set ). Defaults to 0.
+         """
+        self.record_type = record_type
+        self._typecodes = dict(zip(record_type._fields, record_type._types))
+        self._columns = {name:_new_column(typecode, size) for name, typecode in self._typecodes.items()}
+        self._size = size
+        if records != None:
+            self.extend(records)
+
+    @property
+    def size(self)->int:
+        """ number of rows """
+        return self._size
+
+    @property
+    def nbytes(self)->int:
+        """ approximate memory used by the columns """
+        total = 0
+        for column in self._columns.values():
+            if isinstance(column, array):
+                total += sys.getsizeof(column)
+            else:
+                total += sys.getsizeof(column) + sum(sys.getsizeof(x) for x in column)
+        return total
+
+    def append(self, row):
+        """ Add a row
+
+         Args:
+            row (record or dict): with the record_type fields
+         """
+        for name, column in self._columns.items():
+            try:
+                column.append(row[name])
+            except (TypeError, OverflowError):
+                self._to_list(name).append(row[name])
+        self._size += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def set(self, index:int, row):
+        """ Replace the row at index ( see size to preallocate ) """
+        for name, column in self._columns.items():
+            try:
+                column[index] = row[name]
+            except (TypeError, OverflowError):
+                self._to_list(name)[index] = row[name]
+
+    def row(self, index:int):
+        """ record at index """
+        return self.record_type(*[bool(column[index]) if self._typecodes[name] == "?" else column[index]
+                                  for name, column in self._columns.items()])
+
+    def rows(self):
+        """ Yields:
+            record: all rows in order
+         """
+        for i in range(self._size):
+            yield self.row(i)
+
+    def to_dict(self)->dict:
+        """ columns as lists """
+        return {name:[bool(x) for x in column] if self._typecodes[name] == "?" else list(column) for name, column in self._columns.items()}
+
+    def to_numpy(self)->dict:
+        """ columns as numpy arrays ( typed columns are not copied ) """
+        import numpy as np
+
+        result = dict()
+        for name, column in self._columns.items():
+            if self._typecodes[name] == "O":
+                result[name] = np.array(column, dtype=object)
+            else:
+                result[name] = np.frombuffer(column, dtype={"d":np.float64, "q":np.int64, "?":np.bool_}[self._typecodes[name]])
+        return result
+
+    def to_dataframe(self):
+        """ pandas DataFrame of the columns """
+        import pandas as pd
+
+        return pd.DataFrame(self.to_numpy())
+
+   # MAPPING
+    def __getitem__(self, name:str):
+        return self._columns[name]
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self)->int:
+        return len(self._columns)
+
+    def __repr__(self)->str:
+        return "record_table({}, {} rows)".format(self.record_type.__name__, self._size)
+
+   # HELPERS
+    def _to_list(self, name:str)->list:
+        """ change a typed column to a list """
+        column = self._columns[name]
+        if not isinstance(column, list):
+            self._columns[name] = [bool(x) for x in column] if self._typecodes[name] == "?" else list(column)
+            self._typecodes[name] = "O"
+        return self._columns[name]
@@ -0,0 +1,392 @@
+import time
+import json
+import random
+import logging
+import weakref
+import threading
+import concurrent.futures
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+from web3.providers.base import JSONBaseProvider
+from web3.providers.rpc import HTTPProvider
+from web3._utils.request import make_post_request
+
+
+# methods safe to send more than once or to several endpoints ( hedged or retried after reaching a node ).
+# Others ( eth_sendRawTransaction, filters living in one node... ) are only retried when the node never got them
+READ_METHODS = {"eth_call", "eth_estimateGas", "eth_chainId", "eth_blockNumber", "eth_gasPrice", "eth_maxPriorityFeePerGas", "eth_feeHistory",
+                "eth_getLogs", "eth_getBlockByNumber", "eth_getBlockByHash", "eth_getBalance", "eth_getCode", "eth_getStorageAt",
+                "eth_getTransactionCount", "eth_getTransactionByHash", "eth_getTransactionReceipt", "eth_getProof",
+                "eth_getBlockTransactionCountByNumber", "eth_getBlockTransactionCountByHash", "eth_syncing", "net_version", "web3_clientVersion"}
+
+
+class _transient_error(Exception):
+    """ request worth retrying ( on other endpoint )
+
+        sent: the request may have reached the node ( False when it was refused before being processed )
+    """
+
+    def __init__(self, message:str, sent:bool=True):
+        super().__init__(message)
+        self.sent = sent
+
+
+class rpc_endpoint():
+    """ One JSON-RPC http endpoint: keep-alive connection pool, rate limit and latency/health stats """
+
+    def __init__(self, url:str, max_rps:float=0, timeout:float=30, pool_size:int=20, latency_window:int=200):
+        """
+         Args:
+            url (str): http(s) endpoint
+            max_rps (float, optional): maximum requests per second ( 0 = no limit ). Defaults to 0.
+            timeout (float, optional): request timeout in seconds. Defaults to 30.
+            pool_size (int, optional): keep-alive connections kept. Defaults to 20.
+            latency_window (int, optional): last request latencies used for stats. Defaults to 200.
+         """
+        self.url = url
+        self.max_rps = max_rps
+        self.timeout = timeout
+
+        self._session = requests.Session()
+        self._session.mount("http://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        self._session.mount("https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+
+        self._lock = threading.Lock()
+        # rate limit ( token bucket )
+        self._tokens = max_rps
+        self._tokens_time = time.monotonic()
+        # health
+        self._latencies = deque(maxlen=latency_window)
+        self._consecutive_errors = 0
+        self._disabled_until = 0
+
+        # stats
+        self.requests = 0
+        self.errors = 0
+
+   # PROPERTIES
+    @property
+    def p95(self)->float:
+        """ 95th percentile latency in seconds ( None when not enough data ) """
+        with self._lock:
+            if len(self._latencies) < 20:
+                return None
+            return sorted(self._latencies)[int(len(self._latencies)*0.95)-1]
+
+    @property
+    def mean_latency(self)->float:
+        with self._lock:
+            return sum(self._latencies)/len(self._latencies) if len(self._latencies) > 0 else 0
+
+    @property
+    def available(self)->bool:
+        return time.monotonic() >= self._disabled_until
+
+    @property
+    def score(self)->float:
+        """ lower is better: mean latency penalized by recent errors """
+        return (self.mean_latency or 0.001) * (1 + self._consecutive_errors)**2
+
+   # FUNCTIONS
+    def acquire(self)->float:
+        """ Take a rate limit token
+
+         Returns:
+            float: seconds to wait before a token is available ( 0 when taken )
+         """
+        if self.max_rps <= 0:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.max_rps, self._tokens + (now - self._tokens_time)*self.max_rps)
+            self._tokens_time = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens)/self.max_rps
+
+    def post(self, data:bytes)->bytes:
+        """ Send a request
+
+         Raises:
+            _transient_error: when the request should be retried
+         """
+        start = time.monotonic()
+        try:
+            response = self._session.post(self.url, data=data, headers={"Content-Type": "application/json"}, timeout=self.timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            self.failed()
+            # connection never made: the node did not get the request
+            sent = not (isinstance(e, requests.exceptions.ConnectTimeout) or "NewConnectionError" in str(e) or "Connection refused" in str(e))
+            raise _transient_error("{} {}".format(self.url, e), sent=sent) from e
+        if response.status_code == 429:
+            self.failed()
+            raise _transient_error("{} http status 429".format(self.url), sent=False)
+        if response.status_code >= 500:
+            self.failed()
+            raise _transient_error("{} http status {}".format(self.url, response.status_code))
+        response.raise_for_status()
+        self.succeeded(latency=time.monotonic()-start)
+        return response.content
+
+    def succeeded(self, latency:float):
+        with self._lock:
+            self.requests += 1
+            self._latencies.append(latency)
+            self._consecutive_errors = 0
+
+    def failed(self, cooldown:float=None):
+        """ Register an error. Endpoints failing repeatedly are taken out of rotation for a while """
+        with self._lock:
+            self.requests += 1
+            self.errors += 1
+            self._consecutive_errors += 1
+            if cooldown == None and self._consecutive_errors >= 3:
+                cooldown = min(2**self._consecutive_errors, 300)
+            if cooldown:
+                self._disabled_until = time.monotonic() + cooldown
+                logging.getLogger(__name__).warning(" rpc endpoint {} out of rotation for {:.0f} seconds".format(self.url, cooldown))
+
+
+class rpc_router(JSONBaseProvider):
+    """ Web3 provider spreading requests over several endpoints of the same chain.
+        Requests go to the healthiest available endpoint, are retried with backoff on errors,
+        and are sent again to a second endpoint ( hedged ) when they take longer than the endpoint's p95 latency.
+        Endpoints much slower than the best one are taken out of rotation for a while.
+        Only READ_METHODS are hedged or retried once they may have reached a node: transactions are never sent twice.
+    """
+
+    def __init__(self, endpoints:list, max_retries:int=4, backoff:float=0.5, hedge:bool=True, slow_factor:float=4, max_workers:int=32):
+        """
+         Args:
+            endpoints (list): of urls or rpc_endpoint objects
+            max_retries (int, optional): retries of a failed request. Defaults to 4.
+            backoff (float, optional): seconds to wait before the first retry ( doubled each time ). Defaults to 0.5.
+            hedge (bool, optional): send slow requests to a second endpoint. Defaults to True.
+            slow_factor (float, optional): endpoints with p95 latency this times the best are taken out of rotation. Defaults to 4.
+            max_workers (int, optional): threads used to hedge requests. Defaults to 32.
+         """
+        super().__init__()
+        if len(endpoints) == 0:
+            raise ValueError(" At least one endpoint should be defined")
+        self.endpoints = [x if isinstance(x, rpc_endpoint) else rpc_endpoint(url=x) for x in endpoints]
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.hedge = hedge
+        self.slow_factor = slow_factor
+        self.max_workers = max_workers
+        # hedging threads ( created on the first hedged request, see close )
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+        # stats
+        self.hedged = 0
+        self.retries = 0
+
+    def __str__(self):
+        return "rpc router of {}".format(", ".join(x.url for x in self.endpoints))
+
+    def close(self):
+        """ Stop the hedging threads and close the endpoints connections """
+        with self._executor_lock:
+            if self._executor != None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+        for endpoint in self.endpoints:
+            endpoint._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def make_request(self, method, params):
+        return self.decode_rpc_response(self.send(self.encode_rpc_request(method, params)))
+
+    def make_batch_request(self, requests:list)->list:
+        """ Send several requests as one JSON-RPC batch ( see make_batch_request ) """
+        return _decode_batch_response(self.send(_encode_batch_request(requests)), len(requests))
+
+    def send(self, data:bytes)->bytes:
+        """ Send a raw JSON-RPC request ( single or batch ) with retries and hedging
+
+         Returns:
+            bytes: raw response
+         """
+        read = _is_read(data)
+        tried = list()
+        for attempt in range(self.max_retries+1):
+            endpoint = self.choose_endpoint(exclude=tried)
+            try:
+                if not read:
+                    return self._post(endpoint, data)
+                return self._send_hedged(endpoint=endpoint, data=data, exclude=tried)
+            except _transient_error as e:
+                tried.append(endpoint)
+                if not read and e.sent:
+                    raise ConnectionError(" rpc request not retried ( may have reached the node ): {}".format(e)) from e
+                if attempt == self.max_retries:
+                    raise ConnectionError(" rpc request failed after {} retries: {}".format(self.max_retries, e)) from e
+                self.retries += 1
+                logging.getLogger(__name__).debug(" retrying rpc request: {}".format(e))
+                time.sleep(self.backoff * 2**attempt * random.uniform(0.5, 1))
+
+    def choose_endpoint(self, exclude:list=None)->rpc_endpoint:
+        """ Healthiest available endpoint ( waits for rate limits )
+
+         Args:
+            exclude (list, optional): endpoints to avoid when possible. Defaults to None.
+         """
+        self._check_slow_endpoints()
+        candidates = [x for x in self.endpoints if x.available and not x in (exclude or [])]
+        if len(candidates) == 0:
+            candidates = [x for x in self.endpoints if x.available] or self.endpoints
+        candidates = sorted(candidates, key=lambda x: x.score)
+
+        while True:
+            waits = list()
+            for endpoint in candidates:
+                wait = endpoint.acquire()
+                if wait == 0:
+                    return endpoint
+                waits.append(wait)
+            time.sleep(min(waits))
+
+    def _send_hedged(self, endpoint:rpc_endpoint, data:bytes, exclude:list)->bytes:
+        p95 = endpoint.p95
+        if not self.hedge or p95 == None or len(self.endpoints) < 2:
+            return self._post(endpoint, data)
+
+        executor = self._get_executor()
+        primary = executor.submit(self._post, endpoint, data)
+        try:
+            return primary.result(timeout=p95)
+        except concurrent.futures.TimeoutError:
+            pass
+
+        # slow request: send a copy to another endpoint and keep the first answer
+        other = self.choose_endpoint(exclude=list(exclude)+[endpoint])
+        if other == endpoint:
+            return primary.result()
+        self.hedged += 1
+        futures = {primary, executor.submit(self._post, other, data)}
+        error = None
+        while len(futures) > 0:
+            done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except _transient_error as e:
+                    error = e
+        raise error
+
+    def _post(self, endpoint:rpc_endpoint, data:bytes)->bytes:
+        response = endpoint.post(data)
+        # rate limited by the node ( answered with a JSON-RPC error )
+        if _is_rate_limited(response):
+            endpoint.failed(cooldown=1)
+            raise _transient_error("{} rate limited".format(endpoint.url), sent=False)
+        return response
+
+    def _get_executor(self)->concurrent.futures.ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor == None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+                # threads stop with the router
+                weakref.finalize(self, self._executor.shutdown, wait=False)
+            return self._executor
+
+    def _check_slow_endpoints(self):
+        """ take out of rotation endpoints much slower than the best """
+        p95s = {x:x.p95 for x in self.endpoints if x.available and x.p95 != None}
+        if len(p95s) < 2:
+            return
+        best = min(p95s.values())
+        for endpoint, p95 in p95s.items():
+            if p95 > best * self.slow_factor and len([x for x in self.endpoints if x.available]) > 1:
+                with endpoint._lock:
+                    endpoint._latencies.clear()
+                endpoint.failed(cooldown=60)
+
+
+_routers = dict()
+_routers_lock = threading.Lock()
+
+def get_router(urls, **kwargs)->rpc_router:
+    """ Shared router for a set of endpoints, so every object talking to the same chain reuses its connection pool.
+        Routers with different endpoint or router options are not shared.
+
+     Args:
+        urls (str, dict or list): endpoint url(s) or rpc_endpoint options ( {"url":, "max_rps":, "timeout":, "pool_size":} )
+        kwargs: rpc_router options ( max_retries, backoff, hedge, slow_factor, max_workers )
+
+     Returns:
+        rpc_router:
+     """
+    endpoints = [{"url":x} if isinstance(x, str) else dict(x) for x in ([urls] if isinstance(urls, (str, dict)) else urls)]
+    key = (tuple(tuple(sorted(x.items())) for x in endpoints), tuple(sorted(kwargs.items())))
+    with _routers_lock:
+        if not key in _routers:
+            _routers[key] = rpc_router(endpoints=[rpc_endpoint(**x) for x in endpoints], **kwargs)
+        return _routers[key]
+
+
+def make_batch_request(provider, requests:list)->list:
+    """ Send several requests as one JSON-RPC batch array ( one http request ).
+        Providers not able to send batches get the requests one by one.
+
+     Args:
+        provider: web3 provider
+        requests (list): [ (method, params), ...]
+
+     Returns:
+        list: JSON-RPC responses in the same order ( {"result":...} or {"error":...} )
+     """
+    try:
+        if hasattr(provider, "make_batch_request"):
+            return provider.make_batch_request(requests)
+        if isinstance(provider, HTTPProvider):
+            return _decode_batch_response(make_post_request(provider.endpoint_uri, _encode_batch_request(requests), **provider.get_request_kwargs()), len(requests))
+    except ValueError as e:
+        logging.getLogger(__name__).warning(" {} does not accept batch requests ({}). Sending them one by one".format(provider, e))
+    return [provider.make_request(method, params) for method, params in requests]
+
+
+def _is_read(data:bytes)->bool:
+    """ all methods of a raw JSON-RPC request ( single or batch ) are READ_METHODS """
+    try:
+        request = json.loads(data)
+    except ValueError:
+        return False
+    requests = request if isinstance(request, list) else [request]
+    return all(isinstance(x, dict) and x.get("method", None) in READ_METHODS for x in requests)
+
+def _is_rate_limited(response:bytes)->bool:
+    """ the top level JSON-RPC error object of a response is a rate limit one ( results are not looked into ) """
+    if response.lstrip()[:1] != b"{" or not b'"error"' in response:
+        return False
+    try:
+        error = json.loads(response).get("error", None)
+    except ValueError:
+        return False
+    if not isinstance(error, dict):
+        return False
+    message = str(error.get("message", "")).lower()
+    return error.get("code", None) == 429 or "rate limit" in message or "too many requests" in message
+
+def _encode_batch_request(requests:list)->bytes:
+    return json.dumps([{"jsonrpc":"2.0", "method":method, "params":params, "id":i} for i, (method, params) in enumerate(requests)]).encode()
+
+def _decode_batch_response(raw:bytes, count:int)->list:
+    response = json.loads(raw)
+    if not isinstance(response, list):
+        # whole batch refused
+        raise ValueError(response.get("error", response) if isinstance(response, dict) else response)
+    result = [{"error":{"code":-32603, "message":"missing from batch response"}}]*count
+    for item in response:
+        if isinstance(item.get("id", None), int) and 0 <= item["id"] < count:
+            result[item["id"]] = item
+    return result
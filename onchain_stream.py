@@ -0,0 +1,307 @@
+import abc
+import json
+import asyncio
+import logging
+import itertools
+
+import websockets
+from web3 import Web3
+from web3._utils.method_formatters import log_entry_formatter
+
+from onchain_analysis_base import multicall3, rpc_batch, MULTICALL3_ADDRESS
+from onchain_fleet import hypervisor_refresher
+
+
+class ws_stream(abc.ABC):
+    """ Live snapshots pushed from a WebSocket JSON-RPC node.
+        Subscribes to newHeads and to the logs of log_filter(), and moves the in-memory snapshots to each new block
+        with the logs received for it ( update ). Blocks missed while disconnected are backfilled with get_chunked_events.
+        Subscribers get an async iterator of deltas: {"block":int, "address":str, "snapshot":dict, "changed":dict}
+
+        async for delta in stream.subscribe():
+            ...
+    """
+
+    def __init__(self, ws_url:str, wrapper, confirmations:int=1, reconnect_delay:float=1, max_reconnect_delay:float=60, queue_size:int=1000):
+        """
+         Args:
+            ws_url (str): ws(s) endpoint of the same chain as wrapper
+            wrapper (web3wrap): used to backfill logs with get_chunked_events ( http provider )
+            confirmations (int, optional): blocks behind the head snapshots follow, so that all logs of a block are received
+                                           before it is processed. Defaults to 1.
+            reconnect_delay (float, optional): seconds to wait before the first reconnection ( doubled each time ). Defaults to 1.
+            max_reconnect_delay (float, optional): Defaults to 60.
+            queue_size (int, optional): deltas kept for each slow subscriber ( oldest are dropped ). Defaults to 1000.
+         """
+        self.ws_url = ws_url
+        self.wrapper = wrapper
+        self.confirmations = confirmations
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.queue_size = queue_size
+
+        # last processed block and snapshots at that block ( address: snapshot )
+        self.block = None
+        self.snapshots = dict()
+
+        self._head = None
+        self._new_head = None
+        self._logs = list()   # received and not processed yet
+        self._taken = None    # last block whose logs were taken to be processed
+        self._invalid = set() # addresses with late or removed logs
+        self._backfill = False
+
+        self._queues = set()
+        self._tasks = list()
+        self._ids = itertools.count(1)
+        self._subscriptions = dict() # request id or subscription id: "newHeads" or "logs"
+
+        # stats
+        self.reconnections = 0
+
+   # SNAPSHOTS ( to be defined by subclasses )
+    @abc.abstractmethod
+    def log_filter(self)->dict:
+        """ addresses and topics of the events changing snapshots
+
+         Returns:
+            dict: {"address": [...], "topics": [...]}
+         """
+
+    @abc.abstractmethod
+    def update(self, block:int, logs:list, invalid:set)->dict:
+        """ Move snapshots to block ( runs in a thread )
+
+         Args:
+            block (int):
+            logs (list): event logs since the last update ( None for the first one )
+            invalid (set): lower case addresses to read again completely
+
+         Returns:
+            dict: {address: snapshot at block}
+         """
+
+   # SUBSCRIBERS
+    async def subscribe(self):
+        """ Async iterator of deltas. The stream is started with the first subscriber and closed when the last one leaves.
+
+         Yields:
+            dict: {"block":int, "address":str, "snapshot":dict, "changed": {key: value changed since the last snapshot}}
+         """
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._queues.add(queue)
+        self.start()
+        try:
+            while True:
+                item = await queue.get()
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self._queues.discard(queue)
+            if len(self._queues) == 0:
+                await self.close()
+
+    def start(self):
+        if len(self._tasks) == 0:
+            self._new_head = asyncio.Event()
+            self._tasks = [asyncio.ensure_future(self._run()), asyncio.ensure_future(self._process())]
+
+    async def close(self):
+        tasks, self._tasks = self._tasks, list()
+        for task in tasks:
+            if task != asyncio.current_task():
+                task.cancel()
+        for task in tasks:
+            if task != asyncio.current_task():
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+
+   # CONNECTION
+    async def _run(self):
+        """ keep connected and subscribed, reconnecting with backoff """
+        delay = self.reconnect_delay
+        while True:
+            try:
+                async with websockets.connect(self.ws_url, max_size=None) as ws:
+                    # blocks missed since the last processed one are backfilled on the first head
+                    self._backfill = self.block != None
+                    self._subscriptions = dict()
+                    # logs first, so that no log of a notified head is missed
+                    await self._send(ws, "eth_subscribe", ["logs", self.log_filter()], kind="logs")
+                    await self._send(ws, "eth_subscribe", ["newHeads"], kind="newHeads")
+                    delay = self.reconnect_delay
+                    async for message in ws:
+                        self._on_message(json.loads(message))
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+                logging.getLogger(__name__).warning(" {} disconnected ({}). Reconnecting in {:.0f} seconds".format(self.ws_url, e, delay))
+            except Exception as e:
+                self._broadcast(e)
+                raise
+            self.reconnections += 1
+            await asyncio.sleep(delay)
+            delay = min(delay*2, self.max_reconnect_delay)
+
+    async def _send(self, ws, method:str, params:list, kind:str):
+        request_id = next(self._ids)
+        self._subscriptions[request_id] = kind
+        await ws.send(json.dumps({"jsonrpc":"2.0", "id":request_id, "method":method, "params":params}))
+
+    def _on_message(self, message:dict):
+        # subscription answers
+        if "id" in message:
+            kind = self._subscriptions.pop(message["id"], None)
+            if "error" in message:
+                raise ValueError(" {} subscription to {} refused: {}".format(self.ws_url, kind, message["error"]))
+            self._subscriptions[message["result"]] = kind
+            return
+
+        params = message.get("params", {})
+        kind = self._subscriptions.get(params.get("subscription", None), None)
+        if kind == "newHeads":
+            self._head = int(params["result"]["number"], 16)
+            self._new_head.set()
+        elif kind == "logs":
+            log = log_entry_formatter(params["result"])
+            if log["removed"]:
+                self._logs = [x for x in self._logs if not (x["blockHash"] == log["blockHash"] and x["logIndex"] == log["logIndex"])]
+            if self._taken != None and log["blockNumber"] <= self._taken:
+                # reorged or late, after its block was processed: read its emitter again
+                logging.getLogger(__name__).debug(" {} log of {} at block {}".format("removed" if log["removed"] else "late", log["address"], log["blockNumber"]))
+                self._invalid.add(log["address"].lower())
+            elif not log["removed"]:
+                self._logs.append(log)
+
+   # PROCESSING
+    async def _process(self):
+        """ move snapshots to the last head ( minus confirmations ), skipping heads received while busy """
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._new_head.wait()
+            self._new_head.clear()
+            block = self._head - self.confirmations
+            if self.block != None and block <= self.block:
+                continue
+
+            # logs up to block: received, or backfilled after a disconnection ( None: first snapshot )
+            self._taken = block
+            logs = [x for x in self._logs if x["blockNumber"] <= block]
+            self._logs = [x for x in self._logs if x["blockNumber"] > block]
+            if self.block == None:
+                logs = None
+            elif self._backfill:
+                self._backfill = False
+                eventfilter = {"fromBlock":self.block+1, "toBlock":block, **self.log_filter()}
+                logs = await loop.run_in_executor(None, lambda: list(self.wrapper.get_chunked_events(eventfilter)))
+            else:
+                logs = [x for x in logs if x["blockNumber"] > self.block]
+            invalid, self._invalid = self._invalid, set()
+
+            try:
+                snapshots = await loop.run_in_executor(None, self.update, block, logs, invalid)
+            except Exception as e:
+                logging.getLogger(__name__).exception(" error updating snapshots to block {}: {}".format(block, e))
+                self._broadcast(e)
+                raise
+
+            for address, snapshot in snapshots.items():
+                last = self.snapshots.get(address, None)
+                if last is snapshot:
+                    continue
+                changed = {k:v for k, v in snapshot.items() if last == None or last.get(k, None) != v}
+                if len(changed) > 0:
+                    self._broadcast({"block":block, "address":address, "snapshot":snapshot, "changed":changed})
+            self.snapshots = dict(snapshots)
+            self.block = block
+
+    def _broadcast(self, item):
+        for queue in self._queues:
+            if queue.full():
+                # slow subscriber: drop its oldest delta
+                queue.get_nowait()
+                logging.getLogger(__name__).warning(" subscriber queue full: dropping oldest delta")
+            queue.put_nowait(item)
+
+
+class hypervisor_stream(ws_stream):
+    """ Live tvl_price_fee snapshots of many hypervisors of one chain ( see onchain_fleet.hypervisor_refresher ).
+        Each block only reads what its events made stale.
+
+        stream = hypervisor_stream(hypervisors=[gamma_hypervisor(address=x, web3Provider=w3) for x in addresses], ws_url="wss://...")
+        async for delta in stream.subscribe():
+            print(delta["block"], delta["address"], delta["changed"])
+    """
+
+    def __init__(self, hypervisors:list, ws_url:str, multicall_address:str=MULTICALL3_ADDRESS, batch:bool=False, **kwargs):
+        """
+         Args:
+            hypervisors (list): of gamma_hypervisor objects sharing the same provider
+            ws_url (str): ws(s) endpoint of the same chain
+            multicall_address (str, optional): Multicall3 contract address. Defaults to MULTICALL3_ADDRESS.
+            batch (bool, optional): use JSON-RPC batch requests instead of Multicall3. Defaults to False.
+            **kwargs: see ws_stream
+         """
+        self.refresher = hypervisor_refresher(hypervisors=hypervisors, multicall_address=multicall_address, batch=batch)
+        super().__init__(ws_url=ws_url, wrapper=hypervisors[0], **kwargs)
+
+    def log_filter(self)->dict:
+        return self.refresher.log_filter()
+
+    def update(self, block:int, logs:list, invalid:set)->dict:
+        if len(invalid) > 0:
+            self.refresher.invalidate(list(invalid))
+        return self.refresher.refresh(block=block, logs=logs)
+
+
+class pool_stream(ws_stream):
+    """ Live state of many Uniswap v3 pools of one chain: price, tick, liquidity and fee growth.
+        Only pools with Swap, Mint, Burn or Flash events in a block are read again.
+
+        async for delta in pool_stream(pools=[univ3_pool(address=x, web3Provider=w3) for x in addresses], ws_url="wss://...").subscribe():
+            print(delta["block"], delta["address"], delta["snapshot"]["tick"])
+    """
+
+    _events = ["Swap", "Mint", "Burn", "Flash"]
+
+    def __init__(self, pools:list, ws_url:str, multicall_address:str=MULTICALL3_ADDRESS, batch:bool=False, **kwargs):
+        """
+         Args:
+            pools (list): of univ3_pool objects sharing the same provider
+            ws_url (str): ws(s) endpoint of the same chain
+            multicall_address (str, optional): Multicall3 contract address. Defaults to MULTICALL3_ADDRESS.
+            batch (bool, optional): use JSON-RPC batch requests instead of Multicall3. Defaults to False.
+            **kwargs: see ws_stream
+         """
+        self.pools = {x.address.lower():x for x in pools}
+        self.multicall_address = multicall_address
+        self.batch = batch
+        super().__init__(ws_url=ws_url, wrapper=pools[0], **kwargs)
+
+    def log_filter(self)->dict:
+        abi_events = [x.get("name", "") for x in self.wrapper._abi if x.get("type", "") == "event"]
+        return {"address":[x.address for x in self.pools.values()],
+                "topics":[[self.wrapper.event_topic(x) for x in self._events if x in abi_events]]}
+
+    def update(self, block:int, logs:list, invalid:set)->dict:
+        if logs == None:
+            stale = set(self.pools.keys())
+        else:
+            stale = set(x["address"].lower() for x in logs) | invalid
+        stale &= set(self.pools.keys())
+
+        pools = [self.pools[x].at_block(block) for x in stale]
+        executor = rpc_batch() if self.batch else multicall3(address=self.multicall_address, web3Provider=self.wrapper.w3, block=block)
+        results = executor.execute([(pool, function_name, ()) for pool in pools
+                                        for function_name in ["slot0", "liquidity", "feeGrowthGlobal0X128", "feeGrowthGlobal1X128"]])
+
+        snapshots = dict(self.snapshots)
+        for i, pool in enumerate(pools):
+            slot0, liquidity, feeGrowthGlobal0X128, feeGrowthGlobal1X128 = results[i*4:i*4+4]
+            if slot0 == None:
+                logging.getLogger(__name__).warning(" could not read pool {} at block {}".format(pool.address, block))
+                continue
+            snapshots[Web3.toChecksumAddress(pool.address)] = {"sqrtPriceX96":slot0[0], "tick":slot0[1], "liquidity":liquidity,
+                                                               "feeGrowthGlobal0X128":feeGrowthGlobal0X128, "feeGrowthGlobal1X128":feeGrowthGlobal1X128}
+        return snapshots
@@ -0,0 +1,622 @@
+import math
+import copy
+import logging
+import numpy as np
+
+from onchain_analysis_base import univ3_pool, multicall3, rpc_batch, calculate_feeGrowthInside, calculate_tvlPriceFees, MULTICALL3_ADDRESS
+from onchain_records import slot0_record, tick_record, position_record
+
+
+_q128 = 2**128
+_q256 = 2**256
+
+# Uniswap v3 TickMath
+MIN_TICK = -887272
+MAX_TICK = 887272
+
+_q96 = 2**96
+_sqrt_ratios = [0xfff97272373d413259a46990580e213a, 0xfff2e50f5f656932ef12357cf3c7fdcc, 0xffe5caca7e10e4e61c3624eaa0941cd0,
+                0xffcb9843d60f6159c9db58835c926644, 0xff973b41fa98c081472e6896dfb254c0, 0xff2ea16466c96a3843ec78b326b52861,
+                0xfe5dee046a99a2a811c461f1969c3053, 0xfcbe86c7900a88aedcffc83b479aa3a4, 0xf987a7253ac413176f2b074cf7815e54,
+                0xf3392b0822b70005940c7a398e4b70f3, 0xe7159475a2c29b7443b29c7fa6e889d9, 0xd097f3bdfd2022b8845ad8f792aa5825,
+                0xa9f746462d870fdf8a65dc1f90e061e5, 0x70d869a156d2a1b890bb3df62baf32f7, 0x31be135f97d08fd981231505542fcfa6,
+                0x9aa508b5b7a84e1c677de54f3e99bc9, 0x5d6af8dedb81196699c329225ee604, 0x2216e584f5fa1ea926041bedfe98,
+                0x48a170391f7dc42444e8fa2]
+
+
+# UNISWAP V3 CONTRACT MATH ( exact integer ports )
+def getSqrtRatioAtTick(tick:int)->int:
+    """ sqrt(1.0001^tick) * 2^96 exactly as TickMath.getSqrtRatioAtTick """
+    absTick = abs(tick)
+    if absTick > MAX_TICK:
+        raise ValueError(" tick {} out of range".format(tick))
+    ratio = 0xfffcb933bd6fad37aa2d162d1a594001 if absTick & 0x1 else 0x100000000000000000000000000000000
+    for i, constant in enumerate(_sqrt_ratios):
+        if absTick & (0x2 << i):
+            ratio = (ratio * constant) >> 128
+    if tick > 0:
+        ratio = (_q256 - 1) // ratio
+    return (ratio >> 32) + (0 if ratio % (1 << 32) == 0 else 1)
+
+def _mulDivRoundingUp(a:int, b:int, denominator:int)->int:
+    return -(-(a * b) // denominator)
+
+def getAmount0Delta(sqrtRatioAX96:int, sqrtRatioBX96:int, liquidity:int, roundUp:bool)->int:
+    """ token0 amount between two prices as SqrtPriceMath.getAmount0Delta """
+    if sqrtRatioAX96 > sqrtRatioBX96:
+        sqrtRatioAX96, sqrtRatioBX96 = sqrtRatioBX96, sqrtRatioAX96
+    numerator1 = liquidity << 96
+    numerator2 = sqrtRatioBX96 - sqrtRatioAX96
+    if roundUp:
+        return -(-_mulDivRoundingUp(numerator1, numerator2, sqrtRatioBX96) // sqrtRatioAX96)
+    return (numerator1 * numerator2 // sqrtRatioBX96) // sqrtRatioAX96
+
+def getAmount1Delta(sqrtRatioAX96:int, sqrtRatioBX96:int, liquidity:int, roundUp:bool)->int:
+    """ token1 amount between two prices as SqrtPriceMath.getAmount1Delta """
+    if sqrtRatioAX96 > sqrtRatioBX96:
+        sqrtRatioAX96, sqrtRatioBX96 = sqrtRatioBX96, sqrtRatioAX96
+    if roundUp:
+        return _mulDivRoundingUp(liquidity, sqrtRatioBX96 - sqrtRatioAX96, _q96)
+    return liquidity * (sqrtRatioBX96 - sqrtRatioAX96) // _q96
+
+
+# VECTORIZED POSITION MATH
+def _int_array(values)->np.ndarray:
+    """ exact integer array ( python ints: uint256 values do not fit numpy integer types ) """
+    if isinstance(values, np.ndarray) and values.dtype == object:
+        return values
+    result = np.empty(len(values), dtype=object)
+    result[:] = [int(x) for x in values]
+    return result
+
+def calculate_feeGrowthInside_arrays(tick, tickLower, tickUpper, feeGrowthGlobalX128, feeGrowthOutsideX128_lower, feeGrowthOutsideX128_upper)->np.ndarray:
+    """ Fee growth inside tick ranges ( see onchain_analysis_base.calculate_feeGrowthInside ), wrapping around like uint256
+
+     Args:
+        tick, tickLower, tickUpper: int arrays
+        feeGrowthGlobalX128, feeGrowthOutsideX128_lower, feeGrowthOutsideX128_upper: int arrays ( python ints )
+
+     Returns:
+        np.ndarray: feeGrowthInsideX128 ( object array of python ints )
+     """
+    feeGrowthGlobalX128 = _int_array(feeGrowthGlobalX128)
+    feeGrowthOutsideX128_lower = _int_array(feeGrowthOutsideX128_lower)
+    feeGrowthOutsideX128_upper = _int_array(feeGrowthOutsideX128_upper)
+
+    feeGrowthBelowX128 = np.where(tick >= tickLower, feeGrowthOutsideX128_lower, feeGrowthGlobalX128 - feeGrowthOutsideX128_lower)
+    feeGrowthAboveX128 = np.where(tick < tickUpper, feeGrowthOutsideX128_upper, feeGrowthGlobalX128 - feeGrowthOutsideX128_upper)
+    return (feeGrowthGlobalX128 - feeGrowthBelowX128 - feeGrowthAboveX128) % _q256
+
+def calculate_tvlPriceFees_arrays(tick, tickLower, tickUpper, liquidity,
+                                  feeGrowthGlobal0X128, feeGrowthGlobal1X128,
+                                  feeGrowthOutside0X128_lower, feeGrowthOutside0X128_upper,
+                                  feeGrowthOutside1X128_lower, feeGrowthOutside1X128_upper,
+                                  feeGrowthInside0LastX128, feeGrowthInside1LastX128,
+                                  tokensOwed0, tokensOwed1, decimals_token0, decimals_token1, sqrtPriceX96=None)->dict:
+    """ Calculate TVL, price and uncollected fees, including owed, for many positions/blocks at once
+        from already read pool state ( same results as onchain_analysis_base.calculate_tvlPriceFees ).
+        Prices and amounts are calculated with float arrays while fee growth is calculated with exact integers
+        ( uint256 wraparound and floor division like the pool contract ).
+        All arguments are arrays ( or lists ) of the same length, decimals can also be single values.
+
+     Args:
+        tick: pool current tick ( slot0 )
+        tickLower:
+        tickUpper:
+        liquidity: positions liquidity
+        feeGrowthGlobal0X128:
+        feeGrowthGlobal1X128:
+        feeGrowthOutside0X128_lower: ticks(tickLower) feeGrowthOutside0X128
+        feeGrowthOutside0X128_upper: ticks(tickUpper) feeGrowthOutside0X128
+        feeGrowthOutside1X128_lower: ticks(tickLower) feeGrowthOutside1X128
+        feeGrowthOutside1X128_upper: ticks(tickUpper) feeGrowthOutside1X128
+        feeGrowthInside0LastX128: positions feeGrowthInside0LastX128
+        feeGrowthInside1LastX128: positions feeGrowthInside1LastX128
+        tokensOwed0: positions tokensOwed0
+        tokensOwed1: positions tokensOwed1
+        decimals_token0:
+        decimals_token1:
+        sqrtPriceX96 (optional): slot0 sqrtPriceX96, to use the exact pool price instead of the current tick's. Defaults to None.
+
+     Returns:
+        dict: same keys as univ3_pool.get_tvlPriceFees with np.ndarray values
+     """
+    tick = np.asarray(tick, dtype=np.int64)
+    tickLower = np.asarray(tickLower, dtype=np.int64)
+    tickUpper = np.asarray(tickUpper, dtype=np.int64)
+    liquidity_int = _int_array(liquidity)
+    liquidity = liquidity_int.astype(np.float64)
+    decimals_token0 = np.asarray(decimals_token0, dtype=np.int64)
+    decimals_token1 = np.asarray(decimals_token1, dtype=np.int64)
+    decimal_diff = decimals_token1 - decimals_token0
+
+    # PRICES (not decimal adjusted)
+    if sqrtPriceX96 is None:
+        sqrtPrice_current = np.power(1.0001, tick/2)
+    else:
+        sqrtPrice_current = _int_array(sqrtPriceX96).astype(np.float64) / 2**96
+    sqrtPrice_lower = np.power(1.0001, tickLower/2)
+    sqrtPrice_upper = np.power(1.0001, tickUpper/2)
+    price_current = sqrtPrice_current**2
+
+    # TVL: below the range all liquidity is token0, above all is token1
+    sqrtPrice = np.clip(sqrtPrice_current, sqrtPrice_lower, sqrtPrice_upper)
+    amount0 = liquidity * (1/sqrtPrice - 1/sqrtPrice_upper) / np.power(10.0, decimals_token0)
+    amount1 = liquidity * (sqrtPrice - sqrtPrice_lower) / np.power(10.0, decimals_token1)
+
+    # UNCOLLECTED FEES
+    feeGrowthInside0X128 = calculate_feeGrowthInside_arrays(tick=tick, tickLower=tickLower, tickUpper=tickUpper, feeGrowthGlobalX128=feeGrowthGlobal0X128,
+                                    feeGrowthOutsideX128_lower=feeGrowthOutside0X128_lower, feeGrowthOutsideX128_upper=feeGrowthOutside0X128_upper)
+    feeGrowthInside1X128 = calculate_feeGrowthInside_arrays(tick=tick, tickLower=tickLower, tickUpper=tickUpper, feeGrowthGlobalX128=feeGrowthGlobal1X128,
+                                    feeGrowthOutsideX128_lower=feeGrowthOutside1X128_lower, feeGrowthOutsideX128_upper=feeGrowthOutside1X128_upper)
+    fees0 = (((feeGrowthInside0X128 - _int_array(feeGrowthInside0LastX128)) % _q256) * liquidity_int // _q128).astype(np.float64) / np.power(10.0, decimals_token0)
+    fees1 = (((feeGrowthInside1X128 - _int_array(feeGrowthInside1LastX128)) % _q256) * liquidity_int // _q128).astype(np.float64) / np.power(10.0, decimals_token1)
+
+    return {"qtty_token0": amount0,
+            "qtty_token1": amount1,
+            "price_token0": price_current / np.power(10.0, decimal_diff),
+            "price_token1": np.power(10.0, decimal_diff) / price_current,
+            "fees_uncollected_token0": fees0,
+            "fees_uncollected_token1": fees1,
+            "fees_owed_token0": _int_array(tokensOwed0).astype(np.float64) / np.power(10.0, decimals_token0),
+            "fees_owed_token1": _int_array(tokensOwed1).astype(np.float64) / np.power(10.0, decimals_token1),
+        }
+
+
+# TICK MAP
+class tick_map():
+    """ Initialized ticks of a pool at a block, sorted, with their liquidity and the active liquidity of each range between them.
+        Liquidity values are exact python ints ( uint128 / int128 do not fit numpy integer types ).
+    """
+
+    def __init__(self, block:int, tickSpacing:int, ticks:list, liquidityGross:list, liquidityNet:list):
+        """
+         Args:
+            block (int): block the map is at
+            tickSpacing (int):
+            ticks (list): initialized ticks
+            liquidityGross (list): ticks liquidityGross
+            liquidityNet (list): ticks liquidityNet
+         """
+        self.block = block
+        self.tickSpacing = tickSpacing
+        order = np.argsort(np.asarray(ticks, dtype=np.int64), kind="stable")
+        self.ticks = np.asarray(ticks, dtype=np.int64)[order]
+        self.liquidityGross = _int_array(liquidityGross)[order]
+        self.liquidityNet = _int_array(liquidityNet)[order]
+        self._set_liquidity()
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def copy(self)->"tick_map":
+        """ Same map with its own arrays, to be updated without changing this one """
+        result = copy.copy(self)
+        result.ticks, result.liquidityGross, result.liquidityNet = self.ticks.copy(), self.liquidityGross.copy(), self.liquidityNet.copy()
+        result._set_liquidity()
+        return result
+
+    def _set_liquidity(self):
+        # active liquidity from each tick to the next
+        self.liquidity = np.cumsum(self.liquidityNet) if len(self.liquidityNet) > 0 else _int_array([])
+        self._liquidity_float = self.liquidity.astype(np.float64)
+
+   # LOOKUPS
+    def liquidity_at(self, tick:int)->int:
+        """ Active liquidity when the pool is at tick
+
+         Args:
+            tick (int):
+
+         Returns:
+            int: liquidity
+         """
+        i = np.searchsorted(self.ticks, tick, side="right") - 1
+        return int(self.liquidity[i]) if i >= 0 else 0
+
+    def segments(self, tickLower:int=MIN_TICK, tickUpper:int=MAX_TICK)->tuple:
+        """ Ranges of constant active liquidity between two ticks
+
+         Returns:
+            tuple: (lower ticks, upper ticks, liquidity as float) arrays
+         """
+        edges = np.concatenate(([tickLower], self.ticks[(self.ticks > tickLower) & (self.ticks < tickUpper)], [tickUpper]))
+        index = np.searchsorted(self.ticks, edges[:-1], side="right") - 1
+        liquidity = np.where(index >= 0, self._liquidity_float[np.maximum(index, 0)] if len(self.ticks) > 0 else 0.0, 0.0)
+        return edges[:-1], edges[1:], liquidity
+
+    def amounts(self, tick:int, tickLower:int=MIN_TICK, tickUpper:int=MAX_TICK, sqrtPriceX96:int=None)->tuple:
+        """ Tokens locked by all positions between two ticks when the pool is at tick ( range TVL, not decimal adjusted )
+
+         Args:
+            tick (int): pool current tick
+            tickLower (int, optional): Defaults to MIN_TICK.
+            tickUpper (int, optional): Defaults to MAX_TICK.
+            sqrtPriceX96 (int, optional): exact pool price instead of the tick's. Defaults to None.
+
+         Returns:
+            tuple: (amount0, amount1)
+         """
+        lower, upper, liquidity = self.segments(tickLower=tickLower, tickUpper=tickUpper)
+        sqrtPrice_lower = np.power(1.0001, lower/2)
+        sqrtPrice_upper = np.power(1.0001, upper/2)
+        sqrtPrice_current = sqrtPriceX96 / 2**96 if sqrtPriceX96 != None else math.pow(1.0001, tick/2)
+        sqrtPrice = np.clip(sqrtPrice_current, sqrtPrice_lower, sqrtPrice_upper)
+        amount0 = liquidity * (1/sqrtPrice - 1/sqrtPrice_upper)
+        amount1 = liquidity * (sqrtPrice - sqrtPrice_lower)
+        return float(amount0.sum()), float(amount1.sum())
+
+    def depth(self, tick:int, tick_target:int)->tuple:
+        """ Swap needed to move the pool price from tick to tick_target ( slippage, not decimal adjusted, fees not included )
+
+         Args:
+            tick (int): pool current tick
+            tick_target (int):
+
+         Returns:
+            tuple: (amount in, amount out): token1 in and token0 out when moving up, token0 in and token1 out when moving down
+         """
+        lower, upper, liquidity = self.segments(tickLower=min(tick, tick_target), tickUpper=max(tick, tick_target))
+        amount0 = float((liquidity * (1/np.power(1.0001, lower/2) - 1/np.power(1.0001, upper/2))).sum())
+        amount1 = float((liquidity * (np.power(1.0001, upper/2) - np.power(1.0001, lower/2))).sum())
+        return (amount1, amount0) if tick_target >= tick else (amount0, amount1)
+
+   # UPDATES
+    def apply(self, tickLower:int, tickUpper:int, amount:int):
+        """ Add ( Mint ) or remove ( Burn, negative amount ) liquidity of a position
+
+         Args:
+            tickLower (int):
+            tickUpper (int):
+            amount (int): liquidity
+         """
+        for tick, net in [(tickLower, amount), (tickUpper, -amount)]:
+            i = np.searchsorted(self.ticks, tick)
+            if i < len(self.ticks) and self.ticks[i] == tick:
+                self.liquidityGross[i] += amount
+                self.liquidityNet[i] += net
+            else:
+                self.ticks = np.insert(self.ticks, i, tick)
+                self.liquidityGross = np.insert(self.liquidityGross, i, amount)
+                self.liquidityNet = np.insert(self.liquidityNet, i, net)
+        # uninitialized ticks
+        keep = self.liquidityGross != 0
+        if not keep.all():
+            self.ticks, self.liquidityGross, self.liquidityNet = self.ticks[keep], self.liquidityGross[keep], self.liquidityNet[keep]
+        self._set_liquidity()
+
+    def update(self, pool:univ3_pool, block:int):
+        """ Move the map to a later block applying the pool's Mint and Burn events
+
+         Args:
+            pool (univ3_pool):
+            block (int):
+         """
+        if block <= self.block:
+            return
+        for event in pool.get_events(event_names=["Mint", "Burn"], fromBlock=self.block+1, toBlock=block):
+            amount = event.args.amount if event.event == "Mint" else -event.args.amount
+            # Burn with 0 amount is used to poke fees
+            if amount != 0:
+                self.apply(tickLower=event.args.tickLower, tickUpper=event.args.tickUpper, amount=amount)
+        self.block = block
+
+
+def load_tick_map(pool:univ3_pool, block:int=None, batch:bool=False, multicall_address:str=MULTICALL3_ADDRESS)->tick_map:
+    """ Read all the initialized ticks of a pool: every tickBitmap word of the pool's tick range, then every initialized tick,
+        both in bulk ( Multicall3 or JSON-RPC batch requests )
+
+     Args:
+        pool (univ3_pool):
+        block (int, optional): Defaults to pool's block.
+        batch (bool, optional): use JSON-RPC batch requests instead of Multicall3. Defaults to False.
+        multicall_address (str, optional): Multicall3 contract address. Defaults to MULTICALL3_ADDRESS.
+
+     Returns:
+        tick_map:
+     """
+    block = pool.block if block == None else block
+    if block != pool.block:
+        pool = univ3_pool(address=pool.address, web3Provider=pool.w3, block=block)
+    executor = rpc_batch() if batch else multicall3(address=multicall_address, web3Provider=pool.w3, block=block)
+    ticks, results = read_initialized_ticks(pool=pool, executor=executor)
+    return tick_map(block=block, tickSpacing=pool.tickSpacing, ticks=ticks,
+                    liquidityGross=[x[0] for x in results], liquidityNet=[x[1] for x in results])
+
+
+def read_initialized_ticks(pool:univ3_pool, executor)->tuple:
+    """ Scan the whole tickBitmap of a pool and read every initialized tick at the pool's block
+
+     Args:
+        pool (univ3_pool):
+        executor (multicall3 or rpc_batch): at the pool's block
+
+     Returns:
+        tuple: (ticks, ticks call results)
+     """
+    tickSpacing = pool.tickSpacing
+
+    # bitmap words: one bit per tickSpacing compressed tick
+    words = list(range((MIN_TICK // tickSpacing) >> 8, ((MAX_TICK // tickSpacing) >> 8) + 1))
+    bitmaps = executor.execute([(pool, "tickBitmap", (word,)) for word in words])
+
+    ticks = list()
+    for word, bitmap in zip(words, bitmaps):
+        if bitmap == None:
+            raise ValueError(" tickBitmap({}) of pool {} could not be read at block {}".format(word, pool.address, pool.block))
+        while bitmap:
+            bit = (bitmap & -bitmap).bit_length() - 1
+            ticks.append(((word << 8) + bit) * tickSpacing)
+            bitmap &= bitmap - 1
+    logging.getLogger(__name__).debug(" {} initialized ticks found in {} bitmap words of pool {}".format(len(ticks), len(words), pool.address))
+
+    results = executor.execute([(pool, "ticks", (tick,)) for tick in ticks])
+    if any(x == None for x in results):
+        raise ValueError(" ticks of pool {} could not be read at block {}".format(pool.address, pool.block))
+    return ticks, results
+
+
+# REPLAY
+class pool_replay():
+    """ Uniswap v3 pool state rebuilt locally: seeded from one snapshot, then moved forward applying the pool's
+        Swap, Mint, Burn, Collect ( and Flash, SetFeeProtocol, CollectProtocol ) events in order, with the contract's integer math.
+        slot0 ( price, tick and protocol fee ), liquidity, fee growth, ticks, positions and get_tvlPriceFees are then available
+        at any later block without calls to the node ( oracle observations are not replayed ).
+
+        replay = pool_replay(pool=univ3_pool(address, web3Provider, block=seed_block), owners=[hypervisor_address])
+        for block in replay.snapshots(blocks=range(seed_block, seed_block+10000)):
+            replay.get_tvlPriceFees(ownerAddress=hypervisor_address, tickUpper=..., tickLower=...)
+    """
+
+    _event_names = ["Swap", "Mint", "Burn", "Collect", "Flash", "SetFeeProtocol", "CollectProtocol"]
+
+    def __init__(self, pool:univ3_pool, owners:list=None, batch:bool=False, multicall_address:str=MULTICALL3_ADDRESS):
+        """
+         Args:
+            pool (univ3_pool): pool at the seed block
+            owners (list, optional): position owners to keep track of ( None for all ). Defaults to None.
+            batch (bool, optional): read the seed snapshot using JSON-RPC batch requests instead of Multicall3. Defaults to False.
+            multicall_address (str, optional): Multicall3 contract address. Defaults to MULTICALL3_ADDRESS.
+         """
+        self.pool = pool # stays at the seed block
+        self.owners = None if owners == None else {x.lower() for x in owners}
+        self.seed_block = pool.block
+        self.block = pool.block
+
+        executor = rpc_batch() if batch else multicall3(address=multicall_address, web3Provider=pool.w3, block=pool.block)
+        slot0, self.liquidity, self.feeGrowthGlobal0X128, self.feeGrowthGlobal1X128, self.fee, self.tickSpacing, protocolFees = executor.execute(
+            [(pool, x, ()) for x in ["slot0", "liquidity", "feeGrowthGlobal0X128", "feeGrowthGlobal1X128", "fee", "tickSpacing", "protocolFees"]])
+        self.sqrtPriceX96, self.tick, self.feeProtocol = slot0[0], slot0[1], slot0[5]
+        self.protocolFees = list(protocolFees)
+
+        ticks, results = read_initialized_ticks(pool=pool, executor=executor)
+        self.tick_map = tick_map(block=pool.block, tickSpacing=self.tickSpacing, ticks=ticks,
+                                 liquidityGross=[x[0] for x in results], liquidityNet=[x[1] for x in results])
+        # tick: [feeGrowthOutside0X128, feeGrowthOutside1X128]
+        self._feeGrowthOutside = {tick:[x[2], x[3]] for tick, x in zip(ticks, results)}
+        # (owner, tickLower, tickUpper): [liquidity, feeGrowthInside0LastX128, feeGrowthInside1LastX128, tokensOwed0, tokensOwed1]
+        self._positions = dict()
+
+   # STATE
+    @property
+    def slot0(self)->slot0_record:
+        """ same as univ3_pool.slot0 ( observation fields are None ) """
+        return slot0_record(sqrtPriceX96=self.sqrtPriceX96,
+                            tick=self.tick,
+                            observationIndex=None,
+                            observationCardinality=None,
+                            observationCardinalityNext=None,
+                            feeProtocol=self.feeProtocol,
+                            unlocked=True,
+                        )
+
+    def ticks(self, tick:int)->tick_record:
+        """ same as univ3_pool.ticks ( oracle fields are None ) """
+        i = np.searchsorted(self.tick_map.ticks, tick)
+        initialized = i < len(self.tick_map) and self.tick_map.ticks[i] == tick
+        feeGrowthOutside = self._feeGrowthOutside.get(tick, [0, 0])
+        return tick_record(liquidityGross=int(self.tick_map.liquidityGross[i]) if initialized else 0,
+                           liquidityNet=int(self.tick_map.liquidityNet[i]) if initialized else 0,
+                           feeGrowthOutside0X128=feeGrowthOutside[0],
+                           feeGrowthOutside1X128=feeGrowthOutside[1],
+                           tickCumulativeOutside=None,
+                           secondsPerLiquidityOutsideX128=None,
+                           secondsOutside=None,
+                           initialized=bool(initialized),
+                        )
+
+    def positions(self, ownerAddress:str, tickLower:int, tickUpper:int)->position_record:
+        """ same as univ3_pool.positions """
+        position = self._position(owner=ownerAddress, tickLower=tickLower, tickUpper=tickUpper)
+        if position == None:
+            raise ValueError(" positions of {} are not tracked ( see owners )".format(ownerAddress))
+        return position_record(*position[:5])
+
+    def get_tvlPriceFees(self, ownerAddress:str, tickUpper:int, tickLower:int)->dict:
+        """ same as univ3_pool.get_tvlPriceFees at the replay block """
+        return calculate_tvlPriceFees(position=self.positions(ownerAddress=ownerAddress, tickLower=tickLower, tickUpper=tickUpper),
+                                      tick=self.tick, tickUpper=tickUpper, tickLower=tickLower,
+                                      ticks_lower=self.ticks(tickLower), ticks_upper=self.ticks(tickUpper),
+                                      feeGrowthGlobal0X128=self.feeGrowthGlobal0X128, feeGrowthGlobal1X128=self.feeGrowthGlobal1X128,
+                                      decimals_token0=self.pool.token0.decimals, decimals_token1=self.pool.token1.decimals)
+
+   # REPLAY
+    def advance(self, block:int):
+        """ Apply the pool events up to block ( included )
+
+         Args:
+            block (int):
+         """
+        for x in self.snapshots(blocks=[block]):
+            pass
+
+    def snapshots(self, blocks:list):
+        """ Move the state forward stopping at each block ( events of the block included )
+
+         Args:
+            blocks (list): increasing block numbers, after the current replay block
+
+         Yields:
+            int: block the state is at
+         """
+        blocks = [x for x in sorted(blocks) if x >= self.block]
+        if len(blocks) == 0:
+            return
+        pending = iter(blocks)
+        next_block = next(pending)
+        event_names = [x for x in self._event_names if x in [e.get("name", "") for e in self.pool._abi if e.get("type", "") == "event"]]
+
+        events = self.pool.get_events(event_names=event_names, fromBlock=self.block+1, toBlock=blocks[-1]) if blocks[-1] > self.block else []
+        for event in events:
+            while event.blockNumber > next_block:
+                self.block = self.tick_map.block = next_block
+                yield next_block
+                next_block = next(pending)
+            self.apply(event)
+        while True:
+            self.block = self.tick_map.block = next_block
+            yield next_block
+            next_block = next(pending, None)
+            if next_block == None:
+                break
+
+    def apply(self, event):
+        """ Apply one decoded pool event ( see web3wrap.get_events ) """
+        args = event.args
+        if event.event == "Swap":
+            self._swap(amount0=args.amount0, amount1=args.amount1, sqrtPriceX96=args.sqrtPriceX96, liquidity=args.liquidity, tick=args.tick)
+        elif event.event == "Mint":
+            self._modify_position(owner=args.owner, tickLower=args.tickLower, tickUpper=args.tickUpper, liquidityDelta=args.amount)
+        elif event.event == "Burn":
+            position = self._modify_position(owner=args.owner, tickLower=args.tickLower, tickUpper=args.tickUpper, liquidityDelta=-args.amount)
+            if position != None:
+                position[3] = (position[3] + args.amount0) % _q128
+                position[4] = (position[4] + args.amount1) % _q128
+        elif event.event == "Collect":
+            position = self._position(owner=args.owner, tickLower=args.tickLower, tickUpper=args.tickUpper)
+            if position != None:
+                position[3] -= args.amount0
+                position[4] -= args.amount1
+        elif event.event == "Flash":
+            for i, paid in enumerate([args.paid0, args.paid1]):
+                if paid > 0:
+                    feeProtocol = self.feeProtocol % 16 if i == 0 else self.feeProtocol >> 4
+                    fees = 0 if feeProtocol == 0 else paid // feeProtocol
+                    self.protocolFees[i] += fees
+                    self._add_feeGrowth(token=i, amount=paid - fees)
+        elif event.event == "SetFeeProtocol":
+            self.feeProtocol = args.feeProtocol0New + (args.feeProtocol1New << 4)
+        elif event.event == "CollectProtocol":
+            self.protocolFees[0] -= args.amount0
+            self.protocolFees[1] -= args.amount1
+
+   # HELPERS
+    def _add_feeGrowth(self, token:int, amount:int):
+        if self.liquidity > 0:
+            if token == 0:
+                self.feeGrowthGlobal0X128 = (self.feeGrowthGlobal0X128 + amount * _q128 // self.liquidity) % _q256
+            else:
+                self.feeGrowthGlobal1X128 = (self.feeGrowthGlobal1X128 + amount * _q128 // self.liquidity) % _q256
+
+    def _next_initialized_tick(self, tick:int, lte:bool)->tuple:
+        """ TickBitmap.nextInitializedTickWithinOneWord: steps never go past a bitmap word """
+        ticks = self.tick_map.ticks
+        compressed = tick // self.tickSpacing
+        if lte:
+            lowest = ((compressed >> 8) << 8) * self.tickSpacing
+            i = np.searchsorted(ticks, compressed * self.tickSpacing, side="right") - 1
+            return (int(ticks[i]), True) if i >= 0 and ticks[i] >= lowest else (lowest, False)
+        compressed += 1
+        highest = (((compressed >> 8) << 8) + 255) * self.tickSpacing
+        i = np.searchsorted(ticks, compressed * self.tickSpacing, side="left")
+        return (int(ticks[i]), True) if i < len(ticks) and ticks[i] <= highest else (highest, False)
+
+    def _swap(self, amount0:int, amount1:int, sqrtPriceX96:int, liquidity:int, tick:int):
+        """ Walk the swap from the current price to the event's price, tick by tick as the pool does,
+            splitting the input amount in each step's amount and fee ( only the last step's fee is not derived from its amount )
+        """
+        if amount0 > 0 or amount1 > 0:
+            zeroForOne = amount0 > 0
+            remaining = amount0 if zeroForOne else amount1
+            feeProtocol = self.feeProtocol % 16 if zeroForOne else self.feeProtocol >> 4
+
+            while True:
+                tickNext, initialized = self._next_initialized_tick(self.tick, lte=zeroForOne)
+                tickNext = min(max(tickNext, MIN_TICK), MAX_TICK)
+                sqrtPriceNextX96 = getSqrtRatioAtTick(tickNext)
+                target = max(sqrtPriceNextX96, sqrtPriceX96) if zeroForOne else min(sqrtPriceNextX96, sqrtPriceX96)
+
+                if zeroForOne:
+                    amountIn = getAmount0Delta(target, self.sqrtPriceX96, self.liquidity, True)
+                else:
+                    amountIn = getAmount1Delta(self.sqrtPriceX96, target, self.liquidity, True)
+                last = target == sqrtPriceX96
+                feeAmount = remaining - amountIn if last else _mulDivRoundingUp(amountIn, self.fee, 10**6 - self.fee)
+                remaining -= amountIn + feeAmount
+
+                if feeProtocol > 0:
+                    self.protocolFees[0 if zeroForOne else 1] += feeAmount // feeProtocol
+                    feeAmount -= feeAmount // feeProtocol
+                self._add_feeGrowth(token=0 if zeroForOne else 1, amount=feeAmount)
+
+                self.sqrtPriceX96 = target
+                if target == sqrtPriceNextX96:
+                    if initialized:
+                        # cross the tick
+                        outside = self._feeGrowthOutside[tickNext]
+                        outside[0] = (self.feeGrowthGlobal0X128 - outside[0]) % _q256
+                        outside[1] = (self.feeGrowthGlobal1X128 - outside[1]) % _q256
+                        liquidityNet = int(self.tick_map.liquidityNet[np.searchsorted(self.tick_map.ticks, tickNext)])
+                        self.liquidity += -liquidityNet if zeroForOne else liquidityNet
+                    self.tick = tickNext - 1 if zeroForOne else tickNext
+                if last:
+                    break
+
+        self.sqrtPriceX96 = sqrtPriceX96
+        self.tick = tick
+        if self.liquidity != liquidity:
+            logging.getLogger(__name__).warning(" replay of pool {} liquidity {} differs from the Swap event's {}".format(self.pool.address, self.liquidity, liquidity))
+            self.liquidity = liquidity
+
+    def _position(self, owner:str, tickLower:int, tickUpper:int)->list:
+        """ tracked position state, read at the seed block the first time ( None when not tracked ) """
+        if self.owners != None and not owner.lower() in self.owners:
+            return None
+        key = (owner.lower(), tickLower, tickUpper)
+        if not key in self._positions:
+            # untouched since the seed block
+            position = self.pool.positions(self.pool.get_positionKey(ownerAddress=owner, tickLower=tickLower, tickUpper=tickUpper))
+            self._positions[key] = [position["liquidity"], position["feeGrowthInside0LastX128"], position["feeGrowthInside1LastX128"],
+                                    position["tokensOwed0"], position["tokensOwed1"]]
+        return self._positions[key]
+
+    def _modify_position(self, owner:str, tickLower:int, tickUpper:int, liquidityDelta:int)->list:
+        """ UniswapV3Pool._modifyPosition """
+        if liquidityDelta != 0:
+            # initialize new ticks fee growth outside
+            for tick in [tickLower, tickUpper]:
+                if not tick in self._feeGrowthOutside:
+                    self._feeGrowthOutside[tick] = [self.feeGrowthGlobal0X128, self.feeGrowthGlobal1X128] if tick <= self.tick else [0, 0]
+            self.tick_map.apply(tickLower=tickLower, tickUpper=tickUpper, amount=liquidityDelta)
+
+        position = self._position(owner=owner, tickLower=tickLower, tickUpper=tickUpper)
+        if position != None:
+            feeGrowthInside = [calculate_feeGrowthInside(tick=self.tick, tickLower=tickLower, tickUpper=tickUpper, feeGrowthGlobalX128=feeGrowthGlobal,
+                                                         feeGrowthOutsideX128_lower=self._feeGrowthOutside.get(tickLower, [0, 0])[i],
+                                                         feeGrowthOutsideX128_upper=self._feeGrowthOutside.get(tickUpper, [0, 0])[i])
+                               for i, feeGrowthGlobal in enumerate([self.feeGrowthGlobal0X128, self.feeGrowthGlobal1X128])]
+            for i in range(2):
+                tokensOwed = ((feeGrowthInside[i] - position[1+i]) % _q256) * position[0] // _q128
+                position[3+i] = (position[3+i] + tokensOwed) % _q128
+                position[1+i] = feeGrowthInside[i]
+            position[0] += liquidityDelta
+
+        if liquidityDelta < 0:
+            # cleared ticks
+            for tick in [tickLower, tickUpper]:
+                i = np.searchsorted(self.tick_map.ticks, tick)
+                if not (i < len(self.tick_map) and self.tick_map.ticks[i] == tick):
+                    self._feeGrowthOutside.pop(tick, None)
+        if tickLower <= self.tick < tickUpper:
+            self.liquidity += liquidityDelta
+        return position
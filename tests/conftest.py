@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+# modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    """ empty process wide call cache, metadata store and block index ( in tmp_path ), so tests do not share chain reads """
+    import onchain_analysis_base as base
+    from onchain_cache import call_cache, metadata_store, block_index
+
+    monkeypatch.setattr(base, "_shared", dict())
+    monkeypatch.setattr(base.web3wrap, "_call_cache", call_cache())
+    monkeypatch.setattr(base.web3wrap, "_metadata_store", metadata_store(filename=str(tmp_path / "metadata.sqlite")))
+    monkeypatch.setattr(base.web3wrap, "_block_index", block_index(filename=str(tmp_path / "blocks.sqlite")))
+    yield base.web3wrap
+    base.web3wrap._metadata_store.close()
+    base.web3wrap._block_index.close()
+
+
+
+@pytest.fixture(scope="session")
+def chain():
+    """ mock hypervisor fleet on a local eth-tester chain ( see benchmarks/mock_chain.py ) """
+    pytest.importorskip("eth_tester")
+    from benchmarks.mock_chain import mock_chain
+    return mock_chain(fleet_size=3, ticks_per_pool=20, events_per_hypervisor=5, blocks=200, seed=1)
@@ -0,0 +1,242 @@
+""" web3wrap, univ3_pool and gamma_hypervisor reads against the mock chain ( see benchmarks/mock_chain.py ) """
+import json
+import math
+import random
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from web3.exceptions import ContractLogicError
+
+import onchain_analysis_base as base
+from onchain_cache import metadata_store
+from onchain_analysis_base import erc20, univ3_pool, gamma_hypervisor, batch_result, rpc_batch
+
+
+@pytest.fixture(scope="module")
+def uneven_chain():
+    """ chain with 300 blocks two seconds apart but for a day long gap after the 100th one ( block interpolation misses ) """
+    pytest.importorskip("eth_tester")
+    from benchmarks.mock_chain import mock_chain
+    result = mock_chain(fleet_size=1, ticks_per_pool=10, events_per_hypervisor=0, blocks=0)
+    timestamp = result.tester.get_block_by_number("latest")["timestamp"]
+    for block in range(1, 301):
+        timestamp += 86400 if block == 100 else 2
+        result.tester.time_travel(timestamp)
+    return result
+
+
+def _expected_blocks(blocks:list, timestamps:list)->list:
+    """ highest block with a timestamp lower or equal to each timestamp ( blocks: [ (block, timestamp), ...] ) """
+    times = [x[1] for x in blocks]
+    return [blocks[bisect.bisect_right(times, x) - 1][0] for x in timestamps]
+
+
+def _cold(stores):
+    """ forget the calls read so far ( immutable values stay in the metadata store ) """
+    stores._call_cache.clear()
+    base._shared.clear()
+
+
+# SNAPSHOTS
+@pytest.mark.parametrize("mode", [{"multicall":True}, {"batch":True}])
+def test_tvl_price_fee_bulk_reads(chain, stores, mode):
+    w3 = chain.web3()
+    block = chain.head
+    bulk = [gamma_hypervisor(address=x["address"], web3Provider=w3, block=block).tvl_price_fee(multicall_address=chain.multicall, **mode)
+            for x in chain.hypervisors]
+    bulk_methods = dict(w3.provider.methods)
+    bulk_requests = w3.provider.requests
+
+    _cold(stores)
+    w3.provider.reset_counts()
+    plain = [gamma_hypervisor(address=x["address"], web3Provider=w3, block=block).tvl_price_fee() for x in chain.hypervisors]
+
+    assert bulk == plain
+    # two bulk requests per hypervisor ( besides chain id requests )
+    assert bulk_requests - bulk_methods.get("eth_chainId", 0) == 2 * len(chain.hypervisors)
+    assert w3.provider.methods["eth_call"] > 10 * len(chain.hypervisors)
+
+
+# BATCH REQUESTS
+def test_batch_block_reads(chain, stores):
+    w3 = chain.web3()
+    hypervisor = chain.hypervisors[0]
+    pool = univ3_pool(address=hypervisor["pool"], web3Provider=w3, block=chain.head)
+    token = erc20(address=chain.tokens[0]["address"], web3Provider=w3, block=chain.head)
+    # immutables are needed right away: known before the block
+    pool.chain_id, token.decimals
+    w3.provider.reset_counts()
+
+    with pool.batch():
+        slot0 = pool.slot0
+        tick = slot0["tick"]
+        liquidity = pool.liquidity
+        lower = pool.ticks(hypervisor["baseLower"])
+        supply = token.totalSupply
+        # not an initialized tick: the mock pool reverts
+        missing = pool.ticks(hypervisor["baseLower"] + 1)
+        assert isinstance(tick, batch_result) and w3.provider.requests == 0
+    # one batch request on exit
+    assert w3.provider.requests == 1 and w3.provider.methods["eth_call"] == 5
+
+    values = (slot0.result(), tick.result(), liquidity.result(), lower.result(), supply.result())
+    with pytest.raises(ContractLogicError):
+        missing.result()
+
+    _cold(stores)
+    plain = univ3_pool(address=pool.address, web3Provider=w3, block=pool.block)
+    assert values == (plain.slot0, plain.slot0["tick"], plain.liquidity, plain.ticks(hypervisor["baseLower"]),
+                      erc20(address=token.address, web3Provider=w3, block=token.block).totalSupply)
+
+
+def test_batch_execute(chain, stores):
+    w3 = chain.web3()
+    pool = univ3_pool(address=chain.pools[0]["address"], web3Provider=w3, block=chain.head)
+    results = rpc_batch(max_calls=2).execute([(pool, "liquidity", ()), (pool, "fee", ()), (pool, "ticks", (1,)), (pool, "tickSpacing", ())])
+    assert results[0] == pool.liquidity and results[1] == pool.fee and results[3] == chain.pools[0]["tickSpacing"]
+    # failed calls are None
+    assert results[2] == None
+    # 2 calls per batch request
+    assert w3.provider.methods["eth_call"] == 4 and w3.provider.requests - w3.provider.methods["eth_chainId"] == 2
+
+
+def test_batch_result_operators():
+    value = batch_result(compute=lambda: 10)
+    assert not value == None and value != None
+    assert repr(value) == "batch_result(pending)"
+    assert ((value + 2).result(), (2 - value).result(), (value * value).result(), (value / 4).result(), (value // 3).result(),
+            (value % 3).result(), (value ** 2).result(), (-value).result()) == (12, -8, 100, 2.5, 3, 1, 100, -10)
+    assert value == 10 and value > 9 and int(value) == 10 and [1, 2, 3][batch_result(compute=lambda: 1)] == 2
+    with pytest.raises(TypeError):
+        hash(value)
+    with pytest.raises(TypeError):
+        list(value)
+
+
+# CALL CACHE
+def test_concurrent_identical_calls_are_sent_once(chain, stores):
+    w3 = chain.web3(latency=0.05)
+    pool = univ3_pool(address=chain.pools[0]["address"], web3Provider=w3, block=chain.head)
+    pool.chain_id
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda i: univ3_pool(address=pool.address, web3Provider=w3, block=pool.block).slot0, range(8)))
+
+    assert all(x == results[0] for x in results)
+    assert w3.provider.methods["eth_call"] == 1
+    assert stores._call_cache.coalesced + stores._call_cache.hits == 7
+
+
+# METADATA STORE
+def test_immutables_read_once_across_processes(chain, stores, tmp_path, monkeypatch):
+    w3 = chain.web3()
+    token = chain.tokens[0]["address"]
+    first = erc20(address=token, web3Provider=w3, block=chain.head)
+    values = (first.decimals, first.symbol)
+    stores.flush_stores()
+
+    # a new process: empty call cache, same metadata file
+    monkeypatch.setattr(base.web3wrap, "_metadata_store", metadata_store(filename=stores._metadata_store.filename))
+    _cold(stores)
+    w3.provider.reset_counts()
+    later = erc20(address=token, web3Provider=w3, block=chain.head + 1)
+    assert (later.decimals, later.symbol) == values
+    assert w3.provider.methods["eth_call"] == 0
+
+
+# BLOCKS FROM TIMESTAMPS
+@pytest.mark.parametrize("chain_name", ["chain", "uneven_chain"])
+def test_blockNumbersFromTimestamps(chain_name, stores, request):
+    chain = request.getfixturevalue(chain_name)
+    w3 = chain.web3()
+    blocks = chain.block_timestamps()
+    rnd = random.Random(4)
+    timestamps = [rnd.randint(blocks[0][1], blocks[-1][1]) for _ in range(40)] + [x[1] for x in rnd.sample(blocks, 10)] + [blocks[-1][1] + 1000]
+    wrapper = gamma_hypervisor(address=chain.hypervisors[0]["address"], web3Provider=w3, block=chain.head)
+    wrapper.chain_id
+
+    # first search: interpolation falls back to bisection, about two probes per halving at most ( besides head and genesis )
+    middle = blocks[len(blocks)*2//3]
+    assert wrapper.blockNumberFromTimestamp(middle[1] + 1) == _expected_blocks(blocks, [middle[1] + 1])[0]
+    assert w3.provider.methods["eth_getBlockByNumber"] <= 2 + 2 * math.ceil(math.log2(len(blocks)))
+
+    found = wrapper.blockNumbersFromTimestamps(timestamps)
+    assert found == _expected_blocks(blocks, timestamps[:-1]) + [chain.head]
+
+    # known blocks cost no queries
+    w3.provider.reset_counts()
+    assert [wrapper.blockNumberFromTimestamp(x) for x in timestamps[:10]] == found[:10]
+    assert w3.provider.requests == 0
+
+    with pytest.raises(ValueError):
+        wrapper.blockNumberFromTimestamp(blocks[0][1] - 1)
+
+
+# EVENT LOGS
+def _rebalances(chain, w3, **kwargs)->list:
+    wrapper = gamma_hypervisor(address=chain.hypervisors[0]["address"], web3Provider=w3, block=chain.head)
+    eventfilter = {"fromBlock":0, "toBlock":chain.head, "address":[x["address"] for x in chain.hypervisors], "topics":[[wrapper.event_topic("Rebalance")]]}
+    return [(x["blockNumber"], x["logIndex"], x["address"]) for x in wrapper.get_chunked_events(eventfilter, **kwargs)]
+
+
+def test_get_logs_splits_refused_ranges(chain, stores):
+    expected = _rebalances(chain, chain.web3())
+    assert len(expected) == len(chain.hypervisors) * chain.config["events_per_hypervisor"]
+    assert expected == sorted(expected)
+
+    w3 = chain.web3(max_logs=2)
+    assert _rebalances(chain, w3, max_blocks=chain.head + 1) == expected
+    # the whole range was refused and split until every part had 2 logs at most
+    assert w3.provider.methods["eth_getLogs"] > 1 + len(expected) // 2
+
+
+@pytest.mark.parametrize("message, split", [("query returned more than 10000 results", True),
+                                            ("eth_getLogs block range is too wide", True),
+                                            ("Log response size exceeded", True),
+                                            ("daily request rate limit exceeded", False),
+                                            ("429 Client Error: Too Many Requests", False),
+                                            ("execution reverted", False)])
+def test_log_range_errors(message, split):
+    assert base._is_log_range_error(ValueError({"code":-32005, "message":message})) == split
+    assert base._is_log_range_error(ConnectionError("query timeout")) == False
+
+
+# HISTORY
+def test_history_resumes_from_checkpoint(chain, stores, tmp_path, monkeypatch):
+    w3 = chain.web3()
+    hypervisor = gamma_hypervisor(address=chain.hypervisors[0]["address"], web3Provider=w3, block=chain.head)
+    blocks = [10, 50, 100, 150, 200]
+    checkpoint = str(tmp_path / "history.jsonl")
+    expected = hypervisor.history(blocks=blocks, multicall_address=chain.multicall, max_workers=2).to_dict()
+    assert expected["block"] == blocks
+
+    # interrupted at block 150
+    history_row = gamma_hypervisor._history_row
+    def failing_row(self, block, *args):
+        if block == 150:
+            raise ConnectionError("node down")
+        return history_row(self, block, *args)
+    monkeypatch.setattr(gamma_hypervisor, "_history_row", failing_row)
+    with pytest.raises(ConnectionError):
+        hypervisor.history(blocks=blocks, checkpoint=checkpoint, multicall_address=chain.multicall, max_workers=1)
+    with open(checkpoint) as f:
+        saved = [json.loads(x)["block"] for x in f]
+    assert 0 < len(saved) < len(blocks) and not 150 in saved
+
+    # resume reads only the blocks missing
+    read = list()
+    def counted_row(self, block, *args):
+        read.append(block)
+        return history_row(self, block, *args)
+    monkeypatch.setattr(gamma_hypervisor, "_history_row", counted_row)
+    resumed = hypervisor.history(blocks=blocks, checkpoint=checkpoint, multicall_address=chain.multicall)
+    assert sorted(read) == sorted(set(blocks) - set(saved))
+    assert resumed.to_dict() == expected
+    with open(checkpoint) as f:
+        assert sorted(json.loads(x)["block"] for x in f) == blocks
+
+    # every block saved: nothing read, rows of other blocks in the checkpoint left out
+    read.clear()
+    assert hypervisor.history(blocks=blocks[1:], checkpoint=checkpoint, multicall_address=chain.multicall).to_dict() == \
+                {k:v[1:] for k, v in expected.items()}
+    assert read == []
@@ -0,0 +1,142 @@
+""" call cache and persistent sqlite stores """
+import json
+import time
+import sqlite3
+import threading
+
+import pytest
+
+from onchain_cache import call_cache, metadata_store, event_store
+
+
+ADDRESS = "0xAbCdEF0123456789aBcDeF0123456789ABCDef01"
+TOPIC0 = "0xDDF252AD1BE2C89B69C2B068FC378DAA952BA7F163C4A11628F55A4DF523B3EF"
+
+
+def _row(block:int, log_index:int=0, address:str=ADDRESS, topic0:str=TOPIC0)->dict:
+    return {"address":address, "topic0":topic0, "block":block, "log_index":log_index, "transaction_index":0,
+            "transaction_hash":"0x" + "{:064x}".format(block), "block_hash":"0x" + "{:064x}".format(block),
+            "topics":json.dumps([topic0]), "data":"0x"}
+
+
+@pytest.fixture
+def events(tmp_path):
+    store = event_store(filename=str(tmp_path / "onchain.sqlite"))
+    yield store
+    store.close()
+
+
+def _together(count:int, func)->list:
+    """ func() results ( or exceptions ) of count threads started at once """
+    barrier = threading.Barrier(count)
+    results = [None]*count
+    def run(i):
+        barrier.wait()
+        try:
+            results[i] = func()
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+# CALL CACHE
+def test_call_cache_singleflight():
+    cache = call_cache()
+    executions = list()
+    def read():
+        executions.append(1)
+        time.sleep(0.2)
+        return {"value":1}
+
+    results = _together(8, lambda: cache.get_or_call(key=(1, "0xpool", "0x3850c7bd", 100), func=read))
+    assert len(executions) == 1
+    assert all(x is results[0] for x in results)
+    assert (cache.misses, cache.coalesced, cache.hits) == (1, 7, 0)
+    assert cache.get_or_call(key=(1, "0xpool", "0x3850c7bd", 100), func=read) is results[0] and cache.hits == 1
+
+
+def test_call_cache_singleflight_errors():
+    cache = call_cache()
+    executions = list()
+    def failing():
+        executions.append(1)
+        time.sleep(0.2)
+        raise ConnectionError("node down")
+
+    results = _together(4, lambda: cache.get_or_call(key="slot0", func=failing))
+    assert len(executions) == 1
+    assert all(isinstance(x, ConnectionError) for x in results)
+    # errors are not cached
+    assert not "slot0" in cache
+    assert cache.get_or_call(key="slot0", func=lambda: 5) == 5
+
+
+def test_call_cache_evicts_least_recently_used():
+    cache = call_cache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert ("a" in cache, "b" in cache, "c" in cache) == (True, False, True)
+
+
+# METADATA STORE
+def test_metadata_store_round_trip(tmp_path):
+    filename = str(tmp_path / "onchain.sqlite")
+    values = {"decimals":18, "symbol":"WETH", "token0":ADDRESS, "fees":[500, 3000], "info":{"name":"Wrapped Ether"}}
+    store = metadata_store(filename=filename, flush_every=3)
+    for field, value in values.items():
+        store.save(chain_id=1, address=ADDRESS, field=field, value=value)
+    store.save(chain_id=137, address=ADDRESS, field="decimals", value=6)
+    # flushed and pending rows
+    assert store.load(chain_id=1, address=ADDRESS.lower()) == values
+    store.close()
+
+    store = metadata_store(filename=filename)
+    try:
+        assert store.load(chain_id=1, address=ADDRESS) == values
+        assert store.load(chain_id=137, address=ADDRESS) == {"decimals":6}
+        assert store.load(chain_id=10, address=ADDRESS) == {}
+        # last value saved wins
+        store.save(chain_id=137, address=ADDRESS, field="decimals", value=8)
+        assert store.load(chain_id=137, address=ADDRESS) == {"decimals":8}
+    finally:
+        store.close()
+
+
+# EVENT STORE
+def test_event_store_checksum_addresses(events):
+    events.save(chain_id=1, pairs=[(ADDRESS, TOPIC0)], logs=[_row(3), _row(7, 1)], fromBlock=0, toBlock=10, toBlock_hash="0x10")
+
+    assert events.synced(1, ADDRESS, TOPIC0) == (0, 10, "0x10")
+    for address in (ADDRESS, ADDRESS.lower()):
+        assert [(x["block"], x["log_index"]) for x in events.logs(chain_id=1, addresses=[address], topic0s=[TOPIC0], fromBlock=0, toBlock=10)] == [(3, 0), (7, 1)]
+    assert list(events.logs(chain_id=1, addresses=[ADDRESS], topic0s=[TOPIC0], fromBlock=4, toBlock=10))[0]["address"] == ADDRESS.lower()
+
+    events.rollback(chain_id=1, address=ADDRESS, topic0=TOPIC0, block=5)
+    assert events.synced(1, ADDRESS, TOPIC0) == (0, 5, None)
+    assert [x["block"] for x in events.logs(chain_id=1, addresses=[ADDRESS], topic0s=[TOPIC0], fromBlock=0, toBlock=10)] == [3]
+
+
+def test_event_store_lowers_old_rows(tmp_path):
+    filename = str(tmp_path / "onchain.sqlite")
+    store = event_store(filename=filename)
+    store.connection
+    store.close()
+    # a row saved with its checksum address
+    connection = sqlite3.connect(filename)
+    connection.execute("INSERT INTO logs (chain_id, {}) VALUES (1,{})".format(", ".join(event_store._fields), ",".join(["?"]*len(event_store._fields))),
+                       [_row(3)[x] for x in event_store._fields])
+    connection.commit()
+    connection.close()
+
+    store = event_store(filename=filename)
+    try:
+        assert [x["block"] for x in store.logs(chain_id=1, addresses=[ADDRESS], topic0s=[TOPIC0], fromBlock=0, toBlock=10)] == [3]
+    finally:
+        store.close()
@@ -0,0 +1,100 @@
+""" stage and merge pipelines: dropped items, errors, timeouts and consumers closing early """
+import time
+import logging
+import threading
+
+import pytest
+
+from onchain_export import stage, merge
+
+
+def _until(condition, timeout:float=5):
+    for _ in range(int(timeout/0.01)):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError(" condition not met in {} seconds".format(timeout))
+
+
+def _endless(state:dict):
+    """ numbers until closed ( state["produced"], state["closed"] ) """
+    state.update({"produced":0, "closed":False})
+    try:
+        while True:
+            state["produced"] += 1
+            yield state["produced"]
+    finally:
+        state["closed"] = True
+
+
+def _failing(items:list, error:Exception):
+    yield from items
+    raise error
+
+
+# STAGE
+def test_stage_drops_none_and_failing_items(caplog):
+    def func(x):
+        if x == 3:
+            raise ValueError("bad item")
+        return None if x % 5 == 0 else x*10
+
+    with caplog.at_level(logging.ERROR, logger="onchain_export"):
+        results = sorted(stage(range(20), func, workers=3, queue_size=2))
+    assert results == [x*10 for x in range(20) if x != 3 and x % 5 != 0]
+    assert [x.getMessage() for x in caplog.records] == [" func failed on 3: bad item"]
+
+
+def test_stage_passes_input_errors_on():
+    results = list()
+    with pytest.raises(ConnectionError, match="node down"):
+        for result in stage(_failing([1, 2], ConnectionError("node down")), lambda x: x, workers=2):
+            results.append(result)
+    assert len(results) <= 2
+
+
+def test_stage_closed_early_stops_upstream():
+    threads = threading.active_count()
+    state = dict()
+    calls = list()
+    first = stage(_endless(state), lambda x: calls.append(x) or x, workers=2, queue_size=2)
+    second = stage(first, lambda x: x + 1, workers=2, queue_size=2)
+    assert next(second) > 1
+    second.close()
+
+    # the source and every worker thread end, without running the whole source
+    _until(lambda: state["closed"] and threading.active_count() == threads)
+    assert len(calls) < 50 and state["produced"] < 50
+
+
+# MERGE
+def test_merge_leaves_failing_sources_out(caplog):
+    with caplog.at_level(logging.ERROR, logger="onchain_export"):
+        items = sorted(merge({"a":[1, 2, 3], "b":_failing([10, 20], ValueError("bad source")), "c":iter([])}, queue_size=2))
+    assert items == [1, 2, 3, 10, 20]
+    assert [x.getMessage() for x in caplog.records] == [" b failed: bad source"]
+
+
+def test_merge_timeout(caplog):
+    release = threading.Event()
+    def slow():
+        yield "slow first"
+        release.wait(5)
+        yield "slow second"
+
+    started = time.monotonic()
+    with caplog.at_level(logging.ERROR, logger="onchain_export"):
+        items = list(merge({"fast":["fast"], "slow":slow()}, timeout=0.3))
+    release.set()
+    assert sorted(items) == ["fast", "slow first"]
+    assert time.monotonic() - started < 3
+    assert [x.getMessage() for x in caplog.records] == [" ['slow'] did not finish in 0.3 seconds"]
+
+
+def test_merge_closed_early_closes_sources():
+    threads = threading.active_count()
+    states = {"a":dict(), "b":dict()}
+    merged = merge({name:_endless(state) for name, state in states.items()}, queue_size=2)
+    assert next(merged) >= 1
+    merged.close()
+    _until(lambda: all(x["closed"] for x in states.values()) and threading.active_count() == threads)
@@ -0,0 +1,144 @@
+""" hypervisor_refresher and rebalance_apr against the mock chain ( see benchmarks/mock_chain.py ) """
+import pytest
+from web3 import Web3
+from eth_abi import abi
+from eth_utils import event_abi_to_log_topic
+
+from onchain_analysis_base import gamma_hypervisor, _abi_types
+from onchain_fleet import hypervisor_refresher, rebalance_apr
+
+
+def _rebalance_blocks(chain, w3)->dict:
+    """ {block: [hypervisor addresses]} of the Rebalance events """
+    hypervisor = gamma_hypervisor(address=chain.hypervisors[0]["address"], web3Provider=w3)
+    result = dict()
+    for log in w3.eth.get_logs({"fromBlock":0, "toBlock":chain.head, "address":[x["address"] for x in chain.hypervisors],
+                                "topics":[hypervisor.event_topic("Rebalance")]}):
+        result.setdefault(log["blockNumber"], list()).append(log["address"])
+    return result
+
+
+def _pool_log(pool, event_name:str, block:int, values:dict)->dict:
+    """ node log of a pool event """
+    event = [x for x in pool._abi if x.get("type", "") == "event" and x["name"] == event_name][0]
+    indexed = [x for x in event["inputs"] if x.get("indexed", False)]
+    data = [x for x in event["inputs"] if not x.get("indexed", False)]
+    return {"address":pool.address, "blockNumber":block, "logIndex":0, "transactionIndex":0, "removed":False,
+            "transactionHash":"0x" + "{:064x}".format(block), "blockHash":"0x" + "{:064x}".format(block),
+            "topics":[event_abi_to_log_topic(event)] + [abi.encode_single(x["type"], values[x["name"]]) for x in indexed],
+            "data":Web3.toHex(abi.encode_abi(_abi_types(data), [values[x["name"]] for x in data]))}
+
+
+@pytest.fixture
+def refresher(chain, stores):
+    w3 = chain.web3()
+    return hypervisor_refresher(hypervisors=[gamma_hypervisor(address=x["address"], web3Provider=w3) for x in chain.hypervisors], batch=True)
+
+
+def _calls(refresher)->int:
+    """ eth_calls sent since the last _calls ( batch contents included ) """
+    provider = next(iter(refresher.hypervisors.values())).w3.provider
+    result = provider.methods["eth_call"]
+    provider.reset_counts()
+    return result
+
+
+# REFRESHER
+def test_refresher_reads_hypervisors_with_events(chain, refresher):
+    w3 = next(iter(refresher.hypervisors.values())).w3
+    rebalances = _rebalance_blocks(chain, w3)
+    # a block with one rebalance, not the first one
+    block = next(x for x in sorted(rebalances) if x > min(rebalances) and len(rebalances[x]) == 1 and not x - 1 in rebalances)
+    changed = rebalances[block][0]
+
+    refresher.refresh(block=block - 1)
+    _calls(refresher)
+    results = refresher.refresh(block=block)
+    # everything of the rebalanced hypervisor: 4 ranges, 3 pool, 2 positions, 2 balances and 4 ticks reads
+    assert _calls(refresher) == 15
+    for address, result in results.items():
+        assert result == gamma_hypervisor(address=address, web3Provider=w3, block=block).tvl_price_fee()
+    assert refresher.block == block
+
+    # a block delta without events: nothing read
+    quiet = next(x for x in range(block + 1, chain.head + 1) if not x in rebalances)
+    refresher.refresh(block=quiet)
+    assert _calls(refresher) == 0
+    assert refresher.results == results
+    # invalidated hypervisors are read again
+    refresher.invalidate([changed])
+    refresher.refresh(block=quiet + 1, logs=[])
+    assert _calls(refresher) == 15
+
+
+def test_refresher_pool_events(chain, refresher):
+    refresher.refresh(block=10)
+    hypervisor = next(iter(refresher.hypervisors.values()))
+    pool, tick = hypervisor.pool, chain.hypervisors[0]["tick"]
+    swap = {"sender":hypervisor.address, "recipient":hypervisor.address, "amount0":1, "amount1":-1, "sqrtPriceX96":2**96, "liquidity":1}
+    _calls(refresher)
+
+    # swaps inside the hypervisor ranges: slot0 and fee growth
+    refresher.refresh(block=11, logs=[_pool_log(pool, "Swap", 11, {**swap, "tick":tick})])
+    assert _calls(refresher) == 3
+    # crossing a range tick: its fee growth outside too
+    refresher.refresh(block=12, logs=[_pool_log(pool, "Swap", 12, {**swap, "tick":chain.hypervisors[0]["baseUpper"] + 1})])
+    assert _calls(refresher) == 3 + 4
+    # liquidity of others: nothing
+    mint = {"sender":hypervisor.address, "tickLower":-60, "tickUpper":60, "amount":1, "amount0":1, "amount1":1}
+    refresher.refresh(block=13, logs=[_pool_log(pool, "Mint", 13, {**mint, "owner":Web3.toChecksumAddress("0x" + "12"*20)})])
+    assert _calls(refresher) == 0
+    # liquidity of the hypervisor: positions and parked balances
+    refresher.refresh(block=14, logs=[_pool_log(pool, "Mint", 14, {**mint, "owner":hypervisor.address})])
+    assert _calls(refresher) == 4
+
+
+# REBALANCE APR
+def _readme_apr(rebalances:list)->float:
+    """ visor_v1 APR of rebalances ( see defillama_gamma_adaptors/README.md ) """
+    aggregated_fees = sum(x["grossFeesUSD"] for x in rebalances)
+    aggregated_tvl = sum(x["totalAmountUSD"] for x in rebalances)
+    time_passed = rebalances[-1]["timestamp"] - rebalances[0]["timestamp"]
+    average_tvl = (aggregated_tvl - aggregated_fees if aggregated_tvl >= aggregated_fees else aggregated_tvl)/len(rebalances)
+    yearly_fees = aggregated_fees/time_passed*60*60*24*365
+    return yearly_fees/average_tvl
+
+
+@pytest.mark.parametrize("window", [3, 100])
+def test_rebalance_apr_matches_readme_formula(chain, stores, window):
+    w3 = chain.web3()
+    hypervisors = [gamma_hypervisor(address=x["address"], web3Provider=w3) for x in chain.hypervisors]
+    prices = {hypervisors[0].pool.token0.address.lower():2.5, hypervisors[0].pool.token1.address.lower():0.4}
+    engine = rebalance_apr(hypervisors=hypervisors, window=window, usd_price=lambda token, block: prices.get(token.lower(), 1.0))
+    # the whole chain in uneven steps
+    for block in [17, 18, 90, chain.head]:
+        aprs = engine.update(block=block)
+
+    for hv in hypervisors:
+        rebalances = list()
+        for log in w3.eth.get_logs({"fromBlock":0, "toBlock":chain.head, "address":hv.address, "topics":[hv.event_topic("Rebalance")]}):
+            event = hv._contract.events.Rebalance().processLog(log)
+            price0, price1 = prices.get(hv.pool.token0.address.lower(), 1.0), prices.get(hv.pool.token1.address.lower(), 1.0)
+            decimals0, decimals1 = 10**hv.pool.token0.decimals, 10**hv.pool.token1.decimals
+            rebalances.append({"block":log["blockNumber"], "timestamp":w3.eth.get_block(log["blockNumber"])["timestamp"],
+                               "totalAmountUSD":event.args.totalAmount0/decimals0*price0 + event.args.totalAmount1/decimals1*price1,
+                               "grossFeesUSD":event.args.feeAmount0/decimals0*price0 + event.args.feeAmount1/decimals1*price1})
+        rebalances = rebalances[-window:]
+        assert [x["block"] for x in engine.rebalances(hv.address)] == [x["block"] for x in rebalances]
+        assert aprs[hv.address] == pytest.approx(_readme_apr(rebalances), rel=1e-12)
+
+
+def test_rebalance_apr_fee_heavy_windows(chain, stores):
+    hv = gamma_hypervisor(address=chain.hypervisors[0]["address"], web3Provider=chain.web3())
+    engine = rebalance_apr(hypervisors=[hv], window=3, usd_price=lambda token, block: 1.0)
+    assert engine.apr(hv.address) == None
+    rows = [{"block":block, "tick":0, "totalAmount0":total, "totalAmount1":0, "feeAmount0":fee, "feeAmount1":0}
+            for block, total, fee in [(1, 100, 10), (2, 120, 30), (3, 80, 20), (4, 10, 200)]]
+    expected = list()
+    for row in rows:
+        engine._add(address=hv.address, row=row, timestamp=row["block"]*3600)
+        expected.append({"timestamp":row["block"]*3600, "totalAmountUSD":row["totalAmount0"], "grossFeesUSD":row["feeAmount0"]})
+        if len(expected) > 1:
+            assert engine.apr(hv.address) == pytest.approx(_readme_apr(expected[-3:]), rel=1e-12)
+    # fees higher than the tvl are not subtracted
+    assert engine.apr(hv.address) == pytest.approx(250/7200*60*60*24*365/(210/3), rel=1e-12)
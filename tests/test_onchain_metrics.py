@@ -0,0 +1,84 @@
+""" call budgets: requests counted against what the node received, cache hits, threads and limits """
+import logging
+import threading
+
+import pytest
+
+from onchain_metrics import rpc_metrics, rpc_event, metrics
+from onchain_analysis_base import gamma_hypervisor
+
+
+def _rows(budget)->dict:
+    return {(x["kind"], x["contract"], x["function"]):x for x in budget.report()["rows"]}
+
+
+# CALL BUDGET
+def test_budget_aggregates_events():
+    recorder = rpc_metrics()
+    with recorder.budget("reads", max_requests=2) as budget:
+        recorder.record(rpc_event(kind="call", contract="univ3_pool", function="slot0", latency=0.5, size=10, cache="miss"))
+        recorder.record(rpc_event(kind="call", contract="univ3_pool", function="slot0", cache="hit"))
+        recorder.record(rpc_event(kind="multicall", contract="multicall3", function="aggregate3", latency=0.25, calls=3, size=100))
+        recorder.record(rpc_event(kind="call", contract="univ3_pool", function="ticks", calls=3, via="multicall", cache="miss", size=60))
+        recorder.record(rpc_event(kind="call", contract="erc20", function="decimals", latency=0.125, cache="miss", error=True))
+    # recorded after the block
+    recorder.record(rpc_event(kind="call", contract="univ3_pool", function="slot0", latency=1, cache="miss"))
+
+    assert (budget.requests, budget.hits, budget.misses, budget.latency, budget.size) == (3, 1, 3, 0.875, 170)
+    assert budget.exceeded and budget.wall_time != None
+    rows = _rows(budget)
+    assert {key:(x["calls"], x["requests"], x["hits"], x["misses"], x["errors"]) for key, x in rows.items()} == {
+                ("call", "univ3_pool", "slot0"):(2, 1, 1, 1, 0),
+                ("multicall", "multicall3", "aggregate3"):(3, 1, 0, 0, 0),
+                ("call", "univ3_pool", "ticks"):(3, 0, 0, 1, 0),
+                ("call", "erc20", "decimals"):(1, 1, 0, 1, 1)}
+
+
+def test_budget_threads_and_limits(caplog):
+    recorder = rpc_metrics()
+    def read():
+        recorder.record(rpc_event(kind="call", contract="erc20", function="balanceOf", latency=0.1, cache="miss"))
+
+    with caplog.at_level(logging.WARNING, logger="onchain_metrics"):
+        with recorder.budget("all", max_requests=1) as everything, recorder.budget("this thread", thread_only=True) as this_thread:
+            read()
+            worker = threading.Thread(target=read)
+            worker.start()
+            worker.join()
+    assert (everything.requests, this_thread.requests) == (2, 1)
+    assert everything.exceeded and not this_thread.exceeded
+    assert [x.getMessage() for x in caplog.records] == [" call budget all exceeded: 2 requests of 1 allowed"]
+
+    recorder.enabled = False
+    with recorder.budget("disabled") as disabled:
+        read()
+    assert disabled.requests == 0
+
+
+@pytest.mark.parametrize("multicall", [False, True])
+def test_budget_matches_node_requests(chain, stores, multicall):
+    w3 = chain.web3()
+    hypervisor = gamma_hypervisor(address=chain.hypervisors[0]["address"], web3Provider=w3, block=chain.head)
+    with metrics.budget("cold") as cold:
+        hypervisor.tvl_price_fee(multicall=multicall, multicall_address=chain.multicall)
+    with metrics.budget("warm") as warm:
+        hypervisor.tvl_price_fee(multicall=multicall, multicall_address=chain.multicall)
+    methods = w3.provider.methods
+
+    rows = _rows(cold)
+    calls = [x for x in rows.values() if x["kind"] == "call"]
+    # contract reads reached the node one by one or inside multicall requests
+    assert sum(x["requests"] for x in rows.values() if x["kind"] in ("call", "multicall")) == methods["eth_call"]
+    # besides the chain id the wrappers ask for, web3 validation asks for it before each eth_call
+    assert sum(x["requests"] for x in rows.values() if x["function"] == "eth_chainId") == methods["eth_chainId"] - methods["eth_call"]
+    assert cold.requests == w3.provider.requests - methods["eth_call"]
+    if multicall:
+        assert all(x["requests"] == 0 for x in calls)
+        assert rows[("multicall", "multicall3", "aggregate3")]["calls"] == sum(x["misses"] for x in calls)
+    else:
+        assert all(x["requests"] == x["misses"] for x in calls)
+    assert sum(x["calls"] for x in calls) == cold.hits + cold.misses
+
+    # everything from the call cache
+    assert warm.requests == 0 and warm.misses == 0
+    assert warm.hits == sum(x["calls"] for x in _rows(warm).values() if x["kind"] == "call") > 0
@@ -0,0 +1,162 @@
+""" usd_pricer routes and twap_oracle windows against mock pools of known depth, price and oracle observations """
+import math
+
+import pytest
+
+pytest.importorskip("eth_tester")
+
+from web3 import Web3
+
+from benchmarks.mock_chain import mock_chain, _responses, _load_abi
+from onchain_analysis_base import erc20, univ3_pool
+from onchain_pricing import usd_pricer, twap_oracle, _observe
+
+
+def _address(i:int)->str:
+    return Web3.toChecksumAddress("0x" + "{:02x}".format(i)*20)
+
+USD, WETH, WBTC, LONE0, LONE1 = [_address(0x71 + i) for i in range(5)]
+DECIMALS = {USD:6, WETH:18, WBTC:8, LONE0:18, LONE1:18}
+# deep and shallow pools of each pair: address: (token0, token1, token1 per token0, balance0, balance1)
+POOLS = {_address(0x91):(WETH, USD, 2000, 1000, 2*10**6),
+         _address(0x92):(WETH, USD, 1000, 1, 1000),
+         _address(0x93):(WETH, WBTC, 1/15, 500, 33),
+         _address(0x94):(WBTC, USD, 20000, 0.25, 5000),
+         _address(0x95):(LONE0, LONE1, 1, 1, 1)}
+DEEP_WETH, SHALLOW_WETH, WBTC_WETH, SHALLOW_WBTC, UNROUTED = POOLS.keys()
+# WETH/USD oracles: one reaching back the windows asked, one answered from its observations
+OBSERVED, RING = _address(0x96), _address(0x97)
+
+
+def _slot0(token0:str, token1:str, price:float)->tuple:
+    """ slot0 of a pool at a decimal adjusted token1 per token0 price """
+    sqrtPriceX96 = int(math.sqrt(price * 10**(DECIMALS[token1] - DECIMALS[token0])) * 2**96)
+    return (sqrtPriceX96, 0, 0, 1, 1, 0, True)
+
+
+def _pool_answers(token0:str, token1:str, price:float)->dict:
+    responses = _responses(_load_abi(univ3_pool))
+    responses.set("token0", result=token0)
+    responses.set("token1", result=token1)
+    responses.set("slot0", result=_slot0(token0, token1, price))
+    return responses.items
+
+
+@pytest.fixture(scope="module")
+def pricing_chain():
+    tokens = {address:_responses(_load_abi(erc20)) for address in DECIMALS.keys()}
+    for address, decimals in DECIMALS.items():
+        tokens[address].set("decimals", result=decimals)
+    for address, (token0, token1, price, balance0, balance1) in POOLS.items():
+        tokens[token0].set("balanceOf", address, result=int(balance0 * 10**DECIMALS[token0]))
+        tokens[token1].set("balanceOf", address, result=int(balance1 * 10**DECIMALS[token1]))
+    contracts = {address:responses.items for address, responses in tokens.items()}
+    contracts.update({address:_pool_answers(*values[:3]) for address, values in POOLS.items()})
+    contracts.update({OBSERVED:dict(), RING:dict()})
+    return mock_chain(fleet_size=0, blocks=3, contracts=contracts)
+
+
+@pytest.fixture
+def pricer(pricing_chain, stores):
+    w3 = pricing_chain.web3()
+    return usd_pricer(pools=[univ3_pool(address=x, web3Provider=w3, block=1) for x in POOLS.keys()], usd_tokens=[USD], batch=True)
+
+
+def _calls(pricer)->int:
+    """ eth_calls sent since the last _calls ( batch contents included ) """
+    provider = next(iter(pricer.pools.values())).w3.provider
+    result = provider.methods["eth_call"]
+    provider.reset_counts()
+    return result
+
+
+# USD PRICER
+def test_usd_pricer_routes_through_deepest_pools(pricer):
+    routes = pricer.update_routes(block=1)
+    # WETH from the deep pool, WBTC through WETH ( its pool holds more USD than the direct one )
+    assert routes == {WETH.lower():(DEEP_WETH.lower(), USD.lower()), WBTC.lower():(WBTC_WETH.lower(), WETH.lower())}
+    assert pricer.routes_block == 1
+
+    assert pricer.price(token=USD, block=1) == 1.0
+    assert pricer.price(token=WETH, block=1) == pytest.approx(2000, rel=1e-9)
+    assert pricer.price(token=WBTC, block=1) == pytest.approx(2000*15, rel=1e-9)
+    assert pricer(LONE0, 1) == None
+
+
+def test_usd_pricer_reads_routed_pools_once_per_block(pricing_chain, pricer):
+    pricer.update_routes(block=1)
+    _calls(pricer)
+    assert pricer.price(token=WBTC, block=2) == pytest.approx(30000, rel=1e-9)
+    # slot0 of the routed pools only
+    assert _calls(pricer) == 2
+    assert pricer.price(token=WETH, block=2) == pytest.approx(2000, rel=1e-9)
+    assert _calls(pricer) == 0 and (pricer.hits, pricer.misses) == (1, 1)
+
+    # the deep WETH pool moves: WBTC follows through its route
+    block = pricing_chain.set_responses(DEEP_WETH, _pool_answers(WETH, USD, 3000))
+    assert pricer.prices(block=block) == pytest.approx({USD.lower():1.0, WETH.lower():3000, WBTC.lower():45000}, rel=1e-9)
+    assert pricer.price(token=WETH, block=2) == pytest.approx(2000, rel=1e-9)
+
+
+# TWAP ORACLE
+def _tickCumulative(start:int, time:int)->int:
+    """ ring pool tick cumulative at time: tick 50 for 1000 seconds from start, -30 for 2000 seconds, then 80 """
+    points = [(start, 0, 50), (start + 1000, 50000, -30), (start + 3000, -10000, 80)]
+    since, cumulative, tick = [x for x in points if x[0] <= time][-1]
+    return cumulative + tick*(time - since)
+
+
+@pytest.fixture(scope="module")
+def oracle_block(pricing_chain):
+    """ block answering the oracle pools, from 5000 seconds after the first ring observation on
+
+     Returns:
+        tuple: (block, first ring observation timestamp)
+     """
+    start = pricing_chain.tester.get_block_by_number("latest")["timestamp"] - 5000
+    observed = _responses(_load_abi(univ3_pool))
+    for name, result in [("token0", WETH), ("token1", USD), ("slot0", _slot0(WETH, USD, 2000))]:
+        observed.set(name, result=result)
+    observed.set("observe", [0, 600], result=([5, 5 + 600*201 + 1], [0, 0]))
+    pricing_chain.set_responses(OBSERVED, observed.items)
+
+    ring = _responses(_load_abi(univ3_pool))
+    for name, result in [("token0", WETH), ("token1", USD), ("slot0", (2**96, 80, 1, 4, 4, 0, True))]:
+        ring.set(name, result=result)
+    # oldest first from observationIndex + 1, slot 2 not initialized yet
+    for i, time in [(3, start), (0, start + 1000), (1, start + 3000)]:
+        ring.set("observations", i, result=(time, _tickCumulative(start, time), 0, True))
+    ring.set("observations", 2, result=(0, 0, 0, False))
+    return pricing_chain.set_responses(RING, ring.items), start
+
+
+def test_observe_interpolates_like_the_pool():
+    observations = [(100, 0), (103, 10), (106, -12)]
+    assert _observe(observations=observations, tick=7, time=110, target=103) == 10
+    assert _observe(observations=observations, tick=7, time=110, target=101) == 3
+    # int56 division truncates toward zero
+    assert _observe(observations=observations, tick=7, time=110, target=105) == 10 - 7*2
+    assert _observe(observations=observations, tick=7, time=110, target=108) == -12 + 7*2
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_twap_falls_back_to_observations(pricing_chain, stores, oracle_block, batch):
+    block, start = oracle_block
+    w3 = pricing_chain.web3()
+    now = w3.eth.get_block(block)["timestamp"]
+    oracle = twap_oracle(multicall_address=pricing_chain.multicall, batch=batch)
+    observed, ring = [univ3_pool(address=x, web3Provider=w3, block=block) for x in (OBSERVED, RING)]
+
+    results = oracle.twaps(requests=[(observed, [600]), (ring, [600, 4000, 10**5])], block=block)
+    # mean ticks rounded to negative infinity
+    assert results[0][600]["tick"] == -202 and results[0][600]["seconds"] == 600
+    assert results[0][600]["price_token0"] == pytest.approx(1.0001**-202 * 10**12, rel=1e-12)
+    assert oracle.fallbacks == 1
+    for window, seconds in [(600, 600), (4000, 4000), (10**5, now - start)]:
+        expected = (_tickCumulative(start, now) - _tickCumulative(start, now - seconds)) // seconds
+        assert (results[1][window]["tick"], results[1][window]["seconds"]) == (expected, seconds)
+
+    # memoized
+    w3.provider.reset_counts()
+    assert oracle.twap(pool=ring, windows=[4000, 10**5]) == {x:results[1][x] for x in [4000, 10**5]}
+    assert w3.provider.methods["eth_call"] == 0
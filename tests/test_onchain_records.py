@@ -0,0 +1,74 @@
+""" records and record_table columns, typed and fallen back to lists """
+import pickle
+from array import array
+
+import pytest
+
+from onchain_records import record_table, snapshot_record, slot0_record, tick_record
+
+
+def _snapshot(number:int, **changes)->snapshot_record:
+    row = snapshot_record(number, 1700000000 + number*12, 1.5, 2.5, 1800.0, 1/1800, 0.01, 0.02, 0.0, 0.0)
+    return row.replace(**changes)
+
+
+# RECORD
+def test_record_behaves_like_a_dict():
+    row = slot0_record(sqrtPriceX96=2**96, tick=-5, observationIndex=1, observationCardinality=2, observationCardinalityNext=2,
+                       feeProtocol=0, unlocked=True)
+    assert row == {"sqrtPriceX96":2**96, "tick":-5, "observationIndex":1, "observationCardinality":2, "observationCardinalityNext":2,
+                   "feeProtocol":0, "unlocked":True}
+    assert row["tick"] == row.tick == -5 and slot0_record.from_dict(dict(row)) == row
+    assert row.replace(tick=7).tick == 7 and row.tick == -5
+    assert pickle.loads(pickle.dumps(row)) == row
+    with pytest.raises(AttributeError):
+        row.tick = 1
+    with pytest.raises(TypeError):
+        row.replace(price=1)
+    with pytest.raises(TypeError):
+        slot0_record(2**96, -5)
+
+
+# RECORD TABLE
+def test_record_table_typed_columns():
+    rows = [_snapshot(x) for x in range(5)]
+    table = record_table(snapshot_record, rows)
+    assert table.size == 5 and len(table) == len(snapshot_record._fields)
+    assert all(isinstance(table[x], array) for x in snapshot_record._fields)
+    assert list(table.rows()) == rows
+    assert table.to_dict()["block"] == [0, 1, 2, 3, 4]
+
+
+def test_record_table_falls_back_to_lists():
+    table = record_table(snapshot_record, [_snapshot(1), _snapshot(2)])
+    # uint256 in a 64 bit column and None in a float column
+    table.append(_snapshot(3, block=2**70, price_token0=None))
+    assert isinstance(table["block"], list) and isinstance(table["price_token0"], list)
+    assert isinstance(table["timestamp"], array)
+    assert list(table["block"]) == [1, 2, 2**70]
+    assert list(table["price_token0"]) == [1800.0, 1800.0, None]
+    # typed values keep going to the list columns
+    table.append(_snapshot(4))
+    assert [x.block for x in table.rows()] == [1, 2, 2**70, 4]
+    assert table.row(2) == _snapshot(3, block=2**70, price_token0=None)
+
+
+def test_record_table_set_falls_back_to_lists():
+    table = record_table(tick_record, size=3)
+    assert (table.row(1).tickCumulativeOutside, table.row(1).initialized) == (0, False)
+    table.set(1, tick_record(10, -10, 2**200, 2**201, -2**63, 2**160, 2**64, True))
+    table.set(2, tick_record(1, 1, 1, 1, 1, 1, 1, None))
+    # uint256 in a 64 bit column and None in a bool column
+    assert isinstance(table["secondsOutside"], list) and isinstance(table["initialized"], list)
+    assert isinstance(table["tickCumulativeOutside"], array)
+    assert list(table.rows())[1:] == [tick_record(10, -10, 2**200, 2**201, -2**63, 2**160, 2**64, True),
+                                      tick_record(1, 1, 1, 1, 1, 1, 1, None)]
+    assert table.to_dict()["initialized"] == [False, True, None] and table.row(0).secondsOutside == 0
+
+
+def test_record_table_to_numpy():
+    np = pytest.importorskip("numpy")
+    table = record_table(snapshot_record, [_snapshot(1), _snapshot(2, qtty_token0=None)])
+    columns = table.to_numpy()
+    assert columns["block"].dtype == np.int64 and list(columns["block"]) == [1, 2]
+    assert columns["qtty_token0"].dtype == object and list(columns["qtty_token0"]) == [1.5, None]
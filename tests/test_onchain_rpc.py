@@ -0,0 +1,156 @@
+""" rpc_router against local stub JSON-RPC servers: failover, 429 backoff, rate limit answers, hedging and writes sent once """
+import json
+import time
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from onchain_rpc import rpc_router, rpc_endpoint, get_router
+
+
+class stub_node():
+    """ Local JSON-RPC http server answering eth_blockNumber with its block.
+        answers: list of behaviours used by the next requests ( "429", "500", "rate_limit" ), then "ok"
+    """
+
+    def __init__(self, block:int, delay:float=0, answers:list=None):
+        self.block = block
+        self.delay = delay
+        self.answers = list(answers or [])
+        self.methods = list()
+        node = self
+
+        class handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                node.methods.append(request["method"])
+                answer = node.answers.pop(0) if len(node.answers) > 0 else "ok"
+                time.sleep(node.delay)
+                if answer in ("429", "500"):
+                    self.send_response(int(answer))
+                    self.end_headers()
+                    return
+                if answer == "rate_limit":
+                    body = {"jsonrpc":"2.0", "id":request["id"], "error":{"code":-32005, "message":"daily request rate limit exceeded"}}
+                elif request["method"] == "eth_call":
+                    # a result mentioning a rate limit is not a rate limit answer
+                    body = {"jsonrpc":"2.0", "id":request["id"], "result":"0x" + b"rate limit".hex()}
+                else:
+                    body = {"jsonrpc":"2.0", "id":request["id"], "result":hex(node.block)}
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.url = "http://127.0.0.1:{}".format(self._server.server_address[1])
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _closed_port_url()->str:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return "http://127.0.0.1:{}".format(s.getsockname()[1])
+
+
+@pytest.fixture
+def nodes():
+    created = list()
+    def create(*args, **kwargs):
+        created.append(stub_node(*args, **kwargs))
+        return created[-1]
+    yield create
+    for node in created:
+        node.close()
+
+
+def _primed(url:str, latency:float=0.01)->rpc_endpoint:
+    """ endpoint with a known p95 latency ( hedging needs latency stats ) """
+    endpoint = rpc_endpoint(url=url, timeout=5)
+    for _ in range(20):
+        endpoint.succeeded(latency=latency)
+    return endpoint
+
+
+def test_failover_to_next_endpoint(nodes):
+    node = nodes(block=100)
+    with rpc_router([_closed_port_url(), node.url], backoff=0.01) as router:
+        assert router.make_request("eth_blockNumber", [])["result"] == hex(100)
+        assert router.retries == 1
+        assert node.methods == ["eth_blockNumber"]
+
+
+def test_429_backoff(nodes):
+    node = nodes(block=7, answers=["429", "429"])
+    with rpc_router([node.url], backoff=0.1) as router:
+        start = time.monotonic()
+        assert router.make_request("eth_blockNumber", [])["result"] == hex(7)
+        # two retries waiting at least half of 0.1 and 0.2 seconds
+        assert time.monotonic() - start >= 0.15
+        assert len(node.methods) == 3 and router.retries == 2
+
+
+def test_rate_limit_error_answer(nodes):
+    limited, other = nodes(block=1, answers=["rate_limit"]), nodes(block=2)
+    with rpc_router([limited.url, other.url], backoff=0.01) as router:
+        assert router.make_request("eth_blockNumber", [])["result"] == hex(2)
+        # results are not looked into
+        assert router.make_request("eth_call", [{"to":"0x" + "11"*20, "data":"0x"}, "latest"])["result"] == "0x" + b"rate limit".hex()
+        assert router.retries == 1
+
+
+def test_hedging_slow_endpoint(nodes):
+    slow, fast = nodes(block=1, delay=1), nodes(block=2)
+    with rpc_router([_primed(slow.url), _primed(fast.url, latency=0.02)], slow_factor=100) as router:
+        start = time.monotonic()
+        assert router.make_request("eth_blockNumber", [])["result"] == hex(2)
+        assert time.monotonic() - start < 0.8
+        assert router.hedged == 1
+
+
+def test_transactions_are_not_hedged_or_resent(nodes):
+    slow, other = nodes(block=1, delay=0.3), nodes(block=2)
+    with rpc_router([_primed(slow.url), _primed(other.url, latency=0.02)], slow_factor=100, backoff=0.01) as router:
+        router.make_request("eth_sendRawTransaction", ["0x00"])
+        assert router.hedged == 0
+        assert slow.methods == ["eth_sendRawTransaction"] and other.methods == []
+
+    failing, other = nodes(block=1, answers=["500"]), nodes(block=2)
+    with rpc_router([failing.url, other.url], backoff=0.01) as router:
+        with pytest.raises(ConnectionError):
+            router.make_request("eth_sendRawTransaction", ["0x00"])
+        assert other.methods == []
+
+
+def test_transactions_retried_when_never_sent(nodes):
+    node = nodes(block=3)
+    with rpc_router([_closed_port_url(), node.url], backoff=0.01) as router:
+        router.make_request("eth_sendRawTransaction", ["0x00"])
+        assert node.methods == ["eth_sendRawTransaction"]
+
+
+def test_shared_routers_keep_endpoint_options(nodes):
+    node = nodes(block=5)
+    plain = get_router(node.url)
+    limited = get_router([{"url":node.url, "max_rps":2, "timeout":5}], hedge=False)
+    hedged = get_router([{"url":node.url, "max_rps":2, "timeout":5}])
+    try:
+        assert get_router([node.url]) is plain
+        assert get_router({"timeout":5, "max_rps":2, "url":node.url}, hedge=False) is limited
+        assert hedged not in (plain, limited)
+        assert (limited.endpoints[0].max_rps, limited.endpoints[0].timeout, limited.hedge) == (2, 5, False)
+        assert (plain.endpoints[0].max_rps, plain.hedge) == (0, True)
+        assert limited.make_request("eth_blockNumber", [])["result"] == hex(5)
+    finally:
+        for router in (plain, limited, hedged):
+            router.close()
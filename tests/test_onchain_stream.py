@@ -0,0 +1,149 @@
+""" ws_stream against a local WebSocket JSON-RPC server replaying heads and logs: late and removed logs, disconnection and backfill """
+import sys
+import json
+import asyncio
+
+import pytest
+
+websockets = pytest.importorskip("websockets")
+# websockets before 10 passes loop= to asyncio functions, removed in python 3.10
+if sys.version_info >= (3, 10) and int(websockets.__version__.split(".")[0]) < 10:
+    pytest.skip("websockets {} does not run on python {}.{}".format(websockets.__version__, *sys.version_info[:2]), allow_module_level=True)
+
+from onchain_stream import ws_stream
+
+
+EMITTER_A = "0x" + "aa"*20
+EMITTER_B = "0x" + "bb"*20
+TOPIC = "0x" + "11"*32
+
+
+def _head(subscription:str, number:int)->str:
+    return json.dumps({"jsonrpc":"2.0", "method":"eth_subscription",
+                       "params":{"subscription":subscription, "result":{"number":hex(number)}}})
+
+def _log(subscription:str, address:str, number:int, index:int=0, removed:bool=False)->str:
+    log = {"address":address, "blockNumber":hex(number), "blockHash":"0x" + "{:064x}".format(number), "logIndex":hex(index),
+           "transactionHash":"0x" + "{:064x}".format(number*100 + index), "transactionIndex":hex(index),
+           "data":"0x", "topics":[TOPIC], "removed":removed}
+    return json.dumps({"jsonrpc":"2.0", "method":"eth_subscription", "params":{"subscription":subscription, "result":log}})
+
+
+class backfill_wrapper():
+    """ get_chunked_events stand-in recording its filters """
+
+    def __init__(self, logs:list):
+        self.logs = logs
+        self.filters = list()
+
+    def get_chunked_events(self, eventfilter:dict):
+        self.filters.append(eventfilter)
+        return [x for x in self.logs if eventfilter["fromBlock"] <= x["blockNumber"] <= eventfilter["toBlock"]]
+
+
+class recording_stream(ws_stream):
+    """ snapshots are the last block each emitter was read at """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.updates = list()
+
+    def log_filter(self)->dict:
+        return {"address":[EMITTER_A, EMITTER_B], "topics":[TOPIC]}
+
+    def update(self, block:int, logs:list, invalid:set)->dict:
+        self.updates.append((block, None if logs == None else [(x["address"].lower(), x["blockNumber"]) for x in logs], set(invalid)))
+        stale = {EMITTER_A, EMITTER_B} if logs == None else set(x["address"].lower() for x in logs) | invalid
+        snapshots = dict(self.snapshots)
+        for address in stale:
+            snapshots[address] = {"read_at":block}
+        return snapshots
+
+
+async def _until(condition, timeout:float=5):
+    for _ in range(int(timeout/0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(" condition not met in {} seconds".format(timeout))
+
+
+async def _replay(stream:recording_stream):
+    """ serve two connections: heads and logs, late and removed logs and a disconnection, then a head after a gap """
+    connections = list()
+
+    async def handler(ws, path=None):
+        connections.append(ws)
+        logs, heads = "0xlogs{}".format(len(connections)), "0xheads{}".format(len(connections))
+        # subscription answers, in the client request order ( logs first )
+        for subscription in (logs, heads):
+            request = json.loads(await ws.recv())
+            await ws.send(json.dumps({"jsonrpc":"2.0", "id":request["id"], "result":subscription}))
+
+        if len(connections) == 1:
+            await ws.send(_head(heads, 10))
+            await _until(lambda: stream.block == 9)
+            await ws.send(_log(logs, EMITTER_A, 10))
+            await ws.send(_head(heads, 11))
+            await _until(lambda: stream.block == 10)
+            # late log of an already processed block and removal of a processed log
+            await ws.send(_log(logs, EMITTER_B, 9, index=3))
+            await ws.send(_log(logs, EMITTER_A, 10, removed=True))
+            await ws.send(_head(heads, 12))
+            await _until(lambda: stream.block == 11)
+            # disconnect
+            await ws.close()
+        else:
+            # blocks 12 to 19 were missed
+            await ws.send(_head(heads, 20))
+            await ws.wait_closed()
+
+    return await websockets.serve(handler, "127.0.0.1", 0)
+
+
+def test_stream_subclasses_define_snapshots():
+    class no_update(ws_stream):
+        def log_filter(self)->dict:
+            return {}
+
+    with pytest.raises(TypeError):
+        no_update(ws_url="", wrapper=None)
+
+
+def test_stream_reconnects_and_backfills():
+    async def run():
+        wrapper = backfill_wrapper(logs=[{"address":EMITTER_B, "blockNumber":15, "logIndex":0}])
+        stream = recording_stream(ws_url="", wrapper=wrapper, reconnect_delay=0.01)
+        server = await _replay(stream)
+        stream.ws_url = "ws://127.0.0.1:{}".format(server.sockets[0].getsockname()[1])
+
+        deltas = list()
+        iterator = stream.subscribe()
+        try:
+            async for delta in iterator:
+                deltas.append(delta)
+                if delta["block"] == 19:
+                    break
+        finally:
+            await iterator.aclose()
+            server.close()
+            await server.wait_closed()
+        return stream, wrapper, deltas
+
+    stream, wrapper, deltas = asyncio.run(asyncio.wait_for(run(), timeout=20))
+
+    assert stream.updates == [
+        # first snapshot reads everything
+        (9, None, set()),
+        # logs received for the block
+        (10, [(EMITTER_A, 10)], set()),
+        # late and removed logs of processed blocks: their emitters are read again
+        (11, [], {EMITTER_A, EMITTER_B}),
+        # after the reconnection the missed blocks are backfilled
+        (19, [(EMITTER_B, 15)], set()),
+    ]
+    assert stream.reconnections == 1
+    assert [(x["fromBlock"], x["toBlock"]) for x in wrapper.filters] == [(12, 19)]
+    assert sorted((x["block"], x["address"]) for x in deltas) == [(9, EMITTER_A), (9, EMITTER_B), (10, EMITTER_A), (11, EMITTER_A),
+                                                            (11, EMITTER_B), (19, EMITTER_B)]
+    assert stream.snapshots == {EMITTER_A:{"read_at":11}, EMITTER_B:{"read_at":19}}
@@ -0,0 +1,295 @@
+""" pool_replay against a mock pool whose answers follow a reference Uniswap v3 pool model, block by block """
+import copy
+import math
+import random
+
+import pytest
+
+pytest.importorskip("eth_tester")
+
+from web3 import Web3
+from eth_abi import abi
+from eth_utils import event_abi_to_log_topic
+
+from benchmarks.mock_chain import mock_chain, _responses, _load_abi
+from onchain_analysis_base import univ3_pool, _abi_types
+from onchain_univ3 import pool_replay, getSqrtRatioAtTick, getAmount0Delta, getAmount1Delta, MIN_TICK, MAX_TICK
+
+
+_q128 = 2**128
+_q256 = 2**256
+
+POOL = Web3.toChecksumAddress("0x" + "3a"*20)
+OWNERS = [Web3.toChecksumAddress("0x" + "{:02x}".format(0xa0 + i)*20) for i in range(4)]
+
+
+class reference_pool():
+    """ Uniswap v3 pool moved forward the way the contract does ( swaps computed from their input amount as SwapMath does ),
+        producing the events pool_replay reads
+    """
+
+    def __init__(self, tick:int, tickSpacing:int=60, fee:int=3000, feeProtocol:int=4 + (5 << 4)):
+        self.tickSpacing = tickSpacing
+        self.fee = fee
+        self.feeProtocol = feeProtocol
+        self.sqrtPriceX96 = getSqrtRatioAtTick(tick)
+        self.tick = tick
+        self.liquidity = 0
+        self.feeGrowthGlobal = [0, 0]
+        self.protocolFees = [0, 0]
+        self.ticks = dict() # tick: [liquidityGross, liquidityNet, feeGrowthOutside0X128, feeGrowthOutside1X128]
+        self.positions = dict() # (owner, tickLower, tickUpper): [liquidity, feeGrowthInside0LastX128, feeGrowthInside1LastX128, tokensOwed0, tokensOwed1]
+
+    def mint(self, owner:str, tickLower:int, tickUpper:int, amount:int)->dict:
+        amount0, amount1 = self._modify_position(owner, tickLower, tickUpper, amount)
+        return {"sender":owner, "owner":owner, "tickLower":tickLower, "tickUpper":tickUpper, "amount":amount, "amount0":amount0, "amount1":amount1}
+
+    def burn(self, owner:str, tickLower:int, tickUpper:int, amount:int)->dict:
+        amount0, amount1 = self._modify_position(owner, tickLower, tickUpper, -amount)
+        position = self.positions[(owner, tickLower, tickUpper)]
+        position[3] += amount0
+        position[4] += amount1
+        return {"owner":owner, "tickLower":tickLower, "tickUpper":tickUpper, "amount":amount, "amount0":amount0, "amount1":amount1}
+
+    def collect(self, owner:str, tickLower:int, tickUpper:int)->dict:
+        position = self.positions[(owner, tickLower, tickUpper)]
+        amount0, amount1 = position[3], position[4]
+        position[3] = position[4] = 0
+        return {"owner":owner, "recipient":owner, "tickLower":tickLower, "tickUpper":tickUpper, "amount0":amount0, "amount1":amount1}
+
+    def swap(self, zeroForOne:bool, amount:int, sqrtPriceLimitX96:int)->dict:
+        remaining, calculated = amount, 0
+        feeProtocol = self.feeProtocol % 16 if zeroForOne else self.feeProtocol >> 4
+        while remaining != 0 and self.sqrtPriceX96 != sqrtPriceLimitX96:
+            start = self.sqrtPriceX96
+            tickNext, initialized = self._next_initialized_tick(zeroForOne)
+            tickNext = min(max(tickNext, MIN_TICK), MAX_TICK)
+            sqrtPriceNextX96 = getSqrtRatioAtTick(tickNext)
+            target = max(sqrtPriceNextX96, sqrtPriceLimitX96) if zeroForOne else min(sqrtPriceNextX96, sqrtPriceLimitX96)
+            self.sqrtPriceX96, amountIn, amountOut, feeAmount = self._swap_step(target, remaining)
+            remaining -= amountIn + feeAmount
+            calculated -= amountOut
+            if feeProtocol > 0:
+                self.protocolFees[0 if zeroForOne else 1] += feeAmount // feeProtocol
+                feeAmount -= feeAmount // feeProtocol
+            if self.liquidity > 0:
+                i = 0 if zeroForOne else 1
+                self.feeGrowthGlobal[i] = (self.feeGrowthGlobal[i] + feeAmount * _q128 // self.liquidity) % _q256
+            if self.sqrtPriceX96 == sqrtPriceNextX96:
+                if initialized:
+                    outside = self.ticks[tickNext]
+                    outside[2] = (self.feeGrowthGlobal[0] - outside[2]) % _q256
+                    outside[3] = (self.feeGrowthGlobal[1] - outside[3]) % _q256
+                    self.liquidity += -outside[1] if zeroForOne else outside[1]
+                self.tick = tickNext - 1 if zeroForOne else tickNext
+            elif self.sqrtPriceX96 != start:
+                self.tick = self._tick_at(self.sqrtPriceX96)
+        amounts = (amount - remaining, calculated) if zeroForOne else (calculated, amount - remaining)
+        return {"sender":OWNERS[0], "recipient":OWNERS[0], "amount0":amounts[0], "amount1":amounts[1], "sqrtPriceX96":self.sqrtPriceX96,
+                "liquidity":self.liquidity, "tick":self.tick}
+
+    def fee_growth_inside(self, tickLower:int, tickUpper:int)->list:
+        result = list()
+        for i in range(2):
+            lower, upper = self.ticks.get(tickLower, [0, 0, 0, 0])[2+i], self.ticks.get(tickUpper, [0, 0, 0, 0])[2+i]
+            below = lower if self.tick >= tickLower else self.feeGrowthGlobal[i] - lower
+            above = upper if self.tick < tickUpper else self.feeGrowthGlobal[i] - upper
+            result.append((self.feeGrowthGlobal[i] - below - above) % _q256)
+        return result
+
+    def _modify_position(self, owner:str, tickLower:int, tickUpper:int, liquidityDelta:int)->tuple:
+        if liquidityDelta != 0:
+            for tick, upper in [(tickLower, False), (tickUpper, True)]:
+                if not tick in self.ticks:
+                    self.ticks[tick] = [0, 0] + (list(self.feeGrowthGlobal) if tick <= self.tick else [0, 0])
+                self.ticks[tick][0] += liquidityDelta
+                self.ticks[tick][1] += -liquidityDelta if upper else liquidityDelta
+        position = self.positions.setdefault((owner, tickLower, tickUpper), [0, 0, 0, 0, 0])
+        inside = self.fee_growth_inside(tickLower, tickUpper)
+        for i in range(2):
+            position[3+i] = (position[3+i] + ((inside[i] - position[1+i]) % _q256) * position[0] // _q128) % _q128
+            position[1+i] = inside[i]
+        position[0] += liquidityDelta
+        if liquidityDelta < 0:
+            for tick in [tickLower, tickUpper]:
+                if self.ticks[tick][0] == 0:
+                    del self.ticks[tick]
+
+        amount0 = amount1 = 0
+        if liquidityDelta != 0:
+            roundUp, liquidity = liquidityDelta > 0, abs(liquidityDelta)
+            sqrtLower, sqrtUpper = getSqrtRatioAtTick(tickLower), getSqrtRatioAtTick(tickUpper)
+            if self.tick < tickLower:
+                amount0 = getAmount0Delta(sqrtLower, sqrtUpper, liquidity, roundUp)
+            elif self.tick < tickUpper:
+                amount0 = getAmount0Delta(self.sqrtPriceX96, sqrtUpper, liquidity, roundUp)
+                amount1 = getAmount1Delta(sqrtLower, self.sqrtPriceX96, liquidity, roundUp)
+                self.liquidity += liquidityDelta
+            else:
+                amount1 = getAmount1Delta(sqrtLower, sqrtUpper, liquidity, roundUp)
+        return amount0, amount1
+
+    def _next_initialized_tick(self, lte:bool)->tuple:
+        compressed = self.tick // self.tickSpacing
+        initialized = [x // self.tickSpacing for x in self.ticks]
+        if lte:
+            lowest = (compressed >> 8) << 8
+            candidates = [x for x in initialized if lowest <= x <= compressed]
+            return (max(candidates)*self.tickSpacing, True) if candidates else (lowest*self.tickSpacing, False)
+        compressed += 1
+        highest = ((compressed >> 8) << 8) + 255
+        candidates = [x for x in initialized if compressed <= x <= highest]
+        return (min(candidates)*self.tickSpacing, True) if candidates else (highest*self.tickSpacing, False)
+
+    def _swap_step(self, target:int, remaining:int)->tuple:
+        """ SwapMath.computeSwapStep for exact input amounts """
+        current, liquidity = self.sqrtPriceX96, self.liquidity
+        zeroForOne = current >= target
+        remainingLessFee = remaining * (10**6 - self.fee) // 10**6
+        amountIn = getAmount0Delta(target, current, liquidity, True) if zeroForOne else getAmount1Delta(current, target, liquidity, True)
+        if remainingLessFee >= amountIn:
+            sqrtPriceNextX96 = target
+        elif zeroForOne:
+            numerator = liquidity << 96
+            sqrtPriceNextX96 = -(-(numerator * current) // (numerator + remainingLessFee * current))
+        else:
+            sqrtPriceNextX96 = current + (remainingLessFee << 96) // liquidity
+        reached = sqrtPriceNextX96 == target
+        if zeroForOne:
+            amountIn = amountIn if reached else getAmount0Delta(sqrtPriceNextX96, current, liquidity, True)
+            amountOut = getAmount1Delta(sqrtPriceNextX96, current, liquidity, False)
+        else:
+            amountIn = amountIn if reached else getAmount1Delta(current, sqrtPriceNextX96, liquidity, True)
+            amountOut = getAmount0Delta(current, sqrtPriceNextX96, liquidity, False)
+        feeAmount = -(-(amountIn * self.fee) // (10**6 - self.fee)) if reached else remaining - amountIn
+        return sqrtPriceNextX96, amountIn, amountOut, feeAmount
+
+    def _tick_at(self, sqrtPriceX96:int)->int:
+        """ TickMath.getTickAtSqrtRatio """
+        tick = math.floor(math.log(sqrtPriceX96 / 2**96) / math.log(math.sqrt(1.0001)))
+        while getSqrtRatioAtTick(tick + 1) <= sqrtPriceX96:
+            tick += 1
+        while getSqrtRatioAtTick(tick) > sqrtPriceX96:
+            tick -= 1
+        return tick
+
+
+def _operation(model:reference_pool, rnd:random.Random)->tuple:
+    """ random Mint, Burn, Collect or Swap applied to the model: (event name, event values) or None """
+    opened = list(model.positions.keys())
+    choice = rnd.random()
+    if choice < 0.35 or len(opened) == 0:
+        tickLower = (model.tick // model.tickSpacing + rnd.randint(-60, 40)) * model.tickSpacing
+        tickUpper = tickLower + rnd.randint(1, 30) * model.tickSpacing
+        return "Mint", model.mint(rnd.choice(OWNERS), tickLower, tickUpper, rnd.randint(10**15, 10**19))
+    owner, tickLower, tickUpper = rnd.choice(opened)
+    if choice < 0.5:
+        liquidity = model.positions[(owner, tickLower, tickUpper)][0]
+        # 0 amount burns poke the position's fees
+        return "Burn", model.burn(owner, tickLower, tickUpper, rnd.choice([0, liquidity // 3, liquidity]))
+    if choice < 0.6:
+        owed = [key for key, position in model.positions.items() if position[3] > 0 or position[4] > 0]
+        return "Collect", model.collect(*rnd.choice(owed or opened))
+    if model.liquidity == 0:
+        return None
+    zeroForOne = rnd.random() < 0.5
+    limit = getSqrtRatioAtTick(model.tick + rnd.randint(1, 400) * (-1 if zeroForOne else 1))
+    values = model.swap(zeroForOne, rnd.randint(10**14, 10**18), sqrtPriceLimitX96=limit)
+    return ("Swap", values) if values["amount0"] != 0 or values["amount1"] != 0 else None
+
+
+def _answers(model:reference_pool, tokens:list, ticks:set, positions:set)->dict:
+    """ mock pool answers of the model state ( known ticks and positions no longer in the model answer zeros ) """
+    responses = _responses(_load_abi(univ3_pool))
+    responses.set("token0", result=tokens[0]["address"])
+    responses.set("token1", result=tokens[1]["address"])
+    responses.set("fee", result=model.fee)
+    responses.set("tickSpacing", result=model.tickSpacing)
+    responses.set("slot0", result=(model.sqrtPriceX96, model.tick, 0, 1, 1, model.feeProtocol, True))
+    responses.set("liquidity", result=model.liquidity)
+    responses.set("feeGrowthGlobal0X128", result=model.feeGrowthGlobal[0])
+    responses.set("feeGrowthGlobal1X128", result=model.feeGrowthGlobal[1])
+    responses.set("protocolFees", result=tuple(model.protocolFees))
+    for tick in ticks:
+        values = model.ticks.get(tick, None)
+        responses.set("ticks", tick, result=(*values, 0, 0, 0, True) if values != None else (0, 0, 0, 0, 0, 0, 0, False))
+    bitmap = dict()
+    for tick in model.ticks:
+        compressed = tick // model.tickSpacing
+        bitmap[compressed >> 8] = bitmap.get(compressed >> 8, 0) | 1 << (compressed & 255)
+    for word in range((MIN_TICK // model.tickSpacing) >> 8, ((MAX_TICK // model.tickSpacing) >> 8) + 1):
+        responses.set("tickBitmap", word, result=bitmap.get(word, 0))
+    for owner, tickLower, tickUpper in positions:
+        responses.set("positions", univ3_pool.get_positionKey(ownerAddress=owner, tickLower=tickLower, tickUpper=tickUpper),
+                      result=tuple(model.positions.get((owner, tickLower, tickUpper), [0, 0, 0, 0, 0])))
+    return responses.items
+
+
+def _log(name:str, values:dict)->tuple:
+    """ ( topics, data ) of a pool event """
+    event = [x for x in _load_abi(univ3_pool) if x.get("type", "") == "event" and x["name"] == name][0]
+    indexed = [x for x in event["inputs"] if x.get("indexed", False)]
+    data = [x for x in event["inputs"] if not x.get("indexed", False)]
+    topics = [event_abi_to_log_topic(event)] + [abi.encode_single(x["type"], values[x["name"]]) for x in indexed]
+    return topics, abi.encode_abi(_abi_types(data), [values[x["name"]] for x in data])
+
+
+@pytest.fixture(scope="module")
+def replay_chain():
+    """ mock chain whose pool answers follow the reference model block by block
+
+     Returns:
+        tuple: (mock_chain, seed block, {block: model state answered from that block})
+     """
+    rnd = random.Random(12)
+    model = reference_pool(tick=rnd.randint(-50000, 50000) // 60 * 60)
+    # pool history before the seed block
+    for _ in range(60):
+        _operation(model, rnd)
+    states = [copy.deepcopy(model)]
+    rounds = list()
+    for _ in range(10):
+        rounds.append([_log(*x) for x in (_operation(model, rnd) for _ in range(rnd.randint(4, 10))) if x != None])
+        states.append(copy.deepcopy(model))
+    # ticks and positions created later answer zeros until then
+    positions = set(key for state in states for key in state.positions)
+    ticks = set(tick for state in states for tick in state.ticks) | set(x for key in positions for x in key[1:])
+
+    chain = mock_chain(fleet_size=0, blocks=0, contracts={POOL:dict()})
+    answers = _answers(states[0], chain.tokens, ticks, positions)
+    seed_block = chain.set_responses(POOL, answers)
+    blocks = dict()
+    for logs, state in zip(rounds, states[1:]):
+        chain.emit(POOL, logs)
+        changed = _answers(state, chain.tokens, ticks, positions)
+        blocks[chain.set_responses(POOL, {k:v for k, v in changed.items() if answers[k] != v})] = state
+        answers = changed
+    return chain, seed_block, blocks
+
+
+def test_pool_replay_matches_pool_state(replay_chain, stores):
+    chain, seed_block, states = replay_chain
+    w3 = chain.web3()
+    replay = pool_replay(pool=univ3_pool(address=POOL, web3Provider=w3, block=seed_block), multicall_address=chain.multicall)
+
+    compared = list()
+    for block in replay.snapshots(blocks=list(states.keys())):
+        model = states[block]
+        pool = univ3_pool(address=POOL, web3Provider=w3, block=block)
+        slot0 = pool.slot0
+        assert (replay.slot0["sqrtPriceX96"], replay.slot0["tick"], replay.slot0["feeProtocol"]) == (slot0["sqrtPriceX96"], slot0["tick"], slot0["feeProtocol"])
+        assert replay.liquidity == pool.liquidity
+        assert (replay.feeGrowthGlobal0X128, replay.feeGrowthGlobal1X128) == (pool.feeGrowthGlobal0X128, pool.feeGrowthGlobal1X128)
+        assert replay.protocolFees == list(model.protocolFees)
+        assert sorted(int(x) for x in replay.tick_map.ticks) == sorted(model.ticks)
+        for tick in model.ticks:
+            fields = ["liquidityGross", "liquidityNet", "feeGrowthOutside0X128", "feeGrowthOutside1X128", "initialized"]
+            assert [replay.ticks(tick)[x] for x in fields] == [pool.ticks(tick)[x] for x in fields], tick
+        for owner, tickLower, tickUpper in model.positions:
+            position = pool.positions(univ3_pool.get_positionKey(ownerAddress=owner, tickLower=tickLower, tickUpper=tickUpper))
+            assert list(replay.positions(ownerAddress=owner, tickLower=tickLower, tickUpper=tickUpper).values()) == list(position.values())
+            assert replay.get_tvlPriceFees(ownerAddress=owner, tickUpper=tickUpper, tickLower=tickLower) == \
+                        pool.get_tvlPriceFees(ownerAddress=owner, tickUpper=tickUpper, tickLower=tickLower)
+        compared.append(block)
+
+    assert compared == sorted(states.keys())